@@ -0,0 +1,15 @@
+"""
+Benchmarks for plugit's hot paths.
+
+Run all benchmarks and save the results::
+
+    python -m benchmarks.run --output before.json
+
+and compare a later run against them::
+
+    python -m benchmarks.run --output after.json --compare before.json
+
+``--quick`` uses smaller data sets and ``--filter`` selects benchmarks by a
+regular expression on their names. The results file is JSON, see
+`benchmarks.runner.Runner.as_dict`.
+"""
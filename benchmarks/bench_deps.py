@@ -0,0 +1,30 @@
+"""
+Dependency string parsing and evaluation.
+"""
+from plugit import deps, version
+from plugit.specifier import SpecifierSet, compile_spec
+
+from benchmarks import data
+
+
+def run(runner):
+    count = runner.quick and 1000 or 10000
+    specs = data.spec_strings(count)
+    versions = [version.from_string(s)
+            for s in data.version_strings(count, seed=1)]
+
+    runner.measure('deps.parse', lambda: map(deps._parse, specs), count=count)
+    runner.measure('deps.compile', lambda: map(SpecifierSet, specs),
+            count=count)
+    runner.measure('deps.compile.cached', lambda: map(compile_spec, specs),
+            count=count)
+
+    compiled = [compile_spec(spec) for spec in specs]
+    pairs = zip(compiled, versions)
+    runner.measure('deps.contains',
+            lambda: [spec.contains(ver) for spec, ver in pairs], count=count)
+
+    index = deps.VersionIndex(versions)
+    runner.measure('deps.best_version',
+            lambda: [index.best(spec) for spec in compiled[:1000]],
+            count=min(count, 1000), versions=count)
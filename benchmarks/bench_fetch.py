@@ -0,0 +1,50 @@
+"""
+Descriptor and package fetching against a local HTTP server.
+"""
+import os, shutil, hashlib
+
+from plugit import fetch
+from plugit.connection import ConnectionPool
+
+from tests.server import StandInServer
+
+DESCRIPTOR = '{"name": "%s", "version": "1.0", "depends": ["base"]}'
+
+
+def run(runner):
+    apps = runner.quick and 20 or 100
+    package_sizes = runner.quick and (1, 4) or (1, 16)
+    server = StandInServer().start()
+    try:
+        for i in xrange(apps):
+            server.add('/app%d' % i, DESCRIPTOR % ('app%d' % i))
+        base_url = server.url('/')
+        pool = ConnectionPool()
+        names = [('app%d' % i, None) for i in xrange(apps)]
+
+        runner.measure('fetch.descriptor',
+                lambda: fetch.fetch_descriptor(base_url, 'app0'))
+        runner.measure('fetch.descriptor.pooled',
+                lambda: fetch.fetch_descriptor(base_url, 'app0', pool=pool))
+        runner.measure('fetch.descriptors', lambda: fetch.fetch_descriptors(
+            base_url, names, pool=pool), count=apps)
+        # the same descriptors one after the other, a connection each
+        runner.measure('fetch.descriptors.serial', lambda: [
+            fetch.fetch_descriptor(base_url, name) for name, _ in names],
+            count=apps)
+
+        for megabytes in package_sizes:
+            body = os.urandom(megabytes * 1024 * 1024)
+            path = '/pkg%d.tar' % megabytes
+            server.add(path, body)
+            url = server.url(path)
+            digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+            def fetch_package():
+                filename, verifier = fetch.fetch_package(url, digest)
+                assert verifier.is_valid()
+                shutil.rmtree(os.path.dirname(filename))
+            runner.measure('fetch.package.%dm' % megabytes, fetch_package,
+                    bytes=len(body))
+        pool.close()
+    finally:
+        server.stop()
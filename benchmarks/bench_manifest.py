@@ -0,0 +1,43 @@
+"""
+Verification of an installed tree against its manifest, in full and in
+quick mode.
+"""
+from __future__ import with_statement
+
+import os, time, shutil, tempfile
+
+from plugit import manifest
+
+
+def run(runner):
+    if not runner.wants('manifest.'):
+        return
+    count = 2000 if runner.quick else 20000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for index in xrange(count):
+            directory = os.path.join(tmpdir, 'pkg%d' % (index // 100))
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+            with open(os.path.join(directory, 'mod%d.py' % index), 'w') as f:
+                f.write('VALUE = %d\n' % index * 100)
+        # older than the verification, so that quick mode can skip them
+        past = time.time() - 60
+        for dirpath, dirnames, filenames in os.walk(tmpdir):
+            for filename in filenames:
+                os.utime(os.path.join(dirpath, filename), (past, past))
+        expected = manifest.Manifest.from_directory(tmpdir)
+        state = manifest.VerifyState()
+        manifest.verify(tmpdir, expected, state)
+        with_size = dict(files=count)
+        runner.measure('manifest.verify.full',
+                lambda: manifest.verify(tmpdir, expected), repeat=3,
+                **with_size)
+        runner.measure('manifest.verify.multi_algorithm',
+                lambda: manifest.verify(tmpdir, expected,
+                    algorithms=['md5', 'sha1']), repeat=3, **with_size)
+        runner.measure('manifest.verify.quick',
+                lambda: manifest.verify(tmpdir, expected, state, quick=True),
+                repeat=3, **with_size)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,45 @@
+"""
+Package validation and unpacking of tar and zip archives.
+"""
+import os, shutil, hashlib, tempfile
+
+from plugit import package
+
+from benchmarks import data
+
+
+def run(runner):
+    shapes = [('small', 200, 1024), ('large', 20, 256 * 1024)]
+    if runner.quick:
+        shapes = [('small', 50, 1024), ('large', 4, 256 * 1024)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for shape, count, size in shapes:
+            if not runner.wants('package.') or not runner.wants(shape):
+                continue
+            members = data.package_members(count, size)
+            for kind, write in (('tar', data.write_tar),
+                    ('zip', data.write_zip)):
+                name = 'package.%s.%s' % (kind, shape)
+                if not runner.wants(name):
+                    continue
+                workdir = os.path.join(tmpdir, '%s-%s' % (kind, shape))
+                os.mkdir(workdir)
+                path = os.path.join(workdir, 'app.' + kind)
+                write(path, members)
+                with_size = dict(files=count + 1, bytes=os.path.getsize(path))
+                digest = 'sha1:' + _sha1(path)
+                runner.measure(name + '.is_valid',
+                        lambda: package.is_valid(digest, path), **with_size)
+                unpacked = os.path.join(workdir, package.UNPACK_DIR)
+                def remove_unpacked():
+                    if os.path.exists(unpacked):
+                        shutil.rmtree(unpacked)
+                runner.measure(name + '.unpack', lambda: package.unpack(path),
+                        setup=remove_unpacked, **with_size)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
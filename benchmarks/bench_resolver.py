@@ -0,0 +1,27 @@
+"""
+Dependency resolution over a layered graph that needs backtracking.
+"""
+from plugit.app import App
+from plugit.resolver import Resolver, MemorySource
+
+
+def run(runner):
+    if not runner.wants('resolver.'):
+        return
+    # layers of plugins, each depending on two plugins of the next layer
+    # with a version range that rules out the newest release
+    layers, width = (10, 10) if runner.quick else (30, 10)
+    apps = []
+    for layer in xrange(layers):
+        for i in xrange(width):
+            depends = {}
+            if layer + 1 < layers:
+                for j in (i, (i + 1) % width):
+                    depends['p%d_%d' % (layer + 1, j)] = '>= 1.0, < 3.0'
+            for minor in xrange(4):
+                apps.append(App('p%d_%d' % (layer, i), '%d.0' % minor,
+                    depends=depends))
+    roots = ['p0_%d' % i for i in xrange(width)]
+    runner.measure('resolver.diamond',
+            lambda: Resolver(MemorySource(apps)).resolve(roots),
+            apps=layers * width, versions=len(apps))
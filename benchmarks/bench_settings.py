@@ -0,0 +1,40 @@
+"""
+Settings updates on generated settings modules.
+"""
+from plugit.settingshandler import SettingsStringUpdater, SettingsParser
+
+from benchmarks import data
+
+UPDATED_NAMES = 20
+
+
+def run(runner):
+    sizes = runner.quick and (1000,) or (1000, 10000, 100000)
+    for lines in sizes:
+        prefix = 'settings.%dk' % (lines // 1000)
+        if not runner.wants(prefix):
+            continue
+        source = data.settings_source(lines)
+        names = data.container_names(source, UPDATED_NAMES)
+        append = dict((name, name.startswith('DICT') and {'new': 1} or 'new')
+                for name in names)
+        new = {'BENCHMARK_SETTING': True}
+        # large parses take long enough, do not repeat them as often
+        repeat = lines >= 100000 and 1 or lines >= 10000 and 3 or None
+        shared = SettingsParser()
+
+        def update(parser, fast=False):
+            updater = SettingsStringUpdater(source, parser, fast)
+            updater.update(new, append)
+            return updater.result
+
+        runner.measure(prefix + '.parse', lambda: SettingsStringUpdater(
+            source, SettingsParser()), repeat=repeat, lines=lines)
+        runner.measure(prefix + '.update',
+                lambda: update(SettingsParser()), repeat=repeat,
+                lines=lines, names=len(names) + 1)
+        runner.measure(prefix + '.update.cached', lambda: update(shared),
+                repeat=repeat, lines=lines, names=len(names) + 1)
+        runner.measure(prefix + '.update.fast',
+                lambda: update(SettingsParser(), True), repeat=repeat,
+                lines=lines, names=len(names) + 1)
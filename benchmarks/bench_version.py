@@ -0,0 +1,23 @@
+"""
+Version parsing and ordering.
+"""
+from operator import attrgetter
+
+from plugit import version
+
+from benchmarks import data
+
+
+def run(runner):
+    count = runner.quick and 2000 or 20000
+    strings = data.version_strings(count)
+    versions = [version.from_string(s) for s in strings]
+
+    runner.measure('version.parse', lambda: map(version._parse, strings),
+            count=count)
+    runner.measure('version.from_string.cached',
+            lambda: map(version.from_string, strings), count=count)
+    runner.measure('version.sort', lambda: sorted(versions), count=count)
+    runner.measure('version.sort.sort_key',
+            lambda: sorted(versions, key=attrgetter('sort_key')),
+            count=count)
@@ -0,0 +1,103 @@
+"""
+Synthetic data generators for the benchmarks. All generators are
+deterministic for a given seed, so runs are comparable.
+"""
+from __future__ import with_statement
+
+import random, tarfile, zipfile
+from StringIO import StringIO
+
+SUBRELEASES = ['', ' pre-alpha', ' alpha %d', ' beta %d', ' prerelease %d']
+OPERATORS = ['<', '<=', '==', '!=', '>=', '>']
+
+
+def version_strings(count, seed=0):
+    rnd = random.Random(seed)
+    result = []
+    for _ in xrange(count):
+        ver = '%d.%d' % (rnd.randint(0, 20), rnd.randint(0, 50))
+        if rnd.random() < 0.5:
+            ver += '.%d' % rnd.randint(0, 30)
+        if rnd.random() < 0.3:
+            sub = rnd.choice(SUBRELEASES[1:])
+            ver += '%d' in sub and sub % rnd.randint(1, 9) or sub
+        result.append(ver)
+    return result
+
+def spec_strings(count, clauses=3, seed=0):
+    rnd = random.Random(seed)
+    versions = version_strings(count * clauses, seed)
+    return [', '.join('%s %s' % (rnd.choice(OPERATORS), versions.pop())
+                for _ in xrange(rnd.randint(1, clauses)))
+            for _ in xrange(count)]
+
+def settings_source(lines, seed=0):
+    """
+    :return: a generated settings module of about `lines` lines with
+        comments, scalars, multi-line lists and dicts; the containers are
+        named ``LIST_<n>`` and ``DICT_<n>``.
+    """
+    rnd = random.Random(seed)
+    out = ['# Generated settings.\n', '\n']
+    count = 0
+    while len(out) < lines:
+        kind = rnd.randint(0, 3)
+        if kind == 0:
+            out.append('# setting %d\n' % count)
+            out.append('SCALAR_%d = %r\n' % (count, rnd.random()))
+        elif kind == 1:
+            out.append('LIST_%d = [\n' % count)
+            for i in xrange(rnd.randint(1, 8)):
+                out.append('    %r,\n' % ('item%d' % i))
+            out.append(']\n')
+        elif kind == 2:
+            out.append('DICT_%d = {\n' % count)
+            for i in xrange(rnd.randint(1, 8)):
+                out.append('    %r: %d,\n' % ('key%d' % i, i))
+            out.append('}\n')
+        else:
+            out.append('STRING_%d = %r\n' % (count, 'value %d' % count))
+        out.append('\n')
+        count += 1
+    return ''.join(out)
+
+def container_names(source, count, seed=0):
+    """
+    :return: `count` names of the list and dict settings in `source`.
+    """
+    names = [line.split(' ', 1)[0] for line in source.splitlines()
+            if line.startswith('LIST_') or line.startswith('DICT_')]
+    rnd = random.Random(seed)
+    return rnd.sample(names, min(count, len(names)))
+
+def package_members(count, size, seed=0):
+    """
+    :return: `count` ``(name, data)`` pairs of `size` bytes, half of the
+        data is random, the other half repeats (like source files do).
+    """
+    rnd = random.Random(seed)
+    members = [('app/__init__.py', 'VERSION = None\n')]
+    for i in xrange(count):
+        noise = ''.join(chr(rnd.getrandbits(8)) for _ in xrange(size // 2))
+        text = ('# line %d\n' % i) * (size // 20 + 1)
+        members.append(('app/module%d.py' % i,
+            (noise + text)[:size]))
+    return members
+
+def write_tar(path, members, mode='w:gz'):
+    archive = tarfile.open(path, mode)
+    try:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, StringIO(data))
+    finally:
+        archive.close()
+
+def write_zip(path, members):
+    archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for name, data in members:
+            archive.writestr(name, data)
+    finally:
+        archive.close()
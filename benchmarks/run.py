@@ -0,0 +1,44 @@
+"""
+Runs the benchmarks, see `benchmarks`.
+"""
+import sys, optparse
+
+from benchmarks import runner
+
+MODULES = ['version', 'deps', 'resolver', 'settings', 'package', 'fetch',
+        'manifest']
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='save the results as JSON')
+    parser.add_option('-c', '--compare', metavar='FILE',
+            help='compare the results with an earlier results file')
+    parser.add_option('-f', '--filter', metavar='REGEX',
+            help='run only the benchmarks whose names match')
+    parser.add_option('-q', '--quick', action='store_true',
+            help='use smaller data sets')
+    parser.add_option('-t', '--threshold', type='float',
+            default=runner.DEFAULT_THRESHOLD,
+            help='time ratio above which a result is a regression '
+                 '(default: %default)')
+    options, args = parser.parse_args(argv)
+    modules = args or MODULES
+
+    bench = runner.Runner(quick=options.quick, pattern=options.filter)
+    for name in modules:
+        module = __import__('benchmarks.bench_' + name, fromlist=['run'])
+        module.run(bench)
+    if options.output:
+        bench.save(options.output)
+    if options.compare:
+        rows = runner.compare(runner.load(options.compare), bench.as_dict(),
+                options.threshold)
+        print runner.format_comparison(rows)
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
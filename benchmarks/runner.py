@@ -0,0 +1,138 @@
+"""
+Timing, result collection and comparison of benchmark runs.
+"""
+from __future__ import with_statement
+
+import re, sys, time, timeit, platform
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# a sample takes at least this long, fast calls are repeated within it
+MIN_TIME = 0.2
+REPEAT = 5
+# ratio of the new to the old time above which a result is a regression
+DEFAULT_THRESHOLD = 1.1
+
+
+class Runner(object):
+    """
+    Times benchmark functions and collects the results.
+
+    Every benchmark is timed `repeat` times. A sample calls the function as
+    many times as are needed to take `min_time` seconds, and the per-call
+    time of the sample is recorded. The minimum is the most stable measure
+    and is the one that is compared between runs.
+    """
+    def __init__(self, quick=False, pattern=None, min_time=MIN_TIME,
+            repeat=REPEAT, verbose=True):
+        self.quick = quick
+        self.pattern = pattern and re.compile(pattern)
+        self.min_time = min_time
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+
+    def wants(self, name):
+        """
+        True if benchmark `name` is selected. Benchmark modules check this
+        before building expensive data sets.
+        """
+        return self.pattern is None or bool(self.pattern.search(name))
+
+    def measure(self, name, func, setup=None, repeat=None, **info):
+        """
+        Times `func`, calling `setup` (untimed) before every call.
+
+        :param info: additional data to store with the result, e.g. the size
+            of the input
+        """
+        if not self.wants(name):
+            return
+        repeat = repeat or self.repeat
+        number = 1
+        elapsed = self._time(func, setup, number)
+        while elapsed < self.min_time:
+            # aim for 1.5 times the minimum to avoid another round
+            estimate = int(number * 1.5 * self.min_time / max(elapsed, 1e-6))
+            number = max(number * 2, min(estimate, number * 100))
+            elapsed = self._time(func, setup, number)
+        samples = [elapsed / number]
+        for _ in xrange(repeat - 1):
+            samples.append(self._time(func, setup, number) / number)
+        samples.sort()
+        result = dict(info, min=samples[0], median=samples[len(samples) // 2],
+                mean=sum(samples) / len(samples), number=number,
+                repeat=repeat)
+        self.results[name] = result
+        if self.verbose:
+            sys.stderr.write('%-50s %s\n' % (name, _format_time(samples[0])))
+
+    def _time(self, func, setup, number):
+        timer = timeit.default_timer
+        total = 0.0
+        for _ in xrange(number):
+            if setup is not None:
+                setup()
+            start = timer()
+            func()
+            total += timer() - start
+        return total
+
+    def as_dict(self):
+        """
+        :return: ``{'meta': {...}, 'results': {name: {'min': seconds,
+            'median': ..., 'mean': ..., 'number': calls per sample,
+            'repeat': samples, ...}}}``
+        """
+        return {
+            'meta': {
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'quick': self.quick,
+            },
+            'results': self.results,
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two results dictionaries (see `Runner.as_dict`).
+
+    :return: a list of ``(name, old_min, new_min, ratio, is_regression)``
+        tuples for the benchmarks that are in both, sorted by name.
+    """
+    old_results = old['results']
+    new_results = new['results']
+    rows = []
+    for name in sorted(set(old_results) & set(new_results)):
+        old_min = old_results[name]['min']
+        new_min = new_results[name]['min']
+        ratio = new_min / old_min if old_min else float('inf')
+        rows.append((name, old_min, new_min, ratio, ratio > threshold))
+    return rows
+
+def format_comparison(rows):
+    lines = ['%-50s %10s %10s %7s' % ('benchmark', 'old', 'new', 'ratio')]
+    for name, old_min, new_min, ratio, is_regression in rows:
+        lines.append('%-50s %10s %10s %6.2fx%s' % (name,
+            _format_time(old_min), _format_time(new_min), ratio,
+            is_regression and '  REGRESSION' or ''))
+    return '\n'.join(lines)
+
+def _format_time(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return '%.3g %s' % (seconds * factor, unit)
+    return '%.3g ns' % (seconds * 1e9)
@@ -0,0 +1,5 @@
+import sys
+
+from plugit.cli import main
+
+sys.exit(main(prog='plugit'))
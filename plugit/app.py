@@ -2,6 +2,40 @@ class App(object):
     def __init__(self,
             name, version,
             author=None, author_email=None, depends=None,
-            **kwargs):
+            package_url=None, digest=None, manifest_url=None,
+            versions=None, **kwargs):
         self.name = name
         self.version = version
+        self.author = author
+        self.author_email = author_email
+        self.depends = normalize_depends(depends)
+        self.package_url = package_url
+        self.digest = digest
+        self.manifest_url = manifest_url
+        # the published versions, listed by the latest descriptor
+        self.versions = list(versions or [])
+
+    def __repr__(self):
+        return 'App(%r, %r)' % (self.name, self.version)
+
+
+def normalize_depends(depends):
+    """
+    Converts dependencies to a dictionary that maps application names to
+    version dependency strings ('' for any version). Dependencies can be
+    given as a dictionary, or as a list of names and ``[name, ver_deps]``
+    pairs.
+    """
+    if not depends:
+        return {}
+    if isinstance(depends, dict):
+        return dict((name, ver_deps or '')
+                for name, ver_deps in depends.items())
+    result = {}
+    for dep in depends:
+        if isinstance(dep, basestring):
+            result[dep] = ''
+        else:
+            name, ver_deps = dep
+            result[name] = ver_deps or ''
+    return result
@@ -0,0 +1,596 @@
+"""
+Non-blocking descriptor and package fetching.
+
+`AsyncFetcher` runs many HTTP transfers concurrently in one thread on an
+`asyncore` event loop, so a caller with its own loop does not need a thread
+per transfer. Transfers are limited per host, time out when the server goes
+quiet and can be cancelled, which removes the partial package. Errors are
+reported as `FetchError`, as in the `fetch` module::
+
+    fetcher = AsyncFetcher(per_host=4, timeout=30)
+    descriptor = fetcher.fetch_descriptor(base_url, 'blog')
+    package = fetcher.fetch_package(url, digest, callback=on_done)
+    fetcher.run()
+    app = descriptor.result()
+    package_file, verifier = package.result()
+
+`run` drives the loop until all transfers are done. A caller that has a
+loop of its own calls `poll` from it instead, and `close` when it is done
+with the fetcher.
+
+Nothing that can block runs on the loop: host names are resolved on helper
+threads (once per host) before the sockets enter the loop, and package data
+is written to disk in `package.CHUNK_SIZE` blocks by a writer thread. The
+writer is fed through a bounded queue; while the queue is full, the loop
+stops reading package data, so a slow disk slows the package transfers down
+instead of filling memory. Callbacks run on the loop, an exception raised by
+a callback fails its transfer.
+
+Requests use HTTP/1.0 without keep-alive, so a response ends with its
+``Content-Length`` or when the server closes the connection. Only plain
+HTTP is supported.
+"""
+from __future__ import with_statement
+
+import os, sys, time, Queue, shutil, socket, asyncore, tempfile, threading, \
+        urlparse
+from collections import deque
+from functools import partial
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from plugit import app, fetch, package
+from plugit.connection import request_path
+from plugit.exceptions import FetchError
+
+DEFAULT_PER_HOST = 4
+DEFAULT_TIMEOUT = 30
+# how long one round of the event loop waits for socket events
+POLL_INTERVAL = 0.05
+# package data blocks waiting for the writer thread
+WRITE_QUEUE_SIZE = 64
+
+_HEADER_END = '\r\n\r\n'
+MAX_HEADER_SIZE = 64 * 1024
+
+# tells the writer thread to close the file of a transfer
+_CLOSE = object()
+
+
+class Transfer(object):
+    """
+    A descriptor or package transfer started by `AsyncFetcher`.
+
+    :ivar done: True when the transfer has finished, failed or been
+        cancelled
+    :ivar cancelled: True if the transfer was cancelled
+    :ivar bytes_received: the number of body bytes received so far
+    """
+    def __init__(self, fetcher, url, callback):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme != 'http':
+            raise FetchError("Unsupported URL scheme in %s." % url)
+        self.fetcher = fetcher
+        self.url = url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.callback = callback
+        self.done = False
+        self.cancelled = False
+        self.bytes_received = 0
+        self.error = None
+        self._result = None
+        self._channel = None
+        self._header = ''
+        self._status = None
+        self._length = None
+        self._finishing = False
+        self.last_activity = None
+
+    def result(self):
+        """
+        :return: the `app.App` descriptor for descriptor transfers, the
+            package path (or ``(path, verifier)`` with a digest) for package
+            transfers
+        :raise FetchError: if the transfer failed, was cancelled or has not
+            finished yet
+        :raise Exception: what the callback raised, if it failed
+        """
+        if not self.done:
+            raise FetchError("Transfer of %s has not finished." % self.url)
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def cancel(self):
+        """
+        Stops the transfer and removes what it has written to disk.
+        """
+        if not self.done:
+            self.cancelled = True
+            self._fail(FetchError("Transfer of %s was cancelled."
+                % self.url))
+
+    def _connect(self, address):
+        family, sockaddr = address
+        request = ('GET %s HTTP/1.0\r\nHost: %s:%d\r\n'
+                'Accept-Encoding: identity\r\n\r\n'
+                % (request_path(self.url), self.host, self.port))
+        try:
+            self._channel = _Channel(self, request, family, sockaddr,
+                    self.fetcher._map)
+        except socket.error, e:
+            self._fail(FetchError("Error in connecting to %s: %s"
+                % (self.url, str(e))))
+
+    def _feed(self, data):
+        self.last_activity = time.time()
+        if self._status is None:
+            self._header += data
+            end = self._header.find(_HEADER_END)
+            if end < 0:
+                if len(self._header) > MAX_HEADER_SIZE:
+                    self._fail(FetchError("Response header from %s is too "
+                        "large." % self.url))
+                return
+            data = self._header[end + len(_HEADER_END):]
+            self._parse_header(self._header[:end])
+            self._header = ''
+            if self.done:
+                return
+        if self._length is not None:
+            data = data[:self._length - self.bytes_received]
+        if data:
+            self.bytes_received += len(data)
+            self._write(data)
+        if self.bytes_received == self._length:
+            self._complete()
+
+    def _parse_header(self, header):
+        lines = header.split('\r\n')
+        try:
+            version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+            self._status = int(status)
+            headers = dict((name.strip().lower(), value.strip())
+                    for name, value in (line.split(':', 1)
+                        for line in lines[1:] if ':' in line))
+            if 'content-length' in headers:
+                self._length = int(headers['content-length'])
+        except ValueError:
+            self._fail(FetchError("Invalid response from %s." % self.url))
+            return
+        if self._status != 200:
+            self._fail(FetchError("HTTP %s %s" % (self._status, reason)))
+
+    def _eof(self):
+        if self.done:
+            return
+        if self._status is None:
+            self._fail(FetchError("Connection to %s closed before a "
+                "response." % self.url))
+        elif self._length is not None and self.bytes_received < self._length:
+            self._fail(FetchError("Transfer of %s was cut off after %d of "
+                "%d bytes." % (self.url, self.bytes_received, self._length)))
+        else:
+            self._complete()
+
+    def _complete(self):
+        if self.done or self._finishing:
+            return
+        self._finishing = True
+        self._close_channel()
+        self._finish()
+
+    def _succeed(self, result):
+        if self.done:
+            return
+        self._result = result
+        self._done()
+
+    def _fail(self, error):
+        if self.done:
+            return
+        self._close_channel()
+        self.error = error
+        self._discard()
+        self._done()
+
+    def _done(self):
+        self.done = True
+        self.fetcher._finished(self)
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                # fails the transfer, rather than getting lost in the loop
+                if self.error is None:
+                    self.error = sys.exc_info()[1]
+                    self._discard()
+
+    def _close_channel(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+
+    # implemented by the transfer types
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def _finish(self):
+        """
+        Calls `_succeed` or `_fail` once the body has been received, now or
+        later from the loop.
+        """
+        raise NotImplementedError
+
+    def _discard(self):
+        pass
+
+    def _reading(self):
+        """
+        :return: False while the transfer cannot take more data
+        """
+        return True
+
+
+class _DescriptorTransfer(Transfer):
+    def __init__(self, fetcher, url, callback):
+        Transfer.__init__(self, fetcher, url, callback)
+        self._chunks = []
+
+    def _write(self, data):
+        self._chunks.append(data)
+
+    def _finish(self):
+        try:
+            descriptor = app.App(**json.loads(''.join(self._chunks)))
+        except Exception, e:
+            self._fail(FetchError("Error in fetching application "
+                "descriptor: %s" % str(e)))
+        else:
+            self._succeed(descriptor)
+
+
+class _PackageTransfer(Transfer):
+    """
+    The package file belongs to the writer thread once data has been
+    queued for it, so the temporary directory is only removed after the
+    writer has closed the file.
+    """
+    def __init__(self, fetcher, url, digest, callback):
+        Transfer.__init__(self, fetcher, url, callback)
+        self.verifier = package.DigestVerifier(digest) if digest else None
+        self._tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self._tmpdir,
+                fetch._package_filename(url))
+        self._file = open(self.filename, 'wb')
+        self._queued = False
+        self._closing = False
+        self._file_closed = False
+        self._discarded = False
+
+    def _write(self, data):
+        if self.verifier:
+            self.verifier.update(data)
+        self._queued = True
+        self.fetcher._writer().put(self, data)
+
+    def _finish(self):
+        self._close_file()
+
+    def _closed(self, error):
+        # called on the loop once the file is closed
+        self._file_closed = True
+        if self._discarded:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+        elif error is not None:
+            self._fail(FetchError("Error in writing %s: %s"
+                % (self.filename, str(error))))
+        elif self.verifier:
+            self._succeed((self.filename, self.verifier))
+        else:
+            self._succeed(self.filename)
+
+    def _discard(self):
+        self._discarded = True
+        if self._file_closed:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+        else:
+            self._close_file()
+
+    def _close_file(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self._queued:
+            self.fetcher._writer().put(self, _CLOSE)
+        else:
+            self._file.close()
+            self._closed(None)
+
+    def _reading(self):
+        return not self.fetcher._writer().full()
+
+
+class _Writer(object):
+    """
+    Writes package data on a thread of its own, so that a slow disk does
+    not block the loop. The outcome of closing a file is passed back to the
+    loop through `events`.
+
+    `put` never blocks: what does not fit into the queue is kept per
+    transfer and handed over by `flush`, which the loop calls every round.
+    As the transfers stop reading while anything is kept back, that is at
+    most one block and the closing of the file per transfer.
+    """
+    def __init__(self, events):
+        self.events = events
+        self.queue = Queue.Queue(WRITE_QUEUE_SIZE)
+        self.backlog = {}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, transfer, data):
+        if transfer in self.backlog:
+            self.backlog[transfer].append(data)
+            return
+        try:
+            self.queue.put_nowait((transfer, data))
+        except Queue.Full:
+            self.backlog[transfer] = deque([data])
+
+    def flush(self):
+        for transfer, items in self.backlog.items():
+            try:
+                while items:
+                    self.queue.put_nowait((transfer, items[0]))
+                    items.popleft()
+            except Queue.Full:
+                return
+            del self.backlog[transfer]
+
+    def full(self):
+        return bool(self.backlog) or self.queue.full()
+
+    def stop(self):
+        """
+        Waits for the queued writes, blocking.
+        """
+        for transfer, items in self.backlog.items():
+            for data in items:
+                self.queue.put((transfer, data))
+        self.backlog.clear()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        errors = {}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            transfer, data = item
+            if data is _CLOSE:
+                error = errors.pop(transfer, None)
+                try:
+                    transfer._file.close()
+                except IOError, e:
+                    error = error or e
+                self.events.append(partial(transfer._closed, error))
+            elif transfer not in errors and not transfer.done:
+                try:
+                    transfer._file.write(data)
+                except IOError, e:
+                    errors[transfer] = e
+
+
+class _Channel(asyncore.dispatcher):
+    def __init__(self, transfer, request, family, address, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.transfer = transfer
+        self.out_buffer = request
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def readable(self):
+        return self.transfer._reading()
+
+    def writable(self):
+        return bool(self.out_buffer) or not self.connected
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+        self.transfer.last_activity = time.time()
+
+    def handle_read(self):
+        data = self.recv(package.CHUNK_SIZE)
+        if data:
+            self.transfer._feed(data)
+
+    def handle_close(self):
+        self.close()
+        self.transfer._eof()
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.transfer._fail(FetchError("Error in fetching %s: %s"
+            % (self.transfer.url, str(error))))
+
+
+class AsyncFetcher(object):
+    """
+    Runs transfers with at most `per_host` connections to each host. A
+    transfer fails if nothing is sent or received for `timeout` seconds.
+    """
+    def __init__(self, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT):
+        self.per_host = per_host
+        self.timeout = timeout
+        self._map = {}
+        self._active = {}
+        self._queued = {}
+        self._pending = []
+        self._addresses = {}
+        self._resolving = {}
+        # callables that helper threads hand to the loop
+        self._events = deque()
+        self._writer_thread = None
+
+    def fetch_descriptor(self, base_url, appname, appversion=None,
+            callback=None):
+        """
+        Starts fetching an application descriptor (see
+        `fetch.fetch_descriptor`).
+
+        :param callback: called with the `Transfer` when it is done
+        :return: a `Transfer` whose result is an `app.App`
+        """
+        return self._add(_DescriptorTransfer(self,
+            fetch._descriptor_url(base_url, appname, appversion), callback))
+
+    def fetch_package(self, url, digest=None, callback=None):
+        """
+        Starts fetching an application package to a temporary directory
+        (see `fetch.fetch_package`).
+
+        :return: a `Transfer` whose result is the package path or, if
+            `digest` is given, a ``(path, verifier)`` tuple
+        """
+        return self._add(_PackageTransfer(self, url, digest, callback))
+
+    def poll(self, timeout=POLL_INTERVAL):
+        """
+        Handles the socket events that occur within `timeout` seconds and
+        expires idle transfers.
+
+        :return: True if transfers are still pending
+        """
+        if self._writer_thread is not None:
+            self._writer_thread.flush()
+        if self._map:
+            asyncore.loop(timeout, map=self._map, count=1)
+        else:
+            time.sleep(min(timeout, POLL_INTERVAL))
+        while self._events:
+            self._events.popleft()()
+        now = time.time()
+        for transfer in list(self._pending):
+            if (transfer.last_activity is not None and
+                    not transfer._finishing and
+                    now - transfer.last_activity > self.timeout):
+                transfer._fail(FetchError("Transfer of %s timed out."
+                    % transfer.url))
+        return bool(self._pending)
+
+    def run(self):
+        """
+        Runs the event loop until all transfers are done.
+        """
+        while self.poll():
+            pass
+        self.close()
+
+    def close(self):
+        """
+        Stops the writer thread, after the pending writes, and removes what
+        discarded transfers have left behind.
+        """
+        if self._writer_thread is not None:
+            self._writer_thread.stop()
+            self._writer_thread = None
+        while self._events:
+            self._events.popleft()()
+
+    def cancel_all(self):
+        for transfer in list(self._pending):
+            transfer.cancel()
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def _add(self, transfer):
+        key = (transfer.host, transfer.port)
+        self._pending.append(transfer)
+        if self._active.get(key, 0) < self.per_host:
+            self._active[key] = self._active.get(key, 0) + 1
+            self._start(transfer)
+        else:
+            self._queued.setdefault(key, deque()).append(transfer)
+        return transfer
+
+    def _start(self, transfer):
+        transfer.last_activity = time.time()
+        key = (transfer.host, transfer.port)
+        address = self._addresses.get(key) or _numeric_address(*key)
+        if address is not None:
+            self._addresses[key] = address
+            transfer._connect(address)
+        elif key in self._resolving:
+            self._resolving[key].append(transfer)
+        else:
+            self._resolving[key] = [transfer]
+            thread = threading.Thread(target=self._resolve, args=(key,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _resolve(self, key):
+        # on a helper thread, as getaddrinfo blocks
+        try:
+            family, _, _, _, address = socket.getaddrinfo(key[0], key[1], 0,
+                    socket.SOCK_STREAM)[0]
+            result = family, address
+        except socket.error, e:
+            result = e
+        self._events.append(partial(self._resolved, key, result))
+
+    def _resolved(self, key, result):
+        if not isinstance(result, Exception):
+            self._addresses[key] = result
+        for transfer in self._resolving.pop(key, ()):
+            if transfer.done:
+                continue
+            if isinstance(result, Exception):
+                transfer._fail(FetchError("Cannot resolve %s: %s"
+                    % (key[0], str(result))))
+            else:
+                transfer._connect(result)
+
+    def _writer(self):
+        if self._writer_thread is None:
+            self._writer_thread = _Writer(self._events)
+        return self._writer_thread
+
+    def _finished(self, transfer):
+        self._pending.remove(transfer)
+        key = (transfer.host, transfer.port)
+        queue = self._queued.get(key)
+        if queue is not None and transfer in queue:
+            # cancelled before it was started
+            queue.remove(transfer)
+            return
+        if queue:
+            self._start(queue.popleft())
+        else:
+            self._active[key] -= 1
+
+
+def _numeric_address(host, port):
+    """
+    :return: ``(family, address)`` if `host` is an IP address, None if it
+        has to be resolved
+    """
+    try:
+        family, _, _, _, address = socket.getaddrinfo(host, port, 0,
+                socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)[0]
+    except socket.error:
+        return None
+    return family, address
@@ -0,0 +1,193 @@
+"""
+On-disk cache for application descriptors.
+
+Entries are keyed by the descriptor URL and store the validators (``ETag``,
+``Last-Modified``) the server sent, so that stale entries can be revalidated
+with a conditional request instead of downloading the descriptor again.
+Entries younger than `ttl` seconds are used without asking the server.
+
+The total size of the cache directory is bounded by `max_size` bytes, the
+least recently used entries are evicted first. Entry files are replaced
+atomically, so several processes can share a cache directory.
+"""
+from __future__ import with_statement
+
+import os, time, errno, hashlib, tempfile, threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DEFAULT_TTL = 5 * 60
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+
+ENTRY_SUFFIX = '.entry'
+
+
+class CacheEntry(object):
+    def __init__(self, url, body, etag=None, last_modified=None,
+            fetched=None):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched if fetched is not None else time.time()
+
+
+class DescriptorCache(object):
+    """
+    Usage::
+
+        cache = DescriptorCache('/var/cache/plugit/descriptors')
+        fetch.fetch_descriptor(base_url, 'foo', cache=cache)
+        print cache.stats()
+    """
+    def __init__(self, directory, ttl=DEFAULT_TTL,
+            max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def lookup(self, url):
+        """
+        :return: the `CacheEntry` for `url` or None if there is none.
+        """
+        try:
+            with open(self._path(url), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (IOError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return CacheEntry(url, body, meta.get('etag'),
+                meta.get('last_modified'), meta.get('fetched'))
+
+    def is_fresh(self, entry):
+        return time.time() - entry.fetched < self.ttl
+
+    def conditional_headers(self, entry):
+        """
+        :return: request headers that revalidate `entry` (which may be None).
+        """
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def hit(self, entry):
+        """
+        Records a use of a fresh `entry`.
+
+        :return: the cached body.
+        """
+        self._count('hits')
+        self._touch(entry.url)
+        return entry.body
+
+    def revalidated(self, entry, headers):
+        """
+        Records that the server confirmed `entry` to be unchanged (responded
+        with 304 Not Modified) and restarts its time to live.
+
+        :return: the cached body.
+        """
+        self._count('revalidations')
+        entry.fetched = time.time()
+        entry.etag = headers.get('etag', entry.etag)
+        entry.last_modified = headers.get('last-modified',
+                entry.last_modified)
+        self._write(entry)
+        return entry.body
+
+    def store(self, url, body, headers):
+        """
+        Records a full download of `url` and stores it, unless the response
+        carries no validators and `ttl` is zero.
+        """
+        self._count('misses')
+        entry = CacheEntry(url, body, headers.get('etag'),
+                headers.get('last-modified'))
+        if not (entry.etag or entry.last_modified or self.ttl):
+            return
+        self._write(entry)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in
+        `max_size` bytes.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_SUFFIX):
+                os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'revalidations': self.revalidations}
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _touch(self, url):
+        try:
+            os.utime(self._path(url), None)
+        except OSError:
+            pass
+
+    def _write(self, entry):
+        meta = json.dumps({'url': entry.url, 'etag': entry.etag,
+            'last_modified': entry.last_modified, 'fetched': entry.fetched})
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(meta + '\n')
+                f.write(entry.body)
+            os.rename(tmp_path, self._path(entry.url))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                hashlib.sha1(url).hexdigest() + ENTRY_SUFFIX)
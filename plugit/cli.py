@@ -0,0 +1,312 @@
+"""
+The ``plugit`` command line interface::
+
+    python -m plugit <command> [options] [arguments]
+
+Commands:
+
+``fetch URL``
+    downloads a package (``--digest`` checks it) into ``--output``
+``verify FILE DIGEST``
+    checks a package against an ``algo:hexdigest`` digest
+``unpack FILE``
+    unpacks a package next to it
+``check-deps NAME [VERSION_DEPS]``
+    checks that an application is installed in a compatible version
+``update-settings FILE``
+    sets (``--set NAME=VALUE``) or appends to (``--append NAME=VALUE``)
+    settings, values are Python literals
+``verify-files DIR MANIFEST``
+    checks the files below a directory against a manifest (see `manifest`),
+    ``--state`` keeps the verified state for ``--quick`` runs that only hash
+    changed files
+``install BASE_URL NAME[:VERSION_DEPS]...``
+    resolves, fetches and installs applications and their dependencies into
+    ``--target``, choosing among the versions that the latest descriptor of
+    each application lists in its ``versions`` field (only the latest
+    version if it has none)
+``uninstall NAME... --registry FILE``
+    removes applications that ``install`` recorded in the registry, unless
+    other recorded applications depend on them (``--force``)
+
+The command functions import the modules they need themselves, so that a
+command only loads its own subsystems: ``check-deps`` does not load the
+networking modules or the lib2to3 grammar. Keep it that way, the commands
+are run from hook scripts where start-up time matters.
+"""
+import os, sys, optparse
+
+from plugit.exceptions import PlugitError
+
+USAGE = '%prog <command> [options] [arguments]\n\ncommands: ' \
+        'fetch, verify, unpack, check-deps, update-settings, ' \
+        'verify-files, install, uninstall'
+
+
+class UsageError(PlugitError):
+    pass
+
+
+def main(argv=None, prog='plugit'):
+    """
+    Runs the command given in `argv` (``sys.argv[1:]`` by default).
+
+    :return: the exit status
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ('-h', '--help'):
+        print optparse.OptionParser(usage=USAGE, prog=prog).get_usage()
+        return 0 if argv else 2
+    name, args = argv[0], argv[1:]
+    command = COMMANDS.get(name)
+    if command is None:
+        sys.stderr.write("%s: unknown command '%s'\n" % (prog, name))
+        return 2
+    parser = optparse.OptionParser(prog='%s %s' % (prog, name),
+            usage='%%prog %s' % command.usage)
+    for option in command.options:
+        parser.add_option(*option[0], **option[1])
+    options, args = parser.parse_args(args)
+    try:
+        return command(options, args) or 0
+    except UsageError, e:
+        parser.error(str(e))
+    except (PlugitError, EnvironmentError), e:
+        sys.stderr.write('%s: %s\n' % (prog, e))
+        return 1
+
+
+def command(usage, *options):
+    """
+    Declares a command function with its usage line and its options as
+    ``((flags...), {keyword arguments})`` pairs for
+    `optparse.OptionParser.add_option`.
+    """
+    def decorate(func):
+        func.usage = usage
+        func.options = options
+        return func
+    return decorate
+
+
+@command('URL [--digest DIGEST] [--output DIR]',
+        (('-d', '--digest'), {'help': 'expected digest (algo:hexdigest)'}),
+        (('-o', '--output'), {'default': os.curdir,
+            'help': 'directory to save the package to'}))
+def fetch_command(options, args):
+    import shutil
+    from plugit import fetch
+    from plugit.exceptions import PackageError
+    url = _single(args, 'URL')
+    if options.digest:
+        filename, verifier = fetch.fetch_package(url, options.digest)
+    else:
+        filename, verifier = fetch.fetch_package(url), None
+    try:
+        if verifier is not None and not verifier.is_valid():
+            raise PackageError("Digest mismatch in %s: expected %s."
+                    % (url, options.digest))
+        target = os.path.join(options.output, os.path.basename(filename))
+        shutil.move(filename, target)
+    finally:
+        shutil.rmtree(os.path.dirname(filename))
+    print target
+
+
+@command('FILE DIGEST')
+def verify_command(options, args):
+    from plugit import package
+    if len(args) != 2:
+        raise UsageError("FILE and DIGEST are required.")
+    if not package.is_valid(args[1], args[0]):
+        sys.stderr.write('%s: digest mismatch\n' % args[0])
+        return 1
+    print '%s: OK' % args[0]
+
+
+@command('FILE')
+def unpack_command(options, args):
+    from plugit import package
+    print package.unpack(_single(args, 'FILE'))
+
+
+@command('NAME [VERSION_DEPS] [--path DIR]...',
+        (('-p', '--path'), {'action': 'append', 'default': [],
+            'help': 'additional directory to look in, can be repeated'}))
+def check_deps_command(options, args):
+    from plugit import deps
+    if not 1 <= len(args) <= 2:
+        raise UsageError("NAME and optional VERSION_DEPS are required.")
+    name = args[0]
+    ver_deps = len(args) > 1 and args[1] or None
+    if not deps.is_installed(name, ver_deps, options.path):
+        sys.stderr.write('%s is not installed\n' % name)
+        return 1
+    installed = ver_deps and deps.installed_version(name, options.path)
+    print '%s %s' % (name, installed or 'is installed')
+
+
+@command('FILE [--set NAME=VALUE]... [--append NAME=VALUE]... [--create]',
+        (('-s', '--set'), {'action': 'append', 'default': [],
+            'metavar': 'NAME=VALUE', 'help': 'add a new setting'}),
+        (('-a', '--append'), {'action': 'append', 'default': [],
+            'metavar': 'NAME=VALUE',
+            'help': 'append to a list or dict setting'}),
+        (('-c', '--create'), {'action': 'store_true',
+            'help': 'create missing settings given with --append'}),
+        (('-f', '--fast'), {'action': 'store_true',
+            'help': 'parse only the statements that are edited'}))
+def update_settings_command(options, args):
+    import tokenize
+    from lib2to3.pgen2 import parse, tokenize as lib2to3_tokenize
+    from plugit.exceptions import SettingsError
+    from plugit.settingshandler import SettingsFileUpdater
+    filename = _single(args, 'FILE')
+    new_settings = _assignments(options.set)
+    append_settings = _assignments(options.append)
+    if not new_settings and not append_settings:
+        raise UsageError("Give at least one --set or --append.")
+    try:
+        updater = SettingsFileUpdater(filename, fast=options.fast)
+        updater.update(new_settings, append_settings, options.create)
+    except (parse.ParseError, tokenize.TokenError,
+            lib2to3_tokenize.TokenError), e:
+        raise SettingsError("Cannot parse %s: %s" % (filename, str(e)))
+    if updater.save(compare=True):
+        print '%s updated' % filename
+    else:
+        print '%s unchanged' % filename
+
+
+@command('DIR MANIFEST [--state FILE [--quick]] [--algorithm ALGO]...',
+        (('-s', '--state'), {'help': 'file to keep the verified state in'}),
+        (('-q', '--quick'), {'action': 'store_true',
+            'help': 'hash only the files changed since the last run'}),
+        (('-a', '--algorithm'), {'action': 'append', 'default': [],
+            'help': 'also compute and print this digest, can be repeated'}))
+def verify_files_command(options, args):
+    from plugit import manifest
+    if len(args) != 2:
+        raise UsageError("DIR and MANIFEST are required.")
+    if options.quick and not options.state:
+        raise UsageError("--quick requires --state.")
+    directory, expected = args[0], manifest.Manifest.load(args[1])
+    state = None
+    if options.state:
+        state = manifest.VerifyState.load(options.state)
+    report = manifest.verify(directory, expected, state, options.quick,
+            options.algorithm)
+    if state is not None:
+        state.save(options.state)
+    for algo in options.algorithm:
+        for path, digests in sorted(report.digests.items()):
+            print '%s  %s' % (digests[algo], path)
+    for path in report.missing:
+        sys.stderr.write('%s: missing\n' % path)
+    for path in report.mismatched:
+        sys.stderr.write('%s: digest mismatch\n' % path)
+    print '%d files checked, %d hashed, %d unchanged' % (len(expected),
+            report.hashed, report.skipped)
+    return not report.is_valid and 1 or 0
+
+
+@command('BASE_URL NAME[:VERSION_DEPS]... --target DIR [--registry FILE]',
+        (('-t', '--target'), {'help': 'directory to install to'}),
+        (('-r', '--registry'), {'help': 'registry database to record the '
+            'installed applications in'}))
+def install_command(options, args):
+    from plugit import connection
+    from plugit.install import InstallEngine
+    from plugit.resolver import Resolver, DescriptorSource
+    if len(args) < 2:
+        raise UsageError("BASE_URL and at least one NAME are required.")
+    if not options.target:
+        raise UsageError("--target is required.")
+    base_url, roots = args[0], dict(_requirement(arg) for arg in args[1:])
+    source = DescriptorSource(base_url, pool=connection.default_pool())
+    plan = Resolver(source).resolve(roots).plan
+
+    registry = None
+    if options.registry:
+        from plugit.registry import Registry
+        registry = Registry(options.registry)
+    report = InstallEngine(_installer(options.target),
+            registry=registry).install(plan)
+    for installed in report.installed:
+        print 'installed %s %s' % (installed.name, installed.version)
+    for name, error in sorted(report.failed.items()):
+        sys.stderr.write('failed %s: %s\n' % (name, error))
+    return report.failed and 1 or 0
+
+
+@command('NAME... --registry FILE [--force]',
+        (('-r', '--registry'), {'help': 'registry database the '
+            'applications were recorded in'}),
+        (('-f', '--force'), {'action': 'store_true',
+            'help': 'remove applications that others depend on'}))
+def uninstall_command(options, args):
+    from plugit.install import uninstall
+    from plugit.registry import Registry
+    if not args:
+        raise UsageError("At least one NAME is required.")
+    if not options.registry:
+        raise UsageError("--registry is required.")
+    registry = Registry(options.registry)
+    for name in args:
+        removed = uninstall(registry, name, options.force)
+        print 'uninstalled %s (%d files)' % (name, removed)
+
+
+COMMANDS = {
+    'fetch': fetch_command,
+    'verify': verify_command,
+    'unpack': unpack_command,
+    'check-deps': check_deps_command,
+    'update-settings': update_settings_command,
+    'verify-files': verify_files_command,
+    'install': install_command,
+    'uninstall': uninstall_command,
+}
+
+
+def _single(args, name):
+    if len(args) != 1:
+        raise UsageError("%s is required." % name)
+    return args[0]
+
+def _assignments(pairs):
+    import ast
+    result = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise UsageError("Expected NAME=VALUE, got '%s'." % pair)
+        name, value = pair.split('=', 1)
+        try:
+            result[name.strip()] = ast.literal_eval(value)
+        except (SyntaxError, ValueError):
+            # not a Python literal, take it as a string
+            result[name.strip()] = value
+    return result
+
+def _requirement(arg):
+    name, _, ver_deps = arg.partition(':')
+    return name, ver_deps
+
+def _installer(target):
+    import shutil
+
+    def activate(job):
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for entry in os.listdir(job.package_dir):
+            source = os.path.join(job.package_dir, entry)
+            destination = os.path.join(target, entry)
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            if os.path.isdir(source):
+                shutil.copytree(source, destination)
+            else:
+                shutil.copy2(source, destination)
+        return target
+    return activate
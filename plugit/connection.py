@@ -0,0 +1,187 @@
+"""
+Persistent HTTP connections shared between requests to the same host.
+
+`ConnectionPool` keeps idle HTTP/1.1 keep-alive connections per
+``(scheme, host, port)``, so fetching many descriptors from one server costs
+a single TCP (and TLS) handshake per worker rather than one per request.
+Pools are thread-safe.
+"""
+from __future__ import with_statement
+
+import socket, httplib, urlparse, threading
+from contextlib import contextmanager
+
+DEFAULT_TIMEOUT = 30
+
+# exceptions that indicate the server has dropped an idle connection
+_STALE_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+        httplib.ResponseNotReady, socket.error)
+
+
+class Response(object):
+    """
+    A fully read HTTP response. Header names are lowercased.
+    """
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class ConnectionPool(object):
+    """
+    Hands out keep-alive connections, at most `max_idle` idle connections
+    are retained per host.
+    """
+    def __init__(self, max_idle=8, timeout=DEFAULT_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, url):
+        """
+        Checks out a connection to the host in `url`. The caller has to read
+        the response fully before the block ends, otherwise the connection
+        cannot be reused. On error the connection is closed.
+        """
+        key = _host_key(url)
+        conn = self._checkout(key)
+        try:
+            yield conn
+        except:
+            conn.close()
+            raise
+        self._checkin(key, conn)
+
+    def request(self, url, headers=None, method='GET'):
+        """
+        Performs a request and reads the response fully. A reused connection
+        that turns out to have been closed by the server is retried once on a
+        fresh connection.
+
+        :return: a `Response` object.
+        """
+        headers = dict(headers or {})
+        for attempt in (0, 1):
+            with self.connection(url) as conn:
+                reused = conn.sock is not None
+                try:
+                    conn.request(method, request_path(url), headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except _STALE_ERRORS:
+                    if not reused or attempt:
+                        raise
+                    conn.close()
+                    continue
+                return Response(response.status, response.reason,
+                        dict(response.getheaders()), body)
+
+    @contextmanager
+    def open(self, url, headers=None):
+        """
+        Performs a GET request and yields the `httplib.HTTPResponse`, so
+        that the block can read a large body in chunks instead of holding it
+        in memory. The block has to read the body fully, otherwise the
+        connection cannot be reused. Stale connections are retried like in
+        `request`.
+        """
+        headers = dict(headers or {})
+        for attempt in (0, 1):
+            with self.connection(url) as conn:
+                reused = conn.sock is not None
+                try:
+                    conn.request('GET', request_path(url), headers=headers)
+                    response = conn.getresponse()
+                except _STALE_ERRORS:
+                    if not reused or attempt:
+                        raise
+                    conn.close()
+                    continue
+                yield response
+                return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _checkout(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        scheme, host, port = key
+        conn_class = (_CountingHTTPSConnection if scheme == 'https'
+                else _CountingHTTPConnection)
+        return conn_class(self, host, port, timeout=self.timeout)
+
+    def _checkin(self, key, conn):
+        if conn.sock is None:
+            # closed by the server (Connection: close) or after an error
+            return
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _connection_opened(self):
+        with self._lock:
+            self.connections_opened += 1
+
+
+class _CountingHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, pool, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.pool._connection_opened()
+
+
+class _CountingHTTPSConnection(httplib.HTTPSConnection):
+    def __init__(self, pool, *args, **kwargs):
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.pool._connection_opened()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    """
+    Returns the process-wide pool that is used when no pool is given
+    explicitly.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+def request_path(url):
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    return path
+
+def _host_key(url):
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme not in ('http', 'https'):
+        raise ValueError("Unsupported URL scheme in %s" % url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    return parsed.scheme, parsed.hostname, port
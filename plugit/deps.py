@@ -1,20 +1,106 @@
-import re, sys, operator
+from __future__ import with_statement
+
+import os, sys, ast, bisect
 
 from plugit import version
+from plugit.lru import LRUCache
 from plugit.exceptions import VersionError
+from plugit.specifier import (CMP_OP_MAP, DEP_SPLIT_RE, VER_DEP_RE,
+        SpecifierSet, compile_spec)
+
+# all final (non-subrelease) versions sort at or above this key
+_FIRST_FINAL_KEY = (True,)
+
+# VERSION declarations read by installed_version, keyed by file
+VERSION_CACHE_SIZE = 4096
+_version_cache = LRUCache(VERSION_CACHE_SIZE)
 
-CMP_OP_MAP = {
-    '<':  operator.lt,
-    '<=': operator.le,
-    '==': operator.eq,
-    '!=': operator.ne,
-    '>=': operator.ge,
-    '>':  operator.gt,
+_VERSION_CONSTANTS = {
+    'PRE_ALPHA':  version.PRE_ALPHA,
+    'ALPHA':      version.ALPHA,
+    'BETA':       version.BETA,
+    'PRERELEASE': version.PRERELEASE,
+    'FINAL':      version.FINAL,
 }
 
-# ",?\s*(?=%s)" % "|".join(CMP_OP_MAP.keys())
-DEP_SPLIT_RE = re.compile(r',?\s*(?=<|<=|!=|==|>=|>)')
-VER_DEP_RE = re.compile(r'(?P<cmp><|<=|!=|==|>=|>)\s*(?P<ver>[-a-z0-9. ]+)')
+class VersionIndex(object):
+    """
+    A sorted index of the published versions of an application, built once
+    and queried many times during dependency resolution. Queries take a
+    dependency specification (a string or a `specifier.SpecifierSet`) and
+    cost a binary search per interval of the specification.
+
+    The index follows `version.Version` ordering, so subreleases rank below
+    all releases:
+
+    >>> index = VersionIndex(['1.0', '1.1', '2.0 beta 1', '1.2 alpha 2'])
+    >>> str(index.best())
+    '1.1'
+    >>> str(index.best('< 1.0'))
+    '2.0 beta 1'
+    >>> index.latest_final('< 1.0') is None
+    True
+    >>> [str(v) for v in index.in_range('<= 1.0')]
+    ['1.2 alpha 2', '2.0 beta 1', '1.0']
+    """
+    def __init__(self, versions):
+        versions = set(version.to_version(v) for v in versions)
+        self.versions = sorted(versions, key=lambda v: v.sort_key)
+        self._keys = [v.sort_key for v in self.versions]
+        self._first_final = bisect.bisect_left(self._keys, _FIRST_FINAL_KEY)
+
+    def best(self, spec=None, final_only=False):
+        """
+        :return: the highest version satisfying `spec`, or None.
+        """
+        for start, end in reversed(self._spans(spec, final_only)):
+            if end > start:
+                return self.versions[end - 1]
+        return None
+
+    def latest_final(self, spec=None):
+        """
+        :return: the highest final (non-subrelease) version satisfying
+            `spec`, or None.
+        """
+        return self.best(spec, final_only=True)
+
+    def in_range(self, spec=None, final_only=False):
+        """
+        :return: a sorted list of all versions satisfying `spec`.
+        """
+        result = []
+        for start, end in self._spans(spec, final_only):
+            result.extend(self.versions[start:end])
+        return result
+
+    def _spans(self, spec, final_only):
+        keys = self._keys
+        lowest = self._first_final if final_only else 0
+        spans = []
+        for interval in _compile(spec).intervals:
+            low, low_inclusive, high, high_inclusive = interval
+            if low is None:
+                start = 0
+            elif low_inclusive:
+                start = bisect.bisect_left(keys, low)
+            else:
+                start = bisect.bisect_right(keys, low)
+            if high is None:
+                end = len(keys)
+            elif high_inclusive:
+                end = bisect.bisect_right(keys, high)
+            else:
+                end = bisect.bisect_left(keys, high)
+            spans.append((max(start, lowest), end))
+        return spans
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __iter__(self):
+        return iter(self.versions)
+
 
 def _parse(ver_deps):
     chunks = DEP_SPLIT_RE.split(ver_deps)
@@ -23,42 +109,175 @@ def _parse(ver_deps):
         ret.append(VER_DEP_RE.match(chunk).groupdict())
     return ret
 
-def is_installed(appname, ver_deps=None, additional_paths=None):
-    if additional_paths:
-        for path in additional_paths:
-            sys.path.insert(0, path)
-    try:
-        __import__(appname)
-        app = sys.modules[appname]
-    except ImportError:
-        return False
+def is_installed(appname, ver_deps=None, additional_paths=None,
+        static=True):
+    """
+    Checks whether application `appname` is installed (in `additional_paths`
+    or on ``sys.path``) and satisfies `ver_deps`.
 
-    if not ver_deps:
-        return True
+    By default the application is not imported: its ``VERSION`` declaration
+    is read statically (see `installed_version`), so no application code is
+    run and neither ``sys.modules`` nor ``sys.path`` change. With `static`
+    set to False the application is imported to read ``VERSION``.
 
-    for ver in _parse(ver_deps):
-        if CMP_OP_MAP[ver['cmp']](app.VERSION,
-                version.from_string(ver['ver'])):
+    :raise VersionError: if the installed version does not satisfy
+        `ver_deps` or cannot be determined
+    """
+    if static:
+        app_file = find_app(appname, additional_paths)
+        if app_file is None:
+            return False
+        if not ver_deps:
+            return True
+        app_version = _file_version(app_file)
+    else:
+        app = _import_app(appname, additional_paths)
+        if app is None:
+            return False
+        if not ver_deps:
             return True
+        app_version = app.VERSION
+
+    if compile_spec(ver_deps).contains(app_version):
+        return True
 
     raise VersionError("Application %s installed version %s does not "
             "satisfy the version dependencies %s."
-            % (appname, str(app.VERSION), str(ver_deps)))
+            % (appname, str(app_version), str(ver_deps)))
+
+def find_app(appname, additional_paths=None):
+    """
+    Finds the package or module `appname` in `additional_paths` and on
+    ``sys.path`` without importing it.
+
+    :return: the path of the package ``__init__.py`` or the module file, or
+        None if it is not found.
+    """
+    relpath = appname.replace('.', os.sep)
+    for path in list(additional_paths or ()) + sys.path:
+        base = os.path.join(path or os.curdir, relpath)
+        for candidate in (os.path.join(base, '__init__.py'), base + '.py'):
+            if os.path.isfile(candidate):
+                return candidate
+    return None
+
+def installed_version(appname, additional_paths=None):
+    """
+    Reads the ``VERSION = version.Version(...)`` (or
+    ``VERSION = version.from_string('...')``) declaration of an installed
+    application from its source without importing it. Results are cached
+    per file and invalidated when the file changes.
+
+    :return: a `version.Version` object or None if the application is not
+        found.
+    :raise VersionError: if the version cannot be determined statically
+    """
+    app_file = find_app(appname, additional_paths)
+    if app_file is None:
+        return None
+    return _file_version(app_file)
+
+def _file_version(app_file):
+    st = os.stat(app_file)
+    cached = _version_cache.get(app_file)
+    if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+        return cached[1]
+    with open(app_file, 'rU') as f:
+        source = f.read()
+    app_version = _read_version(source, app_file)
+    _version_cache.put(app_file, ((st.st_mtime, st.st_size), app_version))
+    return app_version
+
+def _read_version(source, filename):
+    try:
+        tree = ast.parse(source, filename)
+    except SyntaxError, e:
+        raise VersionError("Cannot read version from %s: %s"
+                % (filename, str(e)))
+    app_version = None
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and
+                any(isinstance(target, ast.Name) and target.id == 'VERSION'
+                    for target in node.targets)):
+            app_version = _eval_version(node.value, filename)
+    if app_version is None:
+        raise VersionError("No static VERSION declaration in %s." % filename)
+    return app_version
+
+def _eval_version(node, filename):
+    if not isinstance(node, ast.Call):
+        raise VersionError("VERSION in %s is not a version.Version() or "
+                "version.from_string() call." % filename)
+    func = _name_of(node.func)
+    args = [_eval_arg(arg, filename) for arg in node.args]
+    kwargs = dict((str(keyword.arg), _eval_arg(keyword.value, filename))
+            for keyword in node.keywords)
+    if node.starargs or node.kwargs:
+        raise VersionError("Cannot read version from %s statically."
+                % filename)
+    if func == 'Version':
+        return version.Version(*args, **kwargs)
+    if func == 'from_string':
+        return version.from_string(*args, **kwargs)
+    raise VersionError("VERSION in %s is not a version.Version() or "
+            "version.from_string() call." % filename)
+
+def _eval_arg(node, filename):
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Str):
+        return node.s
+    name = _name_of(node)
+    if name == 'None':
+        return None
+    if name in _VERSION_CONSTANTS:
+        return _VERSION_CONSTANTS[name]
+    raise VersionError("Cannot read version from %s statically." % filename)
+
+def _name_of(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+def _import_app(appname, additional_paths):
+    saved_path = sys.path[:]
+    sys.path[:0] = list(additional_paths or ())
+    try:
+        __import__(appname)
+        return sys.modules[appname]
+    except ImportError:
+        return None
+    finally:
+        sys.path[:] = saved_path
 
 def python_version_supported(python_versions):
     # or platform.python_version_tuple()?
-    python_version = version.Version(sys.version_info[:3])
-    for ver in _parse(python_versions):
-        if CMP_OP_MAP[ver['cmp']](python_version,
-                version.from_string(ver['ver'])):
-            return True
-    return False
+    python_version = version.Version(*sys.version_info[:3])
+    return compile_spec(python_versions).contains(python_version)
 
 def platform_supported(platforms):
     if sys.platform in platforms:
         return True
     return False
 
-def best_version(versions):
-    """Not implemented."""
-    return None
+def best_version(versions, ver_deps=None, final_only=False):
+    """
+    Picks the highest version that satisfies `ver_deps`.
+
+    :param versions: a `VersionIndex` (preferably, when the same versions are
+        queried repeatedly) or an iterable of `version.Version` objects or
+        version strings
+    :param final_only: consider only final (non-subrelease) versions
+    :return: a `version.Version` object or None if no version satisfies
+        `ver_deps`.
+    """
+    if not isinstance(versions, VersionIndex):
+        versions = VersionIndex(versions)
+    return versions.best(ver_deps, final_only)
+
+def _compile(spec):
+    if isinstance(spec, SpecifierSet):
+        return spec
+    return compile_spec(spec or '')
@@ -0,0 +1,244 @@
+"""
+Resumable and segmented HTTP downloads for large packages.
+
+When the server advertises ``Accept-Ranges: bytes``, the file is
+preallocated and fetched with ``Range`` requests, optionally split into
+several segments that are downloaded concurrently and written straight to
+their offsets. Progress is recorded in a sidecar state file next to the
+target, so an interrupted transfer continues where it stopped, both when a
+connection drops mid-transfer and when the download is started again later.
+
+Servers without range support, and resources whose ``HEAD`` request does
+not succeed, are downloaded in a single stream.
+"""
+from __future__ import with_statement
+
+import os, socket, httplib, threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from plugit import connection, package, workers
+from plugit.exceptions import FetchError
+
+STATE_SUFFIX = '.state'
+DEFAULT_RETRIES = 3
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# how often the sidecar state is written during a transfer
+STATE_SAVE_INTERVAL = 1024 * 1024
+
+_TRANSFER_ERRORS = (socket.error, httplib.HTTPException)
+
+
+class _RestartDownload(Exception):
+    """
+    The server did not honour a range request (e.g. the file changed), the
+    download has to start from scratch.
+    """
+
+
+class _ResourceInfo(object):
+    def __init__(self, headers):
+        self.etag = headers.get('etag')
+        self.last_modified = headers.get('last-modified')
+        self.accepts_ranges = headers.get('accept-ranges') == 'bytes'
+        try:
+            self.size = int(headers['content-length'])
+        except (KeyError, ValueError):
+            self.size = None
+
+
+class _Segment(object):
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        # inclusive, as in Range headers
+        self.end = end
+        self.pos = start if pos is None else pos
+
+    @property
+    def done(self):
+        return self.pos > self.end
+
+
+class _State(object):
+    """
+    Download progress that is persisted in the sidecar state file.
+    """
+    def __init__(self, path, url, info, segments):
+        self.path = path
+        self.url = url
+        self.info = info
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+    def matches(self, url, info):
+        return (self.url == url and self.info.size == info.size and
+                self.info.etag == info.etag and
+                self.info.last_modified == info.last_modified)
+
+    def advance(self, segment, nbytes):
+        with self.lock:
+            segment.pos += nbytes
+            self.unsaved += nbytes
+            if self.unsaved < STATE_SAVE_INTERVAL:
+                return
+        self.save()
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'url': self.url, 'size': self.info.size,
+                'etag': self.info.etag,
+                'last_modified': self.info.last_modified,
+                'segments': [(s.start, s.end, s.pos)
+                    for s in self.segments]})
+            self.unsaved = 0
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+
+    def remove(self):
+        _remove(self.path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+            info = _ResourceInfo({})
+            info.size = data['size']
+            info.etag = data['etag']
+            info.last_modified = data['last_modified']
+            segments = [_Segment(*s) for s in data['segments']]
+            return cls(path, data['url'], info, segments)
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+
+def download(url, filename, verifier=None, segments=1, pool=None,
+        retries=DEFAULT_RETRIES, min_segment_size=MIN_SEGMENT_SIZE):
+    """
+    Downloads `url` to `filename`, resuming a previous partial download of
+    the same resource if its state file exists.
+
+    :param verifier: an optional `package.DigestVerifier` that is fed the
+        whole contents of the file
+    :param segments: the maximum number of concurrent range requests, files
+        are not split into segments smaller than `min_segment_size`
+    :param retries: how many times a dropped transfer is resumed before
+        giving up, the state file is kept for a later attempt then
+    """
+    if pool is None:
+        pool = connection.default_pool()
+    try:
+        head = pool.request(url, method='HEAD')
+    except _TRANSFER_ERRORS, e:
+        raise FetchError("Error in fetching %s: %s" % (url, str(e)))
+
+    state_path = filename + STATE_SUFFIX
+    # the headers of an error response say nothing about the resource, the
+    # streamed download reports the error
+    info = _ResourceInfo(head.headers if head.status == 200 else {})
+    if info.accepts_ranges and info.size:
+        try:
+            _download_ranges(url, filename, state_path, info, verifier,
+                    segments, pool, retries, min_segment_size)
+            return
+        except _RestartDownload:
+            if verifier is not None:
+                verifier.reset()
+    _remove(state_path)
+    _download_stream(url, filename, verifier, pool)
+
+def _download_ranges(url, filename, state_path, info, verifier, segments,
+        pool, retries, min_segment_size):
+    state = _State.load(state_path)
+    if (state is None or not state.matches(url, info) or
+            not os.path.exists(filename)):
+        count = max(1, min(segments, info.size // min_segment_size))
+        bounds = [info.size * i // count for i in xrange(count + 1)]
+        state = _State(state_path, url, info, [_Segment(bounds[i],
+            bounds[i + 1] - 1) for i in xrange(count)])
+        with open(filename, 'wb') as f:
+            f.truncate(info.size)
+        state.save()
+
+    stream_verifier = None
+    if verifier is not None and len(state.segments) == 1:
+        # hash the part that is already on disk, the rest as it arrives
+        verifier.update_from_file(filename, state.segments[0].pos)
+        stream_verifier = verifier
+
+    def fetch(segment):
+        for attempt in xrange(retries + 1):
+            try:
+                _fetch_segment(url, filename, segment, state, stream_verifier,
+                        pool)
+                return
+            except _TRANSFER_ERRORS, e:
+                if attempt == retries:
+                    raise FetchError("Error in fetching %s: %s" %
+                            (url, str(e)))
+
+    try:
+        workers.thread_map(fetch, [s for s in state.segments if not s.done],
+                len(state.segments))
+    except FetchError:
+        state.save()
+        raise
+    state.remove()
+    if verifier is not None and stream_verifier is None:
+        verifier.update_from_file(filename)
+
+def _fetch_segment(url, filename, segment, state, verifier, pool):
+    headers = {'Range': 'bytes=%d-%d' % (segment.pos, segment.end)}
+    if state.info.etag or state.info.last_modified:
+        headers['If-Range'] = state.info.etag or state.info.last_modified
+    with pool.connection(url) as conn:
+        conn.request('GET', connection.request_path(url), headers=headers)
+        response = conn.getresponse()
+        content_range = response.getheader('content-range', '')
+        if (response.status != 206 or not content_range.startswith(
+                'bytes %d-' % segment.pos)):
+            raise _RestartDownload()
+        with open(filename, 'r+b') as f:
+            f.seek(segment.pos)
+            while not segment.done:
+                chunk = response.read(min(package.CHUNK_SIZE,
+                    segment.end - segment.pos + 1))
+                if not chunk:
+                    raise httplib.IncompleteRead('')
+                f.write(chunk)
+                if verifier is not None:
+                    verifier.update(chunk)
+                state.advance(segment, len(chunk))
+
+def _download_stream(url, filename, verifier, pool):
+    try:
+        with pool.connection(url) as conn:
+            conn.request('GET', connection.request_path(url))
+            response = conn.getresponse()
+            if response.status != 200:
+                raise FetchError("Error in fetching %s: HTTP %s %s" %
+                        (url, response.status, response.reason))
+            with open(filename, 'wb') as f:
+                while True:
+                    chunk = response.read(package.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if verifier is not None:
+                        verifier.update(chunk)
+    except _TRANSFER_ERRORS, e:
+        raise FetchError("Error in fetching %s: %s" % (url, str(e)))
+
+def is_http(url):
+    return url.split(':', 1)[0].lower() in ('http', 'https')
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
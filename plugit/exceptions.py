@@ -9,3 +9,12 @@ class VersionError(PlugitError):
 
 class FetchError(PlugitError):
     pass
+
+class PackageError(PlugitError):
+    pass
+
+class ResolutionError(PlugitError):
+    pass
+
+class RegistryError(PlugitError):
+    pass
@@ -1,46 +1,255 @@
 from __future__ import with_statement
 
-import urllib, urlparse, tempfile
+import os, shutil, urllib, urlparse, tempfile, posixpath
 from contextlib import closing
 try:
     import json
 except ImportError:
     import simplejson as json
 
-from plugit import app
-from plugit.exceptions import FetchError
+from plugit import app, package, connection, download, instrument, workers
+from plugit.exceptions import FetchError, PackageError
 
-def fetch_descriptor(base_url, appname, appversion=None):
+def fetch_descriptor(base_url, appname, appversion=None, pool=None,
+        cache=None):
     """
     Fetches the application descriptor from `url` and converts it to an
     `app.App` object.
 
+    :param pool: an optional `connection.ConnectionPool` to fetch the
+        descriptor over a persistent connection
+    :param cache: an optional `cache.DescriptorCache`, implies fetching over
+        the default pool if `pool` is not given
     :return: `app.App` object.
     """
+    url = _descriptor_url(base_url, appname, appversion)
+    if pool is None and cache is not None:
+        pool = connection.default_pool()
+    if pool is not None:
+        return _fetch_pooled_descriptor(url, pool, cache)
+    with instrument.span('fetch_descriptor', url=url) as span:
+        try:
+            with closing(urllib.urlopen(url)) as response:
+                body = response.read()
+            span.add('bytes_transferred', len(body))
+            app_dict = json.loads(body)
+        except Exception, e:
+            raise FetchError("Error in fetching application descriptor: %s"
+                    % str(e))
+        return app.App(**app_dict)
+
+def fetch_descriptors(base_url, apps, max_workers=workers.DEFAULT_WORKERS,
+        pool=None, cache=None):
+    """
+    Fetches the descriptors of many applications concurrently on at most
+    `max_workers` threads that share keep-alive connections from `pool`
+    (the default pool if not given) and, optionally, `cache`.
+
+    Failures do not abort the batch: the `FetchError` for a failed
+    application is returned in its place.
+
+    :param apps: an iterable of ``(appname, appversion)`` tuples, `appversion`
+        may be None
+    :return: a list of `app.App` or `FetchError` objects in the order of
+        `apps`.
+    """
+    if pool is None:
+        pool = connection.default_pool()
+
+    def fetch(app_spec):
+        appname, appversion = app_spec
+        try:
+            return _fetch_pooled_descriptor(
+                    _descriptor_url(base_url, appname, appversion), pool,
+                    cache)
+        except FetchError, e:
+            return e
+
+    return workers.thread_map(fetch, apps, max_workers)
+
+def _fetch_pooled_descriptor(url, pool, cache=None):
+    with instrument.span('fetch_descriptor', url=url) as span:
+        try:
+            body, response = _get_descriptor(url, pool, cache, span)
+            descriptor = app.App(**json.loads(body))
+        except Exception, e:
+            raise FetchError("Error in fetching application descriptor: %s"
+                    % str(e))
+        if response is not None and cache is not None:
+            # only descriptors that parse are cached
+            cache.store(url, response.body, response.headers)
+        return descriptor
+
+def _get_descriptor(url, pool, cache, span):
+    """
+    :return: ``(body, response)``, where `response` is the fresh response
+        that the body came from or None if it came from the cache
+    """
+    if cache is None:
+        response = pool.request(url)
+    else:
+        entry = cache.lookup(url)
+        if entry is not None and cache.is_fresh(entry):
+            span.add('cache_hits')
+            return cache.hit(entry), None
+        response = pool.request(url, cache.conditional_headers(entry))
+        if response.status == 304 and entry is not None:
+            span.add('cache_revalidations')
+            return cache.revalidated(entry, response.headers), None
+    span.add('bytes_transferred', len(response.body))
+    if response.status != 200:
+        raise FetchError("HTTP %s %s" % (response.status, response.reason))
+    return response.body, response
+
+def _descriptor_url(base_url, appname, appversion=None):
     url = urlparse.urljoin(base_url, appname)
     if appversion:
         url = _add_query_params(url, version=appversion)
-    try:
-        with closing(urllib.urlopen(url)) as response:
-            app_dict = json.load(response)
-    except Exception, e:
-        raise FetchError("Error in fetching application descriptor: %s" %
-                str(e))
-    return app.App(**app_dict)
+    return url
 
-def fetch_package(url):
+def fetch_package(url, digest=None, store=None, segments=1):
     """
     Fetches the application package from `url`.
 
-    :return: full path to the downloaded package (in a temporary directory).
+    The package is copied to disk in `package.CHUNK_SIZE` blocks. If `digest`
+    (in ``algo:hexdigest`` format) is given, the blocks are hashed as they
+    arrive, so the package does not need to be read again for validation.
+
+    HTTP downloads are resumed with range requests if the connection drops
+    and, if `segments` is larger than one, large packages are fetched in up
+    to `segments` concurrent parts (see `download.download`).
+
+    If a `store.PackageStore` is given (which requires `digest`), a package
+    that is already in the store is not downloaded at all, and a downloaded
+    package is added to the store once its digest has been verified.
+    Interrupted downloads into a store are resumed on the next fetch.
+
+    :return: full path to the downloaded package (in a temporary directory)
+        or, if `digest` is given, a ``(path, verifier)`` tuple where
+        `verifier` is a `package.DigestVerifier`.
     """
+    if store is not None and not digest:
+        raise ValueError("A digest is required for fetching packages "
+                "through a package store.")
+    with instrument.span('fetch_package', url=url) as span:
+        if store is not None:
+            return _fetch_stored_package(url, digest, store, segments, span)
+        verifier = package.DigestVerifier(digest) if digest else None
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, _package_filename(url))
+        try:
+            _download(url, filename, verifier, segments, span)
+        except:
+            shutil.rmtree(tmpdir)
+            raise
+        if verifier:
+            return filename, verifier
+        return filename
+
+def fetch_and_unpack(url, digest=None):
+    """
+    Fetches the application package from `url` and unpacks it.
+
+    Tar packages (plain or compressed) are extracted from the download
+    stream as their entries arrive and hashed on the same pass, so the
+    archive itself is never written to disk. Zip packages need their central
+    directory, so they are downloaded to disk and unpacked with
+    `package.unpack` as before.
+
+    If `digest` is given, the caller has to check the returned verifier
+    before using the unpacked files.
+
+    :return: full path to the unpacked package directory (in a temporary
+        directory that `package.cleanup(None, package_dir)` removes) or, if
+        `digest` is given, a ``(package_dir, verifier)`` tuple.
+    """
+    verifier = package.DigestVerifier(digest) if digest else None
+    tmpdir = tempfile.mkdtemp()
+    package_file = None
+    try:
+        with closing(urllib.urlopen(url)) as response:
+            head = response.read(len(package.ZIP_MAGIC))
+            if head == package.ZIP_MAGIC:
+                package_file = os.path.join(tmpdir, _package_filename(url))
+                with open(package_file, 'wb') as f:
+                    reader = package.HashingReader(response, verifier, head)
+                    _copy_stream(reader, f)
+            else:
+                reader = package.HashingReader(response, verifier, head)
+                package_dir = package.unpack_stream(reader,
+                        os.path.join(tmpdir, package.UNPACK_DIR))
+                reader.drain()
+        if package_file is not None:
+            package_dir = package.unpack(package_file)
+    except PackageError:
+        shutil.rmtree(tmpdir)
+        raise
+    except Exception, e:
+        shutil.rmtree(tmpdir)
+        raise FetchError("Error in fetching application package: %s" %
+                str(e))
+    if verifier:
+        return package_dir, verifier
+    return package_dir
+
+def _fetch_stored_package(url, digest, store, segments, span):
     tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, _package_filename(url))
     try:
-        filename, _ = urllib.urlretrieve(url, tmpdir)
+        if store.checkout(digest, filename):
+            span.add('cache_hits')
+            return filename, package.KnownDigest(digest)
+        verifier = _download_to_store(url, digest, store, segments, span)
+        if not store.checkout(digest, filename):
+            raise FetchError("Package %s disappeared from the package store"
+                    % digest)
+    except:
+        shutil.rmtree(tmpdir)
+        raise
+    return filename, verifier
+
+def _download_to_store(url, digest, store, segments, span):
+    verifier = package.DigestVerifier(digest)
+    with store.partial_file(digest) as temp_path:
+        _download(url, temp_path, verifier, segments, span)
+        if not verifier.is_valid():
+            # the store removes the download state along with it
+            os.remove(temp_path)
+            raise FetchError("Digest mismatch in application package %s: "
+                    "expected %s" % (url, digest))
+        store.commit(digest, temp_path)
+    return verifier
+
+def _download(url, filename, verifier, segments=1, span=None):
+    try:
+        if download.is_http(url):
+            download.download(url, filename, verifier, segments)
+        else:
+            with closing(urllib.urlopen(url)) as response:
+                with open(filename, 'wb') as f:
+                    _copy_stream(response, f, verifier)
+        if span is not None and span.enabled:
+            size = os.path.getsize(filename)
+            span.add('bytes_transferred', size)
+            if verifier:
+                span.add('bytes_hashed', size)
+    except FetchError:
+        raise
     except Exception, e:
         raise FetchError("Error in fetching application package: %s" %
                 str(e))
-    return filename
+
+def _copy_stream(response, f, verifier=None):
+    while True:
+        chunk = response.read(package.CHUNK_SIZE)
+        if not chunk:
+            break
+        if verifier:
+            verifier.update(chunk)
+        f.write(chunk)
+
+def _package_filename(url):
+    return posixpath.basename(urlparse.urlparse(url).path) or 'package'
 
 def _add_query_params(url, **params):
     """
@@ -0,0 +1,384 @@
+"""
+Pipelined installation of many applications.
+
+`InstallEngine` chains the installation steps as concurrent stages that are
+connected by bounded queues:
+
+1. fetch: `fetch.fetch_package` (hashing the package while it downloads),
+   or `fetch.fetch_and_unpack` in streaming mode
+2. verify: check the digest
+3. unpack: `package.unpack` and `package.has_expected_structure`
+4. compile: `package.compile_package`
+5. activate: the caller-supplied activation callback, one application at a
+   time and only after all of its dependencies in the batch have been
+   activated, followed by recording the application in the
+   `registry.Registry` if one is given
+
+Every stage has its own number of worker threads, so packages are being
+downloaded while others are unpacked or compiled, and a batch takes about
+as long as its slowest stage rather than the sum of all stages. The queues
+bound the number of packages between the fetch, verify, unpack and compile
+stages. Compiled packages that wait for the activation of their
+dependencies are not bounded: every one of them stays on disk until it is
+activated, so at worst the whole batch.
+
+`uninstall` removes an application that a registry has recorded, files and
+record.
+"""
+from __future__ import with_statement
+
+import os, sys, time, errno, Queue, threading
+
+from plugit import fetch, manifest, package
+from plugit.exceptions import PackageError
+
+QUEUE_SIZE = 4
+
+# marks the end of the input of a stage
+_DONE = object()
+
+
+class InstallJob(object):
+    """
+    The state of one application while it moves through the pipeline.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.package_file = None
+        self.package_dir = None
+        self.verifier = None
+        self.compile_report = None
+        # the files of the compiled package, with digests, for the registry
+        self.files = None
+        self.error = None
+
+
+class StageStats(object):
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, started, finished):
+        with self._lock:
+            self.items += 1
+            self.busy_time += finished - started
+            if self.started is None or started < self.started:
+                self.started = started
+            if self.finished is None or finished > self.finished:
+                self.finished = finished
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def throughput(self):
+        """
+        Items per second of wall-clock time while the stage was working.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.items / self.elapsed
+
+    def as_dict(self):
+        return {'workers': self.workers, 'items': self.items,
+                'busy_time': self.busy_time, 'elapsed': self.elapsed,
+                'throughput': self.throughput}
+
+
+class InstallReport(object):
+    """
+    :ivar installed: the activated `app.App` objects in activation order
+    :ivar failed: a dictionary that maps names of applications that were not
+        installed to the exceptions that stopped them
+    :ivar stats: a dictionary that maps stage names to `StageStats`
+    """
+    def __init__(self, installed, failed, stats):
+        self.installed = installed
+        self.failed = failed
+        self.stats = stats
+
+
+class InstallEngine(object):
+    """
+    Usage::
+
+        engine = InstallEngine(activate=move_into_place)
+        report = engine.install(resolver.resolve(['blog']).plan)
+
+    `activate` is called with an `InstallJob` whose `package_dir` holds the
+    unpacked, compiled application. It has to copy or move the files it
+    needs, as the temporary package directory is removed afterwards (unless
+    `cleanup` is False). It may return the directory the application was
+    installed to.
+
+    With a `registry`, every activated application is recorded together
+    with the install directory and the files of its package. A failure to
+    record the application fails its installation.
+
+    With `stream`, tar packages are unpacked by the fetch stage straight
+    from the download stream (see `fetch.fetch_and_unpack`), so the archive
+    is never written to disk, and the unpack stage only checks them.
+    Packages that are in `store` already are still taken from the store.
+    """
+    def __init__(self, activate=None, store=None, fetch_workers=4,
+            verify_workers=2, unpack_workers=2, compile_workers=2,
+            queue_size=QUEUE_SIZE, cleanup=True, compile_processes=None,
+            registry=None, stream=False):
+        self.activate = activate
+        self.stream = stream
+        self.registry = registry
+        self.compile_processes = compile_processes
+        self.store = store
+        self.cleanup = cleanup
+        self.queue_size = queue_size
+        self._compile_pool = None
+        self.stages = [
+            ('fetch', self._fetch, fetch_workers),
+            ('verify', self._verify, verify_workers),
+            ('unpack', self._unpack, unpack_workers),
+            ('compile', self._compile, compile_workers),
+        ]
+
+    def install(self, apps):
+        """
+        Installs `apps` (e.g. `resolver.Resolution.plan`). Applications whose
+        dependencies within the batch fail are not activated.
+
+        :return: an `InstallReport`
+        """
+        jobs = [InstallJob(app) for app in apps]
+        # one pool for all compile workers, started before the threads,
+        # as forking a multithreaded process can deadlock the children
+        if jobs:
+            self._compile_pool = self._start_compile_pool()
+        try:
+            return self._install(jobs)
+        finally:
+            if self._compile_pool is not None:
+                self._compile_pool.close()
+                self._compile_pool.join()
+                self._compile_pool = None
+
+    def _install(self, jobs):
+        stats = {}
+        queues = [Queue.Queue(self.queue_size)
+                for _ in xrange(len(self.stages) + 1)]
+        feeder = threading.Thread(target=self._feed, args=(jobs, queues[0]))
+        feeder.setDaemon(True)
+        feeder.start()
+        threads = [feeder]
+        for index, (name, func, workers) in enumerate(self.stages):
+            stats[name] = StageStats(name, workers)
+            threads.extend(self._start_stage(func, workers, stats[name],
+                queues[index], queues[index + 1]))
+
+        stats['activate'] = StageStats('activate', 1)
+        installed, failed = self._activate_in_order(jobs, queues[-1],
+                stats['activate'])
+        for thread in threads:
+            thread.join()
+        return InstallReport(installed, failed, stats)
+
+    def _feed(self, jobs, queue):
+        for job in jobs:
+            queue.put(job)
+        queue.put(_DONE)
+
+    def _start_stage(self, func, workers, stats, in_queue, out_queue):
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                job = in_queue.get()
+                if job is _DONE:
+                    # let the other workers of this stage see the end too
+                    in_queue.put(_DONE)
+                    with lock:
+                        remaining[0] -= 1
+                        last = not remaining[0]
+                    if last:
+                        out_queue.put(_DONE)
+                    return
+                if job.error is None:
+                    started = time.time()
+                    try:
+                        func(job)
+                    except Exception:
+                        job.error = sys.exc_info()[1]
+                    stats.record(started, time.time())
+                out_queue.put(job)
+
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        return threads
+
+    def _activate_in_order(self, jobs, queue, stats):
+        order = dict((job.app.name, index) for index, job in enumerate(jobs))
+        waiting = {}
+        activated = set()
+        installed = []
+        failed = {}
+        while True:
+            job = queue.get()
+            if job is _DONE:
+                break
+            waiting[job.app.name] = job
+            progress = True
+            while progress:
+                progress = False
+                for name in sorted(waiting, key=order.get):
+                    ready = waiting[name]
+                    deps = [dep for dep in ready.app.depends if dep in order]
+                    broken = [dep for dep in deps if dep in failed]
+                    if ready.error is None:
+                        if broken:
+                            ready.error = PackageError("Dependencies %s of "
+                                    "%s failed to install."
+                                    % (', '.join(broken), name))
+                        elif not all(dep in activated for dep in deps):
+                            continue
+                    del waiting[name]
+                    progress = True
+                    self._finish(ready, stats)
+                    if ready.error is None:
+                        activated.add(name)
+                        installed.append(ready.app)
+                    else:
+                        failed[name] = ready.error
+        for name, job in waiting.items():
+            failed[name] = PackageError("Dependencies of %s were not "
+                    "installed." % name)
+            self._cleanup(job)
+        return installed, failed
+
+    def _finish(self, job, stats):
+        if job.error is None:
+            started = time.time()
+            try:
+                install_path = None
+                if self.activate is not None:
+                    install_path = self.activate(job)
+                if self.registry is not None:
+                    self.registry.record(job.app, install_path, job.files)
+            except Exception:
+                job.error = sys.exc_info()[1]
+            stats.record(started, time.time())
+        self._cleanup(job)
+
+    def _fetch(self, job):
+        app = job.app
+        if self.stream and not (self.store is not None and app.digest and
+                app.digest in self.store):
+            if app.digest:
+                job.package_dir, job.verifier = fetch.fetch_and_unpack(
+                        app.package_url, app.digest)
+            else:
+                job.package_dir = fetch.fetch_and_unpack(app.package_url)
+        elif app.digest:
+            job.package_file, job.verifier = fetch.fetch_package(
+                    app.package_url, app.digest, store=self.store)
+        else:
+            job.package_file = fetch.fetch_package(app.package_url)
+
+    def _verify(self, job):
+        if job.verifier is not None and not job.verifier.is_valid():
+            raise PackageError("Digest mismatch in package of %s: expected "
+                    "%s." % (job.app.name, job.app.digest))
+
+    def _unpack(self, job):
+        if job.package_dir is None:
+            job.package_dir = package.unpack(job.package_file)
+        if not package.has_expected_structure(job.package_dir):
+            raise PackageError("Package of %s does not have the expected "
+                    "structure." % job.app.name)
+
+    def _compile(self, job):
+        job.compile_report = package.compile_package(job.app,
+                job.package_dir, self.compile_processes, self._compile_pool)
+        if self.registry is not None:
+            # hashed here, rather than on the single activation thread
+            job.files = _package_files(job.package_dir)
+
+    def _start_compile_pool(self):
+        # not at module level: importing plugit.install for its other
+        # helpers (e.g. uninstall) should not load multiprocessing
+        import multiprocessing
+        processes = self.compile_processes or multiprocessing.cpu_count()
+        if processes < 2:
+            return None
+        return multiprocessing.Pool(processes)
+
+    def _cleanup(self, job):
+        if self.cleanup and (job.package_file is not None or
+                job.package_dir is not None):
+            package.cleanup(job.package_file, job.package_dir)
+
+
+def uninstall(registry, name, force=False):
+    """
+    Removes the files that `registry` recorded for application `name` from
+    its install directory, the directories that are left empty and then
+    the record of the application, so that the registry stays in step with
+    the file system.
+
+    :param force: uninstall the application even if other recorded
+        applications depend on it
+    :return: the number of files removed
+    :raise PackageError: if the application is not recorded, or other
+        applications depend on it
+    """
+    record = registry.get(name)
+    if record is None:
+        raise PackageError("Application %s is not installed." % name)
+    dependents = registry.dependents(name)
+    if dependents and not force:
+        raise PackageError("Application %s is needed by %s."
+                % (name, ', '.join(sorted(dependents))))
+    removed = 0
+    if record.path is not None:
+        directories = set()
+        for path in registry.files(name):
+            filename = os.path.join(record.path, path)
+            if filename.endswith('.py'):
+                # bytecode is not recorded, it is derived from the sources
+                for suffix in manifest.BYTECODE_SUFFIXES:
+                    _remove(filename[:-3] + suffix)
+            if _remove(filename):
+                removed += 1
+            path = os.path.dirname(path)
+            while path:
+                directories.add(path)
+                path = os.path.dirname(path)
+        # subdirectories sort after their parents
+        for path in sorted(directories, reverse=True):
+            try:
+                os.rmdir(os.path.join(record.path, path))
+            except OSError:
+                # not empty
+                pass
+    registry.remove(name)
+    return removed
+
+def _package_files(package_dir):
+    # with digests, so that later upgrades can be applied as deltas
+    return sorted(manifest.Manifest.from_directory(package_dir).files.items())
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
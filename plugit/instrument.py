@@ -0,0 +1,183 @@
+"""
+Instrumentation of the install path.
+
+The installation steps run inside spans that measure their duration and
+count what they did: ``fetch_descriptor``, ``fetch_package``, ``is_valid``,
+``unpack``, ``compile_package``, ``delta_upgrade``, ``verify``,
+``settings_update`` and ``settings_save``.
+When a span ends, it is passed to every registered hook::
+
+    profile = Profile()
+    add_hook(profile)
+    install(...)
+    remove_hook(profile)
+    profile.dump('profile.json')
+
+A span has a `Span.name`, its `Span.duration` in seconds, the exception that
+ended it in `Span.error` (None on success), the keyword arguments it was
+started with in `Span.info` and `Span.counters`, a dictionary of counts such
+as ``bytes_transferred``, ``bytes_hashed``, ``files_extracted`` and
+``cache_hits``.
+
+Without hooks, `span` returns a shared do-nothing span, so instrumented code
+only pays for a function call and a check. Counters that take work to
+compute are only computed if `Span.enabled` is set. A hook that raises does
+not break the installation: its exception is reported with
+`warnings.warn` as a `RuntimeWarning`.
+"""
+from __future__ import with_statement
+
+import sys, threading, warnings
+from timeit import default_timer as _timer
+
+# replaced, never modified in place, so it can be read without locking
+_hooks = ()
+_hooks_lock = threading.Lock()
+
+
+class Span(object):
+    enabled = True
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.counters = {}
+        self.started = None
+        self.duration = None
+        self.error = None
+
+    def add(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def __enter__(self):
+        self.started = _timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = _timer() - self.started
+        self.error = exc_value
+        _emit(self)
+        return False
+
+
+class _NullSpan(object):
+    """
+    Stands in for `Span` when no hooks are registered.
+    """
+    enabled = False
+
+    def add(self, counter, amount=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **info):
+    """
+    :return: a context manager that measures the block it wraps and passes
+        itself to the hooks when the block ends.
+    """
+    if not _hooks:
+        return _NULL_SPAN
+    return Span(name, info)
+
+def add_hook(hook):
+    """
+    Registers `hook`, a callable that is called with every `Span` that ends,
+    in the thread that ran the span.
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+
+def remove_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+def _emit(ended):
+    for hook in _hooks:
+        try:
+            hook(ended)
+        except Exception:
+            # a broken hook must not break the installation
+            warnings.warn("Instrumentation hook %r failed: %s"
+                    % (hook, sys.exc_info()[1]), RuntimeWarning)
+
+
+class Profile(object):
+    """
+    A hook that aggregates spans by name: the number of calls and errors,
+    the total, minimum and maximum duration and the sums of the counters.
+
+    It is a context manager that registers itself::
+
+        with Profile() as profile:
+            install(...)
+        print profile.as_json()
+    """
+    def __init__(self):
+        self._steps = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, ended):
+        with self._lock:
+            step = self._steps.get(ended.name)
+            if step is None:
+                step = self._steps[ended.name] = {'calls': 0, 'errors': 0,
+                        'total_time': 0.0, 'min_time': None,
+                        'max_time': None, 'counters': {}}
+            step['calls'] += 1
+            if ended.error is not None:
+                step['errors'] += 1
+            step['total_time'] += ended.duration
+            if step['min_time'] is None or ended.duration < step['min_time']:
+                step['min_time'] = ended.duration
+            if step['max_time'] is None or ended.duration > step['max_time']:
+                step['max_time'] = ended.duration
+            counters = step['counters']
+            for counter, amount in ended.counters.items():
+                counters[counter] = counters.get(counter, 0) + amount
+
+    def as_dict(self):
+        """
+        :return: a dictionary that maps step names to dictionaries with
+            ``calls``, ``errors``, ``total_time``, ``mean_time``,
+            ``min_time``, ``max_time`` and ``counters``.
+        """
+        with self._lock:
+            result = {}
+            for name, step in self._steps.items():
+                step = dict(step, counters=dict(step['counters']))
+                step['mean_time'] = step['total_time'] / step['calls']
+                result[name] = step
+            return result
+
+    def as_json(self):
+        try:
+            import json
+        except ImportError:
+            import simplejson as json
+        return json.dumps(self.as_dict(), indent=1, sort_keys=True)
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.as_json())
+
+    def clear(self):
+        with self._lock:
+            self._steps.clear()
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_hook(self)
+        return False
@@ -0,0 +1,99 @@
+"""
+A small thread-safe least recently used cache.
+"""
+from __future__ import with_statement
+
+import threading
+
+# indices into the linked list entries
+_PREV, _NEXT, _KEY, _VALUE = range(4)
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most `max_size` entries and evicts the least
+    recently used entry when full. Lookups and updates are O(1).
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("LRUCache size has to be positive.")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._move_to_front(link)
+            return link[_VALUE]
+
+    def put(self, key, value):
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                link[_VALUE] = value
+                self._move_to_front(link)
+                return
+            if len(self._links) >= self.max_size:
+                oldest = self._root[_PREV]
+                self._unlink(oldest)
+                del self._links[oldest[_KEY]]
+            root = self._root
+            link = [root, root[_NEXT], key, value]
+            root[_NEXT][_PREV] = link
+            root[_NEXT] = link
+            self._links[key] = link
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[_VALUE]
+
+    def keys(self):
+        with self._lock:
+            return self._links.keys()
+
+    def clear(self):
+        with self._lock:
+            root = []
+            root[:] = [root, root, None, None]
+            self._root = root
+            self._links = {}
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def _move_to_front(self, link):
+        self._unlink(link)
+        root = self._root
+        link[_PREV] = root
+        link[_NEXT] = root[_NEXT]
+        root[_NEXT][_PREV] = link
+        root[_NEXT] = link
@@ -0,0 +1,607 @@
+"""
+Per-file package manifests and delta upgrades.
+
+A manifest lists the files of a package by their path relative to the
+package root, with the ``algo:hexdigest`` digest and size of each file. The
+repository publishes it as JSON next to the package::
+
+    {"blobs": "blobs/",
+     "files": {"blog/__init__.py": ["sha256:9f86d0...", 1024], ...}}
+
+and serves every file under its digest below the ``blobs`` URL (relative
+to the manifest, ``blobs/`` if not given), e.g.
+``blobs/sha256/9f86d0...``.
+
+When the installed files of an application are known (the registry records
+their digests), `delta_upgrade` compares the installed manifest with the
+manifest of the new version and fetches only the files that are new or have
+changed. Files whose contents are already installed under another path, or
+are in the `store.PackageStore`, are not fetched either. The bytes
+transferred and the work done are thus proportional to the size of the
+change, not to the size of the package.
+
+The new files are staged and verified next to the installation before any
+installed file is touched. They are then renamed into place and the removed
+files deleted; if this fails halfway, the replaced files are restored from
+hard-link backups.
+
+`verify` checks an unpacked or installed tree against its manifest. Files
+are hashed on several threads (hashlib releases the GIL while it hashes
+large buffers) and every file is read once, however many algorithms are
+computed. With a `VerifyState` from the previous run, quick mode only hashes
+the files whose size, modification time or inode have changed since, so
+verifying a large installation is cheap enough for a periodic health
+check::
+
+    state = VerifyState.load(state_file)
+    report = verify(install_dir, manifest, state, quick=True)
+    state.save(state_file)
+"""
+from __future__ import with_statement
+
+import os, time, errno, shutil, urllib, hashlib, tempfile, urlparse
+from contextlib import closing
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from plugit import connection, fetch, instrument, package, workers
+from plugit.exceptions import FetchError, PackageError
+
+DEFAULT_ALGORITHM = 'sha256'
+# large reads let hashlib hash without holding the GIL for longer
+HASH_CHUNK_SIZE = 1024 * 1024
+# files modified this close to a verification are hashed again the next
+# time, as a change within the timestamp resolution would not show
+MTIME_SLACK = 2
+DEFAULT_BLOBS = 'blobs/'
+# derived from the sources at install time, not part of a package
+BYTECODE_SUFFIXES = ('.pyc', '.pyo')
+
+_STAGE_PREFIX = '.plugit-upgrade-'
+
+
+class Manifest(object):
+    """
+    :ivar files: a dictionary that maps relative file paths (with ``/`` as
+        separator) to their digests
+    :ivar sizes: a dictionary that maps relative file paths to their sizes,
+        may be incomplete
+    :ivar blobs: the base URL of the file blobs, relative to the manifest URL
+    """
+    def __init__(self, files=None, sizes=None, blobs=DEFAULT_BLOBS):
+        self.files = dict(files or {})
+        self.sizes = dict(sizes or {})
+        self.blobs = blobs
+
+    @classmethod
+    def from_directory(cls, directory, algo=DEFAULT_ALGORITHM):
+        """
+        Builds the manifest of the files below `directory`, leaving out
+        compiled bytecode.
+        """
+        files = {}
+        sizes = {}
+        for path in _walk(directory):
+            filename = os.path.join(directory, *path.split('/'))
+            files[path], sizes[path] = file_digest(filename, algo)
+        return cls(files, sizes)
+
+    @classmethod
+    def from_json(cls, text):
+        """
+        :raise PackageError: if `text` is not a valid manifest
+        """
+        try:
+            data = json.loads(text)
+            files = {}
+            sizes = {}
+            for path, entry in data['files'].items():
+                if isinstance(entry, basestring):
+                    files[path] = entry
+                else:
+                    files[path], sizes[path] = entry
+                _check_path(path)
+                # as computed locally, hexdigest() is lowercase
+                files[path] = '%s:%s' % package._split_digest(files[path])
+            return cls(files, sizes, data.get('blobs', DEFAULT_BLOBS))
+        except (ValueError, TypeError, KeyError, AttributeError), e:
+            raise PackageError("Invalid manifest: %s" % str(e))
+
+    def to_json(self):
+        return json.dumps({'blobs': self.blobs, 'files': dict(
+            (path, [digest, self.sizes[path]] if path in self.sizes
+                else digest) for path, digest in self.files.items())},
+            indent=1, sort_keys=True)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_json(f.read())
+
+    def diff(self, new):
+        """
+        :return: the `ManifestDiff` that changes this manifest into `new`
+        """
+        added = sorted(path for path in new.files if path not in self.files)
+        removed = sorted(path for path in self.files
+                if path not in new.files)
+        changed = sorted(path for path, digest in new.files.items()
+                if path in self.files and self.files[path] != digest)
+        return ManifestDiff(added, changed, removed,
+                len(new.files) - len(added) - len(changed))
+
+    def __len__(self):
+        return len(self.files)
+
+
+class ManifestDiff(object):
+    """
+    :ivar added: the paths of the files that are only in the new manifest
+    :ivar changed: the paths of the files whose digest has changed
+    :ivar removed: the paths of the files that are only in the old manifest
+    :ivar unchanged: the number of files that are the same in both
+    """
+    def __init__(self, added, changed, removed, unchanged):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.unchanged = unchanged
+
+    @property
+    def updated(self):
+        """
+        The paths of the files that have to be written, added or changed.
+        """
+        return sorted(self.added + self.changed)
+
+    def __nonzero__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __repr__(self):
+        return 'ManifestDiff(added=%d, changed=%d, removed=%d)' % (
+                len(self.added), len(self.changed), len(self.removed))
+
+
+class UpgradeReport(object):
+    """
+    :ivar diff: the applied `ManifestDiff`
+    :ivar fetched: the number of file blobs that were downloaded
+    :ivar reused: the number of file blobs taken from the installation or
+        the package store
+    :ivar bytes_transferred: the number of bytes downloaded
+    """
+    def __init__(self, diff):
+        self.diff = diff
+        self.fetched = 0
+        self.reused = 0
+        self.bytes_transferred = 0
+
+
+def fetch_manifest(url):
+    """
+    Fetches and parses the manifest at `url`.
+
+    :raise FetchError: if the manifest cannot be fetched
+    :raise PackageError: if it is not a valid manifest
+    """
+    try:
+        with closing(urllib.urlopen(url)) as response:
+            status = response.getcode()
+            body = response.read()
+    except Exception, e:
+        raise FetchError("Error in fetching manifest %s: %s" % (url, str(e)))
+    if status not in (None, 200):
+        raise FetchError("Error in fetching manifest %s: HTTP %s"
+                % (url, status))
+    return Manifest.from_json(body)
+
+def installed_manifest(registry, name):
+    """
+    :return: the `Manifest` of the files of application `name` that are
+        recorded in `registry`, or None if the application or the digests of
+        its files are not recorded.
+    """
+    files = registry.files(name)
+    if not files or None in files.values():
+        return None
+    return Manifest(files)
+
+def delta_upgrade(registry, app, store=None, pool=None,
+        max_workers=workers.DEFAULT_WORKERS):
+    """
+    Upgrades the installed application to `app`, a descriptor whose
+    ``manifest_url`` points to the manifest of the new version, and records
+    the new version in `registry`.
+
+    :return: an `UpgradeReport`, or None if a delta upgrade is not possible
+        (no manifest URL, the application is not installed or its files are
+        not recorded with digests) and the package has to be installed in
+        full.
+    """
+    installed = registry.get(app.name)
+    if not app.manifest_url or installed is None or not installed.path:
+        return None
+    old = installed_manifest(registry, app.name)
+    if old is None:
+        return None
+    new = fetch_manifest(app.manifest_url)
+    report = upgrade(installed.path, old, new,
+            urlparse.urljoin(app.manifest_url, new.blobs), store, pool,
+            max_workers)
+    registry.record(app, installed.path, new.files.items())
+    return report
+
+def upgrade(install_dir, old, new, blobs_url, store=None, pool=None,
+        max_workers=workers.DEFAULT_WORKERS):
+    """
+    Changes the files below `install_dir` from manifest `old` to manifest
+    `new`, fetching the missing file blobs from `blobs_url` on at most
+    `max_workers` threads.
+
+    Files that `old` does not list are left alone, so several applications
+    can share `install_dir`.
+
+    :param store: an optional `store.PackageStore` to take blobs from and
+        to keep the fetched blobs in
+    :param pool: the `connection.ConnectionPool` to fetch the blobs over,
+        the default pool if not given
+    :return: an `UpgradeReport`
+    :raise FetchError: if a blob cannot be fetched
+    :raise PackageError: if a fetched blob does not match its digest or the
+        files cannot be replaced; the installation is left unchanged
+    """
+    diff = old.diff(new)
+    report = UpgradeReport(diff)
+    if not diff:
+        return report
+    with instrument.span('delta_upgrade', path=install_dir) as span:
+        stage = tempfile.mkdtemp(dir=install_dir, prefix=_STAGE_PREFIX)
+        try:
+            blobs = _stage_blobs(install_dir, stage, old, new, diff,
+                    blobs_url, store, pool or connection.default_pool(),
+                    max_workers, report)
+            _apply(install_dir, stage, diff, new, blobs)
+        finally:
+            shutil.rmtree(stage, ignore_errors=True)
+        span.add('bytes_transferred', report.bytes_transferred)
+        span.add('files_fetched', report.fetched)
+        span.add('files_reused', report.reused)
+    return report
+
+def blob_url(blobs_url, digest):
+    """
+    >>> blob_url('http://example.com/blog/blobs/', 'sha256:9f86d0')
+    'http://example.com/blog/blobs/sha256/9f86d0'
+    """
+    algo, hexdigest = package._split_digest(digest)
+    return urlparse.urljoin(blobs_url, '%s/%s' % (algo, hexdigest))
+
+def file_digest(filename, algo=DEFAULT_ALGORITHM):
+    """
+    :return: ``(digest, size)`` of `filename`, the digest in
+        ``algo:hexdigest`` format
+    """
+    digests, size = hash_file(filename, [algo])
+    return digests[algo], size
+
+def hash_file(filename, algorithms):
+    """
+    Computes the digests of `filename` with all `algorithms` in one pass
+    over the file.
+
+    :return: ``(digests, size)``, where `digests` maps the algorithms to
+        digests in ``algo:hexdigest`` format
+    """
+    hash_fns = dict((algo, hashlib.new(algo)) for algo in algorithms)
+    updates = [hash_fn.update for hash_fn in hash_fns.values()]
+    size = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            for update in updates:
+                update(chunk)
+            size += len(chunk)
+    return dict((algo, '%s:%s' % (algo, hash_fn.hexdigest()))
+            for algo, hash_fn in hash_fns.items()), size
+
+
+class VerifyState(object):
+    """
+    The size, modification time, inode and digest of every file when it was
+    last found to match its manifest.
+
+    :ivar entries: a dictionary that maps relative file paths to
+        ``[size, mtime, inode, digest]`` lists
+    """
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :return: the state saved in `filename`, an empty state if the file
+            does not exist or cannot be read
+        """
+        try:
+            with open(filename) as f:
+                return cls(json.load(f))
+        except (IOError, ValueError):
+            return cls()
+
+    def save(self, filename):
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_path, filename)
+        except:
+            os.remove(tmp_path)
+            raise
+
+
+class VerifyReport(object):
+    """
+    :ivar mismatched: the paths of the files that do not match their digests
+    :ivar missing: the paths of the files that do not exist
+    :ivar hashed: the number of files that were hashed
+    :ivar skipped: the number of files that were unchanged since the last
+        verification and not hashed
+    :ivar bytes_hashed: the number of bytes read
+    :ivar digests: a dictionary that maps the paths of the hashed files to
+        dictionaries of their digests by algorithm
+    """
+    def __init__(self):
+        self.mismatched = []
+        self.missing = []
+        self.hashed = 0
+        self.skipped = 0
+        self.bytes_hashed = 0
+        self.digests = {}
+
+    @property
+    def is_valid(self):
+        return not self.mismatched and not self.missing
+
+
+def verify(directory, manifest, state=None, quick=False, algorithms=(),
+        max_workers=workers.DEFAULT_WORKERS):
+    """
+    Checks the files below `directory` against `manifest` on at most
+    `max_workers` threads. Files that the manifest does not list are not
+    checked.
+
+    :param state: a `VerifyState` that is updated with the files that
+        match; in `quick` mode, the files that are unchanged since they last
+        matched are not hashed
+    :param algorithms: algorithms to compute besides the manifest's, in the
+        same pass (e.g. to migrate to a new manifest algorithm)
+    :return: a `VerifyReport`
+    """
+    if quick and state is None:
+        raise ValueError("Quick verification requires a verification "
+                "state.")
+    started = time.time()
+    entries = state.entries if state is not None else {}
+
+    def check(path):
+        expected = manifest.files[path]
+        filename = os.path.join(directory, *path.split('/'))
+        try:
+            stat = os.stat(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return path, None, None
+        signature = [stat.st_size, stat.st_mtime, stat.st_ino]
+        if quick and entries.get(path) == signature + [expected]:
+            return path, signature, None
+        if manifest.sizes.get(path, stat.st_size) != stat.st_size:
+            return path, signature, {}
+        algo = package._split_digest(expected)[0]
+        return path, signature, hash_file(filename,
+                [algo] + [extra for extra in algorithms if extra != algo])
+
+    report = VerifyReport()
+    with instrument.span('verify', path=directory) as span:
+        for path, signature, hashed in workers.thread_map(check,
+                sorted(manifest.files), max_workers):
+            if signature is None:
+                report.missing.append(path)
+                entries.pop(path, None)
+                continue
+            if hashed is None:
+                report.skipped += 1
+                continue
+            if hashed:
+                digests, size = hashed
+                report.hashed += 1
+                report.bytes_hashed += size
+                report.digests[path] = digests
+                if manifest.files[path] in digests.values():
+                    if signature[1] < started - MTIME_SLACK:
+                        entries[path] = signature + [manifest.files[path]]
+                    else:
+                        entries.pop(path, None)
+                    continue
+            report.mismatched.append(path)
+            entries.pop(path, None)
+        for path in list(entries):
+            if path not in manifest.files:
+                del entries[path]
+        span.add('files_hashed', report.hashed)
+        span.add('files_skipped', report.skipped)
+        span.add('bytes_hashed', report.bytes_hashed)
+    return report
+
+def _stage_blobs(install_dir, stage, old, new, diff, blobs_url, store,
+        pool, max_workers, report):
+    """
+    Puts a verified copy of every needed blob into `stage`.
+
+    :return: a dictionary that maps digests to the staged files
+    """
+    local = {}
+    for path, digest in old.files.items():
+        local.setdefault(digest, path)
+    digests = sorted(set(new.files[path] for path in diff.updated))
+    blobs = dict((digest, os.path.join(stage, str(index)))
+            for index, digest in enumerate(digests))
+
+    def stage_blob(digest):
+        staged = blobs[digest]
+        if digest in local and _copy_verified(
+                os.path.join(install_dir, *local[digest].split('/')),
+                staged, digest):
+            return 0
+        if store is not None and _copy_verified(store.path(digest), staged,
+                digest):
+            return 0
+        return _fetch_blob(blob_url(blobs_url, digest), digest, staged,
+                store, pool)
+
+    for transferred in workers.thread_map(stage_blob, digests, max_workers):
+        if transferred:
+            report.fetched += 1
+            report.bytes_transferred += transferred
+        else:
+            report.reused += 1
+    return blobs
+
+def _copy_verified(source, staged, digest):
+    """
+    Copies `source` to `staged` if it matches `digest`.
+
+    :return: True if it was copied
+    """
+    verifier = package.DigestVerifier(digest)
+    try:
+        with open(source, 'rb') as src:
+            with open(staged, 'wb') as f:
+                fetch._copy_stream(src, f, verifier)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return verifier.is_valid()
+
+def _fetch_blob(url, digest, staged, store, pool):
+    # one keep-alive request per blob, streamed to disk as it arrives
+    verifier = package.DigestVerifier(digest)
+    try:
+        with pool.open(url) as response:
+            if response.status != 200:
+                raise FetchError("Error in fetching %s: HTTP %s %s"
+                        % (url, response.status, response.reason))
+            with open(staged, 'wb') as f:
+                fetch._copy_stream(response, f, verifier)
+    except FetchError:
+        raise
+    except Exception, e:
+        raise FetchError("Error in fetching %s: %s" % (url, str(e)))
+    if not verifier.is_valid():
+        raise PackageError("Digest mismatch in %s: expected %s."
+                % (url, digest))
+    if store is not None:
+        store.add(digest, staged)
+    return verifier.bytes_hashed
+
+def _apply(install_dir, stage, diff, new, blobs):
+    """
+    Moves the staged blobs to their paths and deletes the removed files,
+    restoring the installation if this fails.
+    """
+    # one file per path, as several paths may have the same contents
+    prepared = []
+    for index, path in enumerate(diff.updated):
+        target = os.path.join(install_dir, *path.split('/'))
+        staged = os.path.join(stage, 'file-%d' % index)
+        package.link_or_copy(blobs[new.files[path]], staged)
+        if os.path.exists(target):
+            shutil.copymode(target, staged)
+        prepared.append((target, staged))
+    removed = [os.path.join(install_dir, *path.split('/'))
+            for path in diff.removed]
+
+    created = []
+    created_dirs = []
+    backups = []
+    try:
+        for target, staged in prepared:
+            _make_dirs(os.path.dirname(target), created_dirs)
+            if os.path.exists(target):
+                backup = staged + '.orig'
+                package.link_or_copy(target, backup)
+                backups.append((target, backup))
+            else:
+                created.append(target)
+            os.rename(staged, target)
+        for target in removed:
+            if os.path.exists(target):
+                backup = os.path.join(stage, 'removed-%d' % len(backups))
+                package.link_or_copy(target, backup)
+                backups.append((target, backup))
+                os.remove(target)
+    except (IOError, OSError), e:
+        for target in created:
+            if os.path.exists(target):
+                os.remove(target)
+        for target, backup in reversed(backups):
+            os.rename(backup, target)
+        for directory in reversed(created_dirs):
+            os.rmdir(directory)
+        raise PackageError("Cannot upgrade %s: %s" % (install_dir, str(e)))
+
+    for target in removed + [target for target, _ in prepared]:
+        # stale bytecode would shadow removed and changed modules
+        if target.endswith('.py'):
+            for suffix in BYTECODE_SUFFIXES:
+                if os.path.exists(target[:-3] + suffix):
+                    os.remove(target[:-3] + suffix)
+    for target in removed:
+        _remove_empty_dirs(os.path.dirname(target), install_dir)
+
+def _make_dirs(directory, created):
+    """
+    Creates `directory` and its missing parents, appending them to `created`
+    from the top down.
+    """
+    missing = []
+    while not os.path.isdir(directory):
+        missing.append(directory)
+        directory = os.path.dirname(directory)
+    for directory in reversed(missing):
+        os.mkdir(directory)
+        created.append(directory)
+
+def _remove_empty_dirs(directory, root):
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    while directory != root and directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+def _walk(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames
+                if not name.startswith(_STAGE_PREFIX)]
+        relative = os.path.relpath(dirpath, directory)
+        for filename in filenames:
+            if filename.endswith(BYTECODE_SUFFIXES):
+                continue
+            path = filename if relative == os.curdir else \
+                    os.path.join(relative, filename)
+            yield path.replace(os.sep, '/')
+
+def _check_path(path):
+    parts = path.split('/')
+    if path.startswith('/') or '..' in parts or '' in parts or '\\' in path:
+        raise ValueError("unsafe path %s" % path)
@@ -1,53 +1,423 @@
 from __future__ import with_statement
 
-import os, shutil, hashlib, tarfile, zipfile
+import os, imp, mmap, shutil, struct, hashlib, tarfile, zipfile, threading, \
+        py_compile
+from contextlib import closing
+
+from plugit import instrument, workers
+from plugit.exceptions import PackageError
+
+# size of the blocks that package contents are hashed and copied in
+CHUNK_SIZE = 64 * 1024
+
+UNPACK_DIR = 'unpacked'
+
+# zip archives need their central directory (at the end of the file), so
+# they cannot be extracted from a stream
+ZIP_MAGIC = 'PK\x03\x04'
+
+# limits that guard against zip bombs
+MAX_UNCOMPRESSED_SIZE = 1024 * 1024 * 1024
+MAX_ENTRIES = 100000
 
 class ZipWrapper(object):
+    """
+    Extracts zip packages with bounded memory use: members are decompressed
+    in `CHUNK_SIZE` blocks straight to disk. Members are distributed over
+    `max_workers` threads that each use their own `zipfile.ZipFile` handle,
+    zlib releases the GIL while decompressing.
 
-    def __init__(self, zip_file):
+    Archives that declare more than `max_size` uncompressed bytes or more
+    than `max_entries` entries, members that turn out to be larger than
+    declared and members with paths that lead outside of the output
+    directory are rejected with `PackageError`.
+    """
+    def __init__(self, zip_file, max_size=MAX_UNCOMPRESSED_SIZE,
+            max_entries=MAX_ENTRIES, max_workers=workers.DEFAULT_WORKERS):
+        self.zip_file = zip_file
         self.zf = zipfile.ZipFile(zip_file)
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+
+    def check_limits(self):
+        infos = self.zf.infolist()
+        if len(infos) > self.max_entries:
+            raise PackageError("%s has %d entries, more than the allowed %d."
+                    % (self.zip_file, len(infos), self.max_entries))
+        total = sum(info.file_size for info in infos)
+        if total > self.max_size:
+            raise PackageError("%s unpacks to %d bytes, more than the "
+                    "allowed %d." % (self.zip_file, total, self.max_size))
 
     def makedirs(self, output_dir):
-        dirs = [os.path.join(output_dir, name)
-                for name in self.zf.namelist() if name.endswith('/')]
-        os.makedirs(dirs)
+        """
+        Creates the directory tree of the archive in `output_dir`, including
+        parents of members that have no directory entries of their own.
+        """
+        root = os.path.realpath(output_dir)
+        dirs = set()
+        for name in self.zf.namelist():
+            path = os.path.realpath(os.path.join(root, name))
+            if not _is_within(root, path):
+                raise PackageError("Refusing to unpack %s outside of the "
+                        "package directory." % name)
+            dirs.add(path if name.endswith('/') else os.path.dirname(path))
+        for path in sorted(dirs):
+            if not os.path.isdir(path):
+                os.makedirs(path)
 
     def extractall(self, output_dir):
+        """
+        :return: the number of extracted files
+        """
+        self.check_limits()
         self.makedirs(output_dir)
-        for name in self.zf.namelist():
-            if not name.endswith('/'):
-                with open(os.path.join(output_dir, name), 'wb') as f:
-                    f.write(self.zf.read(name))
+        members = [info for info in self.zf.infolist()
+                if not info.filename.endswith('/')]
+        workers.thread_map(lambda batch: self._extract_batch(batch,
+            output_dir), _balance(members, self.max_workers),
+            self.max_workers)
+        return len(members)
 
+    def _extract_batch(self, members, output_dir):
+        zf = zipfile.ZipFile(self.zip_file)
+        try:
+            for info in members:
+                self._extract_member(zf, info, output_dir)
+        finally:
+            zf.close()
 
-def is_valid(digest, package_file):
-    algo, hexdigest = digest.split(':', 1)
-    hash_fn = hashlib.new(algo)
-    with open(package_file, 'rb') as f:
-        # TODO: read in chunks
-        hash_fn.update(f.read())
-    if hexdigest = hash_fn.hexdigest():
+    def _extract_member(self, zf, info, output_dir):
+        written = 0
+        with closing(zf.open(info)) as src:
+            with open(os.path.join(output_dir, info.filename), 'wb') as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    if written > info.file_size:
+                        raise PackageError("%s in %s is larger than "
+                                "declared." % (info.filename, self.zip_file))
+                    dst.write(chunk)
+
+
+def _balance(members, count):
+    """
+    Splits zip members into at most `count` batches of roughly equal total
+    size, largest members first.
+    """
+    batches = [[0, []] for _ in xrange(max(1, min(count, len(members))))]
+    for info in sorted(members, key=lambda info: -info.file_size):
+        batch = min(batches, key=lambda batch: batch[0])
+        batch[0] += info.file_size
+        batch[1].append(info)
+    return [batch for _, batch in batches if batch]
+
+
+class DigestVerifier(object):
+    """
+    Incrementally computes the digest of a package as its contents become
+    available (e.g. while it is being downloaded) so that the package does
+    not have to be read again for validation.
+
+    `digest` is in ``algo:hexdigest`` format, e.g. ``sha1:da39a3ee...``.
+    """
+    def __init__(self, digest):
+        self.digest = digest
+        self.algo, self.hexdigest = _split_digest(digest)
+        self.reset()
+
+    def reset(self):
+        self.hash_fn = hashlib.new(self.algo)
+        self.bytes_hashed = 0
+
+    def update(self, chunk):
+        self.hash_fn.update(chunk)
+        self.bytes_hashed += len(chunk)
+
+    def update_from_file(self, package_file, length=None):
+        """
+        Hashes `package_file` (or its first `length` bytes) in chunks through
+        a memory map.
+        """
+        with open(package_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if length is not None:
+                size = min(size, length)
+            if not size:
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, CHUNK_SIZE):
+                    self.update(mapped[offset:min(offset + CHUNK_SIZE, size)])
+            finally:
+                mapped.close()
+
+    def is_valid(self):
+        return self.hexdigest == self.hash_fn.hexdigest()
+
+
+class KnownDigest(object):
+    """
+    Stands in for a `DigestVerifier` of contents whose digest has already
+    been verified, e.g. packages taken from a `store.PackageStore`.
+    """
+    bytes_hashed = 0
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.algo, self.hexdigest = _split_digest(digest)
+
+    def update(self, chunk):
+        pass
+
+    def is_valid(self):
         return True
-    return False
+
+
+class HashingReader(object):
+    """
+    A read-only file-like wrapper that passes everything read from
+    `fileobj` to `verifier`. `head` holds bytes that have already been read
+    from `fileobj` (e.g. to detect the archive format) and are returned
+    first.
+    """
+    def __init__(self, fileobj, verifier=None, head=''):
+        self.fileobj = fileobj
+        self.verifier = verifier
+        self.head = head
+
+    def read(self, size=-1):
+        if self.head:
+            if size < 0:
+                data = self.head + self.fileobj.read()
+            else:
+                data = self.head[:size]
+                if len(data) < size:
+                    data += self.fileobj.read(size - len(data))
+            self.head = self.head[len(data):]
+        else:
+            data = self.fileobj.read(size)
+        if self.verifier is not None:
+            self.verifier.update(data)
+        return data
+
+    def drain(self):
+        """
+        Reads (and hashes) whatever is left, e.g. the padding after the end
+        of a tar archive.
+        """
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def is_valid(digest, package_file):
+    """
+    Checks that `package_file` matches `digest`. The file is hashed in
+    `CHUNK_SIZE` blocks, so memory use does not depend on the package size.
+
+    :param digest: the expected digest in ``algo:hexdigest`` format
+    :param package_file: path to the package
+    """
+    with instrument.span('is_valid', package=package_file) as span:
+        verifier = DigestVerifier(digest)
+        verifier.update_from_file(package_file)
+        span.add('bytes_hashed', verifier.bytes_hashed)
+        return verifier.is_valid()
 
 def unpack(package_file):
-    unpack_to = os.path.join(os.path.dirname(package_file), 'unpacked')
-    os.mkdir(unpack_to)
-    if tarfile.is_tarfile(package_file):
-        tarfile.TarFile(package_file).extractall(unpack_to)
-    elif zipfile.is_zipfile(package_file):
-        ZipWrapper(package_file).extractall(unpack_to)
-    else:
-        raise PackageError("No unpacker for %s." % package_file)
-    return unpack_to
+    with instrument.span('unpack', package=package_file) as span:
+        unpack_to = os.path.join(os.path.dirname(package_file), UNPACK_DIR)
+        os.mkdir(unpack_to)
+        if tarfile.is_tarfile(package_file):
+            archive = tarfile.open(package_file)
+            try:
+                # member by member, so that links extracted earlier are
+                # taken into account by the checks
+                for member in archive:
+                    _check_member(member, unpack_to)
+                    archive.extract(member, unpack_to)
+                    if member.isfile():
+                        span.add('files_extracted')
+            finally:
+                archive.close()
+        elif zipfile.is_zipfile(package_file):
+            span.add('files_extracted',
+                    ZipWrapper(package_file).extractall(unpack_to))
+        else:
+            raise PackageError("No unpacker for %s." % package_file)
+        return unpack_to
+
+def unpack_stream(fileobj, unpack_to):
+    """
+    Extracts a (possibly compressed) tar archive from the non-seekable
+    `fileobj` entry by entry as the data arrives, so that the archive itself
+    never has to be stored on disk.
+
+    Entries with absolute paths or paths that lead outside of `unpack_to`
+    are rejected with `PackageError`, as the archive has not been verified
+    yet while it is extracted.
+
+    :return: `unpack_to`
+    """
+    with instrument.span('unpack', package=unpack_to) as span:
+        os.mkdir(unpack_to)
+        try:
+            archive = tarfile.open(fileobj=fileobj, mode='r|*')
+        except tarfile.TarError, e:
+            raise PackageError("No unpacker for the package stream: %s"
+                    % str(e))
+        try:
+            for member in archive:
+                _check_member(member, unpack_to)
+                archive.extract(member, unpack_to)
+                if member.isfile():
+                    span.add('files_extracted')
+        except tarfile.TarError, e:
+            raise PackageError("Error in unpacking package stream: %s"
+                    % str(e))
+        finally:
+            archive.close()
+        return unpack_to
 
 def has_expected_structure(package_dir):
     """Not implemented."""
     return True
 
-def compile_package(app, package_dir):
-    """Not implemented."""
-    pass
+class CompileReport(object):
+    """
+    :ivar compiled: paths of the source files that were compiled
+    :ivar skipped: paths of the source files whose bytecode was up to date
+    :ivar failed: a dictionary that maps paths of the source files that
+        could not be compiled to error messages
+    """
+    def __init__(self):
+        self.compiled = []
+        self.skipped = []
+        self.failed = {}
+
+
+def compile_package(app, package_dir, processes=None, pool=None):
+    """
+    Compiles all Python source files under `package_dir` to bytecode on a
+    pool of `processes` worker processes (one per CPU by default), so that
+    the application is not compiled on first import in production.
+
+    Forking a process that runs other threads can deadlock the children on
+    locks that those threads hold, so a pool is only started here if the
+    calling process runs no other threads. Otherwise the files are compiled
+    in the calling thread, unless a `multiprocessing.Pool` that was created
+    before the threads were started is passed in `pool` (as
+    `install.InstallEngine` does).
+
+    Files whose bytecode is up to date (the ``.pyc`` header has the current
+    magic number and the source modification time, as checked on import)
+    are skipped, so compiling an unchanged tree again is cheap. Files that
+    fail to compile are reported without stopping the others.
+
+    :return: a `CompileReport`
+    """
+    with instrument.span('compile_package', package=package_dir) as span:
+        report = _compile_package(package_dir, processes, pool)
+        span.add('files_compiled', len(report.compiled))
+        span.add('files_skipped', len(report.skipped))
+        span.add('files_failed', len(report.failed))
+        return report
+
+def _compile_package(package_dir, processes, pool):
+    report = CompileReport()
+    stale = []
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                if _bytecode_is_current(path):
+                    report.skipped.append(path)
+                else:
+                    stale.append(path)
+    if not stale:
+        return report
+
+    # deferred until there are stale files, up-to-date packages and
+    # unpacking do not need it
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    chunksize = max(1, len(stale) // (4 * processes))
+    if pool is not None:
+        results = pool.map(_compile_file, stale, chunksize)
+    elif (processes < 2 or len(stale) < 2 * processes or
+            threading.active_count() > 1):
+        results = map(_compile_file, stale)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_compile_file, stale, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    for path, error in results:
+        if error is None:
+            report.compiled.append(path)
+        else:
+            report.failed[path] = error
+    return report
 
 def cleanup(package_file, package_dir):
-    shutil.rmtree(os.path.dirname(package_file))
+    """
+    Removes the temporary directory of a fetched package. `package_file` is
+    None for packages that were unpacked from the download stream.
+    """
+    shutil.rmtree(os.path.dirname(package_file or package_dir))
+
+def link_or_copy(source, destination):
+    """
+    Hard links `source` to `destination`, or copies it where hard links are
+    not available.
+    """
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        # no hard links on this platform or file system
+        shutil.copy2(source, destination)
+
+def _check_member(member, unpack_to):
+    root = os.path.realpath(unpack_to)
+    target = os.path.realpath(os.path.join(root, member.name))
+    if not _is_within(root, target):
+        raise PackageError("Refusing to unpack %s outside of the package "
+                "directory." % member.name)
+    if member.issym() or member.islnk():
+        base = os.path.dirname(target) if member.issym() else root
+        link = os.path.realpath(os.path.join(base, member.linkname))
+        if not _is_within(root, link):
+            raise PackageError("Refusing to unpack link %s pointing outside "
+                    "of the package directory." % member.name)
+
+def _is_within(root, path):
+    return path == root or path.startswith(root + os.sep)
+
+def _bytecode_is_current(path):
+    try:
+        with open(path + (__debug__ and 'c' or 'o'), 'rb') as f:
+            header = f.read(8)
+        mtime = int(os.stat(path).st_mtime)
+    except (IOError, OSError):
+        return False
+    return (len(header) == 8 and header[:4] == imp.get_magic() and
+            struct.unpack('<I', header[4:])[0] == mtime & 0xFFFFFFFF)
+
+def _compile_file(path):
+    try:
+        py_compile.compile(path, doraise=True)
+    except (py_compile.PyCompileError, IOError, OSError), e:
+        return path, str(e)
+    return path, None
+
+def _split_digest(digest):
+    algo, sep, hexdigest = digest.partition(':')
+    if not sep or not algo or not hexdigest:
+        raise ValueError("invalid digest %s" % digest)
+    return algo.lower(), hexdigest.lower()
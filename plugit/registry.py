@@ -0,0 +1,295 @@
+"""
+A persistent registry of installed applications.
+
+The registry is a SQLite database that records every installed application
+with its version, package digest, install path, declared dependencies and
+file manifest::
+
+    registry = Registry('/var/lib/plugit/registry.db')
+    registry.record(app, '/srv/apps/blog', files=['blog/__init__.py'])
+    registry.get('blog').version
+    registry.dependents('markup')
+    registry.in_range('>= 1.0, < 2.0')
+
+Application names, dependency names, version keys and file paths are
+indexed, so lookups do not scan the whole registry. Versions are stored as
+an encoded `version.Version.sort_key` that sorts like the versions do, so
+version range queries use the compiled intervals of a
+`specifier.SpecifierSet` directly.
+
+Every update runs in its own ``BEGIN IMMEDIATE`` transaction, which takes
+the database write lock up front, so concurrent installers on one host are
+serialized instead of failing halfway through. A writer waits up to
+`timeout` seconds for the lock.
+"""
+from __future__ import with_statement
+
+import os, time, sqlite3, threading
+from contextlib import contextmanager
+
+from plugit import version
+from plugit.app import normalize_depends
+from plugit.exceptions import RegistryError, VersionError
+from plugit.specifier import compile_spec
+
+DEFAULT_TIMEOUT = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    name TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    version_key TEXT NOT NULL,
+    digest TEXT,
+    path TEXT,
+    installed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS apps_version_key ON apps (version_key);
+CREATE TABLE IF NOT EXISTS depends (
+    app TEXT NOT NULL REFERENCES apps (name),
+    dependency TEXT NOT NULL,
+    ver_deps TEXT NOT NULL,
+    PRIMARY KEY (app, dependency)
+);
+CREATE INDEX IF NOT EXISTS depends_dependency ON depends (dependency);
+CREATE TABLE IF NOT EXISTS files (
+    app TEXT NOT NULL REFERENCES apps (name),
+    path TEXT NOT NULL,
+    digest TEXT,
+    PRIMARY KEY (app, path)
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+"""
+
+
+class InstalledApp(object):
+    """
+    A registry record.
+
+    :ivar depends: a dictionary that maps dependency names to version
+        dependency strings
+    """
+    def __init__(self, name, version, digest, path, installed, depends):
+        self.name = name
+        self.version = version
+        self.digest = digest
+        self.path = path
+        self.installed = installed
+        self.depends = depends
+
+    def __repr__(self):
+        return 'InstalledApp(%r, %r)' % (self.name, str(self.version))
+
+
+class Registry(object):
+    """
+    Every thread uses its own database connection, so a registry object
+    can be shared between the worker threads of an `install.InstallEngine`.
+    """
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._transaction() as cursor:
+            for statement in _SCHEMA.split(';'):
+                if statement.strip():
+                    cursor.execute(statement)
+
+    def record(self, app, path=None, files=()):
+        """
+        Records the installation of `app` (an `app.App`), replacing any
+        earlier record of the application.
+
+        :param path: the directory the application was installed to
+        :param files: the installed files, as paths relative to `path` or
+            ``(path, digest)`` pairs
+        """
+        ver = version.to_version(app.version)
+        depends = normalize_depends(app.depends)
+        with self._transaction() as cursor:
+            self._delete(cursor, app.name)
+            cursor.execute("INSERT INTO apps VALUES (?, ?, ?, ?, ?, ?)",
+                    (app.name, str(ver), encode_key(ver.sort_key),
+                        app.digest, path, time.time()))
+            cursor.executemany("INSERT INTO depends VALUES (?, ?, ?)",
+                    [(app.name, dep, ver_deps)
+                        for dep, ver_deps in depends.items()])
+            cursor.executemany("INSERT INTO files VALUES (?, ?, ?)",
+                    [(app.name,) + _file_entry(entry) for entry in files])
+
+    def remove(self, name):
+        """
+        Removes the record of application `name`.
+
+        :return: True if the application was recorded.
+        """
+        with self._transaction() as cursor:
+            return self._delete(cursor, name)
+
+    def get(self, name):
+        """
+        :return: the `InstalledApp` record of `name` or None.
+        """
+        row = self._query("SELECT name, version, digest, path, installed "
+                "FROM apps WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return self._installed_app(row)
+
+    def is_installed(self, name, ver_deps=None):
+        """
+        Checks the registry like `deps.is_installed` checks the file system.
+
+        :raise VersionError: if the installed version does not satisfy
+            `ver_deps`
+        """
+        record = self.get(name)
+        if record is None:
+            return False
+        if not ver_deps or compile_spec(ver_deps).contains(record.version):
+            return True
+        raise VersionError("Application %s installed version %s does not "
+                "satisfy the version dependencies %s."
+                % (name, str(record.version), str(ver_deps)))
+
+    def names(self):
+        return [row[0] for row in
+                self._query("SELECT name FROM apps ORDER BY name")]
+
+    def in_range(self, spec):
+        """
+        :param spec: a version dependency string or a
+            `specifier.SpecifierSet`
+        :return: the names of the installed applications whose versions
+            satisfy `spec`, lowest version first.
+        """
+        if isinstance(spec, basestring):
+            spec = compile_spec(spec)
+        if spec.is_empty:
+            return []
+        clauses = []
+        params = []
+        for low, low_inclusive, high, high_inclusive in spec.intervals:
+            bounds = []
+            if low is not None:
+                bounds.append('version_key %s ?'
+                        % ('>=' if low_inclusive else '>'))
+                params.append(encode_key(low))
+            if high is not None:
+                bounds.append('version_key %s ?'
+                        % ('<=' if high_inclusive else '<'))
+                params.append(encode_key(high))
+            clauses.append(' AND '.join(bounds) or '1')
+        return [row[0] for row in self._query("SELECT name FROM apps "
+                "WHERE (%s) ORDER BY version_key, name"
+                % ') OR ('.join(clauses), params)]
+
+    def dependents(self, name):
+        """
+        :return: a dictionary that maps the names of the installed
+            applications that depend on `name` to their version dependency
+            strings.
+        """
+        return dict(self._query("SELECT app, ver_deps FROM depends "
+                "WHERE dependency = ?", (name,)))
+
+    def files(self, name):
+        """
+        :return: a dictionary that maps the files of application `name` to
+            their digests (None if not recorded).
+        """
+        return dict(self._query("SELECT path, digest FROM files "
+                "WHERE app = ?", (name,)))
+
+    def owner(self, path):
+        """
+        :return: the name of the application that installed the file `path`
+            or None.
+        """
+        row = self._query("SELECT app FROM files WHERE path = ?",
+                (path,)).fetchone()
+        return row and row[0]
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are managed explicitly in _transaction
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                    isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _query(self, sql, params=()):
+        try:
+            return self._connection().execute(sql, params)
+        except sqlite3.Error, e:
+            raise RegistryError("Registry %s query failed: %s"
+                    % (self.path, str(e)))
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error, e:
+            raise RegistryError("Cannot lock registry %s: %s"
+                    % (self.path, str(e)))
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        except sqlite3.Error, e:
+            connection.execute("ROLLBACK")
+            raise RegistryError("Cannot update registry %s: %s"
+                    % (self.path, str(e)))
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        try:
+            connection.execute("COMMIT")
+        except sqlite3.Error, e:
+            connection.execute("ROLLBACK")
+            raise RegistryError("Cannot update registry %s: %s"
+                    % (self.path, str(e)))
+
+    def _delete(self, cursor, name):
+        cursor.execute("DELETE FROM files WHERE app = ?", (name,))
+        cursor.execute("DELETE FROM depends WHERE app = ?", (name,))
+        cursor.execute("DELETE FROM apps WHERE name = ?", (name,))
+        return cursor.rowcount > 0
+
+    def _installed_app(self, row):
+        name, ver, digest, path, installed = row
+        return InstalledApp(name, version.from_string(ver), digest, path,
+                installed, dict(self._query("SELECT dependency, ver_deps "
+                    "FROM depends WHERE app = ?", (name,))))
+
+
+def encode_key(sort_key):
+    """
+    Encodes a `version.Version.sort_key` as a string that sorts like the
+    key, so that the database can compare versions.
+
+    >>> encode_key(version.Version(1, 10).sort_key) > \\
+    ...         encode_key(version.Version(1, 9, 5).sort_key)
+    True
+    >>> encode_key(version.Version(0, 1).sort_key) > \\
+    ...         encode_key(version.Version(2, 0, 0, version.BETA, 1).sort_key)
+    True
+    """
+    is_final, numbers = sort_key
+    return '%d:%s' % (is_final, '.'.join(
+        '-' * 10 if number is None else '%010d' % number
+        for number in numbers))
+
+def _file_entry(entry):
+    if isinstance(entry, basestring):
+        return entry, None
+    return tuple(entry)
@@ -0,0 +1,267 @@
+"""
+Dependency resolution for sets of applications.
+
+`Resolver` builds the transitive dependency graph of a set of root
+applications from their descriptors (`app.App.depends`), picks the highest
+compatible version of every application with backtracking and returns an
+install plan in dependency order.
+
+Descriptors come from a source object that provides two methods:
+
+``versions(name)``
+    the published versions of application `name`, as a `deps.VersionIndex`
+    or an iterable of `version.Version` objects or version strings (empty
+    if the application is unknown)
+``descriptor(name, version)``
+    the `app.App` descriptor of the given `version.Version`
+
+`MemorySource` serves descriptors from memory, `DescriptorSource` fetches
+them from a repository server.
+"""
+from plugit import deps, fetch, version
+from plugit.app import normalize_depends
+from plugit.exceptions import ResolutionError
+from plugit.specifier import compile_spec
+
+
+class Resolution(object):
+    """
+    The result of a successful resolution.
+
+    :ivar versions: a dictionary that maps application names to the chosen
+        `version.Version` objects
+    :ivar plan: the `app.App` descriptors of the chosen versions, every
+        application after its dependencies
+    """
+    def __init__(self, versions, plan):
+        self.versions = versions
+        self.plan = plan
+
+
+class Resolver(object):
+    """
+    Usage::
+
+        resolver = Resolver(MemorySource(apps))
+        for app in resolver.resolve({'blog': '>= 1.0', 'wiki': ''}).plan:
+            install(app)
+
+    Version indexes, descriptors and candidate lists are memoized, so a
+    resolver can be reused for several resolutions against the same source.
+    """
+    def __init__(self, source):
+        self.source = source
+        self._indexes = {}
+        self._dependencies = {}
+        self._candidates = {}
+
+    def resolve(self, roots):
+        """
+        :param roots: a dictionary that maps application names to version
+            dependency strings, or an iterable of names and
+            ``(name, ver_deps)`` pairs
+        :return: a `Resolution`
+        :raise ResolutionError: with an explanation of the last conflict
+            that the search ran into if the roots cannot be satisfied
+        """
+        constraints = {}
+        for name, ver_deps in normalize_depends(roots).items():
+            constraints[name] = ((compile_spec(ver_deps), None),)
+        self._failed = set()
+        self._conflict = None
+        chosen = self._search({}, constraints, frozenset(constraints))
+        if chosen is None:
+            if self._conflict is None:
+                raise ResolutionError("No solution for the dependencies.")
+            raise ResolutionError(self._explain(*self._conflict))
+        return Resolution(chosen, self._plan(chosen))
+
+    def _search(self, chosen, constraints, pending):
+        if not pending:
+            return chosen
+        state = frozenset(chosen.items())
+        if state in self._failed:
+            return None
+
+        # most constrained application first, that fails early
+        candidates = {}
+        for name in pending:
+            candidates[name] = self._matching(name, constraints[name])
+            if not candidates[name]:
+                self._record_conflict(name, constraints[name])
+                self._failed.add(state)
+                return None
+        name = min(pending, key=lambda name: (len(candidates[name]), name))
+
+        for ver in candidates[name]:
+            new_constraints = self._constrain(name, ver, chosen, constraints)
+            if new_constraints is None:
+                continue
+            new_chosen = dict(chosen)
+            new_chosen[name] = ver
+            new_pending = set(pending)
+            new_pending.discard(name)
+            new_pending.update(dep for dep in self._depends(name, ver)
+                    if dep not in new_chosen)
+            result = self._search(new_chosen, new_constraints,
+                    frozenset(new_pending))
+            if result is not None:
+                return result
+        self._failed.add(state)
+        return None
+
+    def _constrain(self, name, ver, chosen, constraints):
+        """
+        Adds the dependencies of `name` `ver` to `constraints`.
+
+        :return: the new constraints, or None if a dependency conflicts with
+            an already chosen version.
+        """
+        new_constraints = dict(constraints)
+        for dep, spec in self._depends(name, ver).items():
+            dep_constraints = new_constraints.get(dep, ()) + (
+                    (spec, (name, ver)),)
+            if dep in chosen and not spec.contains(chosen[dep]):
+                self._record_conflict(dep, dep_constraints, chosen[dep])
+                return None
+            new_constraints[dep] = dep_constraints
+        return new_constraints
+
+    def _matching(self, name, constraints):
+        """
+        :return: the versions of `name` that satisfy all `constraints`,
+            highest first.
+        """
+        key = (name, frozenset(spec.spec_string for spec, _ in constraints))
+        result = self._candidates.get(key)
+        if result is None:
+            first, rest = constraints[0][0], constraints[1:]
+            result = self._index(name).in_range(first)
+            for spec, _ in rest:
+                result = list(spec.filter(result))
+            result.reverse()
+            self._candidates[key] = result
+        return result
+
+    def _index(self, name):
+        index = self._indexes.get(name)
+        if index is None:
+            versions = self.source.versions(name)
+            if not isinstance(versions, deps.VersionIndex):
+                versions = deps.VersionIndex(versions)
+            index = self._indexes[name] = versions
+        return index
+
+    def _depends(self, name, ver):
+        key = (name, ver)
+        result = self._dependencies.get(key)
+        if result is None:
+            depends = self.source.descriptor(name, ver).depends
+            result = self._dependencies[key] = dict(
+                    (dep, compile_spec(ver_deps))
+                    for dep, ver_deps in depends.items())
+        return result
+
+    def _record_conflict(self, name, constraints, chosen_version=None):
+        # overwritten on every failure, so that the error explains the
+        # conflict that exhausted the search rather than an early one that
+        # backtracking got past; formatted only if the resolution fails
+        self._conflict = (name, constraints, chosen_version)
+
+    def _explain(self, name, constraints, chosen_version):
+        requirements = ', '.join('%s (%s)' % (str(spec) or 'any version',
+            'requested' if required_by is None else
+            'required by %s %s' % required_by)
+            for spec, required_by in constraints)
+        available = self._index(name).versions
+        if chosen_version is not None:
+            return ("Conflict for %s: version %s was chosen, but the "
+                    "following is required: %s." % (name, chosen_version,
+                        requirements))
+        elif not available:
+            return "%s is not available: %s." % (name, requirements)
+        return ("No version of %s satisfies: %s. Available versions: %s."
+                % (name, requirements,
+                    ', '.join(str(v) for v in available)))
+
+    def _plan(self, chosen):
+        """
+        Orders the chosen applications so that every application comes
+        after its dependencies (ties are broken by name).
+        """
+        remaining = dict((name, set(self._depends(name, ver)))
+                for name, ver in chosen.items())
+        dependents = dict((name, []) for name in chosen)
+        for name, depends in remaining.items():
+            for dep in depends:
+                dependents[dep].append(name)
+        ready = sorted(name for name, depends in remaining.items()
+                if not depends)
+        plan = []
+        while ready:
+            name = ready.pop(0)
+            plan.append(self.source.descriptor(name, chosen[name]))
+            for dependent in sorted(dependents[name]):
+                remaining[dependent].discard(name)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+            ready.sort()
+        if len(plan) != len(chosen):
+            cycle = sorted(name for name, depends in remaining.items()
+                    if depends)
+            raise ResolutionError("Circular dependencies between %s."
+                    % ', '.join(cycle))
+        return plan
+
+
+class MemorySource(object):
+    """
+    A descriptor source that serves `app.App` objects from memory.
+    """
+    def __init__(self, apps):
+        self._apps = {}
+        for app in apps:
+            ver = version.to_version(app.version)
+            self._apps.setdefault(app.name, {})[ver] = app
+
+    def versions(self, name):
+        return self._apps.get(name, {}).keys()
+
+    def descriptor(self, name, ver):
+        return self._apps[name][ver]
+
+
+class DescriptorSource(object):
+    """
+    A descriptor source that fetches descriptors from the repository at
+    `base_url` (see `fetch.fetch_descriptor`), memoizing them.
+
+    :param available: a dictionary that maps application names to the
+        versions published in the repository. The versions of other
+        applications are taken from the ``versions`` list of their latest
+        descriptor, or are only the latest version if it has none.
+    """
+    def __init__(self, base_url, available=None, pool=None, cache=None):
+        self.base_url = base_url
+        self.available = dict(available or {})
+        self.pool = pool
+        self.cache = cache
+        self._descriptors = {}
+
+    def versions(self, name):
+        if name not in self.available:
+            latest = self._fetch(name)
+            ver = version.to_version(latest.version)
+            self._descriptors[(name, ver)] = latest
+            self.available[name] = latest.versions or [ver]
+        return self.available[name]
+
+    def descriptor(self, name, ver):
+        key = (name, ver)
+        if key not in self._descriptors:
+            self._descriptors[key] = self._fetch(name, str(ver))
+        return self._descriptors[key]
+
+    def _fetch(self, name, ver=None):
+        return fetch.fetch_descriptor(self.base_url, name, ver,
+                pool=self.pool, cache=self.cache)
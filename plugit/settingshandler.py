@@ -7,17 +7,42 @@ automatically.
 
 Based on lib2to3 tests. Some insight of lib2to3 workings came from Pythoscope
 source.
+
+Parsing goes through a `SettingsParser` that is shared by all updaters (see
+`default_parser`). It keeps one lib2to3 driver and caches parsed trees by
+content hash, so parsing the same source again costs a tree copy. With
+``fast=True`` an updater only tokenizes the source and parses just the
+statements it edits.
+
+Updaters remember where the statements they edit came from in the source,
+so `SettingsStringUpdater.result` splices the edited statements into the
+original text instead of serializing the whole tree, and
+`SettingsFileUpdater.save` replaces files atomically.
+
+`update_files` applies updates to many files on a process pool, optionally
+all or nothing.
 """
 
 from __future__ import with_statement
 
+import os, hashlib, tempfile, threading, tokenize
+from StringIO import StringIO
+
 from lib2to3 import pygram, pytree
 from lib2to3.pgen2 import driver
 from lib2to3.pygram import python_symbols as symbols
 from lib2to3.pgen2 import token
 from lib2to3.pytree import Node, Leaf
 
+from plugit import instrument
 from plugit.exceptions import SettingsError
+from plugit.lru import LRUCache
+from plugit.package import link_or_copy
+
+PARSE_CACHE_SIZE = 256
+
+# leaf type of top-level statements that are kept as source text
+UNPARSED = token.N_TOKENS
 
 # node factories
 
@@ -32,27 +57,129 @@ AssignStatement = lambda name, value: Node(symbols.expr_stmt,
          Newline()])
 
 
+class SettingsParser(object):
+    """
+    A thread-safe lib2to3 parser that keeps its grammar and driver between
+    parses and caches the parsed trees of the most recently parsed sources.
+    Callers get their own copy of a cached tree, so they can modify it.
+    """
+    def __init__(self, cache_size=PARSE_CACHE_SIZE):
+        self._driver = driver.Driver(pygram.python_grammar, pytree.convert)
+        self._lock = threading.Lock()
+        self._cache = LRUCache(cache_size)
+
+    def parse_string(self, source):
+        """
+        :return: the node tree of `source`
+        :raise ParseError: if `source` is not valid Python
+        """
+        key = hashlib.sha1(source).digest()
+        tree = self._cache.get(key)
+        if tree is None:
+            with self._lock:
+                tree = self._driver.parse_string(source)
+            self._cache.put(key, tree)
+        return tree.clone()
+
+    def parse_file(self, filename):
+        with open(filename) as f:
+            return self.parse_string(f.read())
+
+
+_default_parser = None
+_default_parser_lock = threading.Lock()
+
+def default_parser():
+    """
+    Returns the process-wide parser that is used when no parser is given
+    explicitly.
+    """
+    global _default_parser
+    with _default_parser_lock:
+        if _default_parser is None:
+            _default_parser = SettingsParser()
+        return _default_parser
+
+
+class UnparsedStatement(Leaf):
+    """
+    A top-level statement that is kept as source text (including the
+    comments and whitespace before it) until it has to be edited.
+
+    :ivar names: the variables that the statement assigns to
+    :ivar start: the offset of the statement in the source
+    """
+    def __init__(self, text, names=(), start=None):
+        Leaf.__init__(self, UNPARSED, text)
+        self.names = names
+        self.start = start
+
+
 class SettingsStringUpdater(object):
     """
     Base class that implements node tree parsing and updating.
     Handles strings.
     """
-    def __init__(self, source):
+    def __init__(self, source, parser=None, fast=False):
         """
         Parses `source` to a node tree.
 
+        With `fast`, the source is only split into top-level statements with
+        `tokenize` and a statement is parsed when it is edited. Syntax
+        errors in the statements that are not edited go unnoticed then.
+
         :param source: a string with Python source
+        :param parser: the `SettingsParser` to use, `default_parser()` by
+            default
+        :param fast: parse only the statements that are edited
         """
-        drv = driver.Driver(pygram.python_grammar, pytree.convert)
-        tree = self._parse_func(drv)(source)
+        self.parser = parser or default_parser()
+        source = self._read(source)
+        if fast:
+            if source and not source.endswith('\n'):
+                source += '\n'
+            statements = []
+            start = 0
+            for text, names in split_statements(source):
+                statements.append(UnparsedStatement(text, names, start))
+                start += len(text)
+            tree = Node(symbols.file_input, statements)
+        else:
+            tree = self.parser.parse_string(source)
         if not isinstance(tree, Node):
             raise SettingsError('Invalid settings: no nodes')
         self.root = tree
+        self.source = source
         self.changed = False
+        self._index = None
+        self._line_offsets = None
+        # original spans of parsed statements and of edited statements by
+        # node id (nodes are not hashable), appended statements in order
+        self._spans = {}
+        self._edits = {}
+        self._appended = []
+        self._appended_ids = set()
+        self._spliceable = True
 
     @property
     def result(self):
-        return str(self.root)
+        """
+        The updated source. Edited statements are spliced into the original
+        source, so changes to `root` that are not made with `update` are
+        only reflected if the whole tree has been serialized anyway.
+        """
+        if not self._spliceable:
+            return str(self.root)
+        pieces = []
+        position = 0
+        for start, end, node in sorted(self._edits.values(),
+                key=lambda edit: edit[0]):
+            pieces.append(self.source[position:start])
+            pieces.append(str(node))
+            position = end
+        pieces.append(self.source[position:])
+        pieces.extend(str(node) for node in self._appended)
+        return ''.join(pieces)
 
     def update(self, new_settings={}, append_settings={},
             create_if_missing=False):
@@ -69,62 +196,427 @@ class SettingsStringUpdater(object):
         :param create_if_missing: if any configuration variable given in
             `append_settings` is missing, create it, otherwise throw
         """
-        node_names = new_settings.keys() + append_settings.keys()
-        node_dict = find_assignment_nodes(self.root, node_names)
+        with instrument.span('settings_update') as span:
+            span.add('settings', len(new_settings) + len(append_settings))
+            self._update(new_settings, append_settings, create_if_missing)
+
+    def _update(self, new_settings, append_settings, create_if_missing):
+        node_dict = self._find(new_settings.keys() + append_settings.keys())
         for name, value in new_settings.iteritems():
             if name in node_dict:
                 raise SettingsError("Variable '%s' already present in settings"
                         % name)
-            self.root.append_child(AssignStatement(name, value))
-            self.changed = True
+            self._append_assignment(name, value)
         for name, value in append_settings.iteritems():
             if name not in node_dict:
                 if create_if_missing:
-                    self.root.append_child(AssignStatement(name, value))
-                    self.changed = True
+                    self._append_assignment(name, value)
                 else:
                     raise SettingsError("Variable '%s' missing from settings"
                             % name)
             else:
+                self._track_edit(node_dict[name])
                 append_to_assignment_node(node_dict[name], value)
                 self.changed = True
 
-    def _parse_func(self, drv):
-        return drv.parse_string
+    def _read(self, source):
+        return source
+
+    def _assignments(self):
+        """
+        The index of top-level assignments, built in one pass over the tree
+        on first use and kept up to date by `update`.
+        """
+        if self._index is None:
+            self._index = assignment_index(self.root)
+        return self._index
+
+    def _find(self, names):
+        """
+        :return: a dictionary that maps the names in `names` that are
+            assigned to in the settings to their ``expr_stmt`` nodes,
+            parsing unparsed statements as needed.
+        """
+        index = self._assignments()
+        result = {}
+        for name in names:
+            node = index.get(name)
+            if isinstance(node, UnparsedStatement):
+                self._parse_statement(node)
+                node = index[name]
+            if node is not None:
+                result[name] = node
+        return result
+
+    def _parse_statement(self, leaf):
+        statement = self.parser.parse_string(leaf.value).children[0]
+        statement.remove()
+        leaf.replace(statement)
+        self._spans[id(statement)] = (leaf.start,
+                leaf.start + len(leaf.value))
+        _index_statement(statement, self._index)
+
+    def _append_assignment(self, name, value):
+        node = AssignStatement(name, value)
+        self.root.append_child(node)
+        self._appended.append(node)
+        self._appended_ids.add(id(node))
+        self._assignments()[name] = node
+        self.changed = True
+
+    def _track_edit(self, node):
+        """
+        Records the span in the source of the top-level statement that
+        contains `node` before the statement is edited.
+        """
+        while node.parent is not self.root:
+            node = node.parent
+        key = id(node)
+        if (key in self._edits or key in self._appended_ids
+                or not self._spliceable):
+            return
+        span = self._spans.get(key) or self._find_span(node)
+        if span is None:
+            # give up on splicing, serialize the whole tree instead
+            self._spliceable = False
+            return
+        self._edits[key] = span + (node,)
+
+    def _find_span(self, statement):
+        if self._line_offsets is None:
+            self._line_offsets = [0]
+            for line in self.source.splitlines(True):
+                self._line_offsets.append(self._line_offsets[-1] + len(line))
+        leaf = statement.leaves().next()
+        text = str(statement)
+        start = (self._line_offsets[leaf.lineno - 1] + leaf.column
+                - len(leaf.prefix))
+        if self.source[start:start + len(text)] != text:
+            return None
+        return start, start + len(text)
 
 
 class SettingsFileUpdater(SettingsStringUpdater):
     """
     Handles settings files.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, parser=None, fast=False):
         """
         Parses the contents of `filename` to a node tree.
 
         :param filename: a file with Python source
         """
-        super(SettingsFileUpdater, self).__init__(filename)
+        super(SettingsFileUpdater, self).__init__(filename, parser, fast)
         self.filename = filename
 
-    def save(self, filename=None):
+    def save(self, filename=None, compare=False):
         """
         Saves the modified settings back to either the original file
         or a new file. If the node tree is unmodified and no new file name
         given, takes no action.
 
+        The file is replaced atomically: the settings are written to a
+        temporary file in the same directory, synced to disk and renamed
+        over the file, so it is never left half-written.
+
         :param filename: the new file name to save the modified settings to
+        :param compare: leave the file alone if its content already equals
+            the settings (compared by SHA-1 digest)
+        :return: True if the file was written
         """
         if filename is None and not self.changed:
             return False
 
         if filename is None:
             filename = self.filename
-        with open(filename, 'w') as f:
-            f.write(self.result)
-        return True
+        with instrument.span('settings_save', filename=filename) as span:
+            result = self.result
+            if (compare and
+                    _file_digest(filename) == hashlib.sha1(result).digest()):
+                return False
+            atomic_write(filename, result)
+            span.add('bytes_written', len(result))
+            return True
+
+    def _read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+
+class BatchReport(object):
+    """
+    :ivar changed: names of the files that were updated
+    :ivar unchanged: names of the files that the updates did not change
+    :ivar failed: a dictionary that maps names of the files that could not
+        be updated to `SettingsError` exceptions
+    :ivar rolled_back: True if an all-or-nothing batch failed and no file
+        was changed
+    """
+    def __init__(self):
+        self.changed = []
+        self.unchanged = []
+        self.failed = {}
+        self.rolled_back = False
+
+
+def update_files(updates, processes=None, all_or_nothing=False, fast=False):
+    """
+    Updates many settings files on a pool of `processes` worker processes
+    (one per CPU by default). Every file is parsed once, gets all of its
+    updates and is saved once.
+
+    Usage::
+
+        update = {'new_settings': {'DEBUG': False}}
+        report = update_files([(filename, update) for filename in files])
+
+    In `all_or_nothing` mode, the workers only write the updated settings
+    to temporary files. The files are replaced when all of them have been
+    updated successfully, otherwise none is, and a failure while replacing
+    them restores the files that were already replaced.
+
+    :param updates: an iterable of ``(filename, update)`` pairs, where
+        `update` is a dictionary of `SettingsStringUpdater.update` keyword
+        arguments; the updates of a file are applied in order
+    :param fast: parse only the statements that are edited (see
+        `SettingsStringUpdater`)
+    :return: a `BatchReport`
+    """
+    files = []
+    file_updates = {}
+    for filename, update in updates:
+        if filename not in file_updates:
+            files.append(filename)
+            file_updates[filename] = []
+        file_updates[filename].append(update)
+    tasks = [(filename, file_updates[filename], fast, all_or_nothing)
+            for filename in files]
+
+    # slow to import, and not needed by single file updates
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or len(tasks) < 2 * processes:
+        results = map(_update_file, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_update_file, tasks,
+                    max(1, len(tasks) // (4 * processes)))
+        finally:
+            pool.close()
+            pool.join()
+
+    report = BatchReport()
+    prepared = []
+    for filename, changed, tmp_path, error in results:
+        if error is not None:
+            report.failed[filename] = error
+        elif changed:
+            report.changed.append(filename)
+            if tmp_path is not None:
+                prepared.append((filename, tmp_path))
+        else:
+            report.unchanged.append(filename)
+    if all_or_nothing:
+        if report.failed:
+            for filename, tmp_path in prepared:
+                os.remove(tmp_path)
+            report.rolled_back = True
+        else:
+            try:
+                _replace_all(prepared)
+            except SettingsError, e:
+                report.failed[e.filename] = e
+                report.rolled_back = True
+        if report.rolled_back:
+            report.unchanged.extend(report.changed)
+            report.changed = []
+    return report
+
+def _update_file(task):
+    filename, updates, fast, prepare = task
+    try:
+        updater = SettingsFileUpdater(filename, fast=fast)
+        for update in updates:
+            updater.update(**update)
+        if not updater.changed:
+            return filename, False, None, None
+        if prepare:
+            return filename, True, _write_temp(filename, updater.result), None
+        updater.save()
+        return filename, True, None, None
+    except SettingsError, e:
+        return filename, False, None, e
+    except Exception, e:
+        # parser and I/O errors do not survive pickling, report them as
+        # settings errors
+        return filename, False, None, SettingsError("%s: %s: %s"
+                % (filename, e.__class__.__name__, str(e)))
+
+def _replace_all(prepared):
+    """
+    Replaces the files with the prepared temporary files, restoring the
+    replaced files if one fails.
+    """
+    backups = []
+    try:
+        for filename, tmp_path in prepared:
+            backup = tmp_path + '.orig'
+            link_or_copy(filename, backup)
+            backups.append((filename, backup))
+            os.rename(tmp_path, filename)
+    except (IOError, OSError), e:
+        error = SettingsError("Cannot replace %s: %s" % (filename, str(e)))
+        error.filename = filename
+        for filename, backup in reversed(backups):
+            os.rename(backup, filename)
+            if os.path.exists(backup):
+                # rename() does nothing if both are links to the same file
+                os.remove(backup)
+        for filename, tmp_path in prepared:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise error
+    for filename, backup in backups:
+        os.remove(backup)
+    for directory in set(os.path.dirname(os.path.abspath(filename))
+            for filename, tmp_path in prepared):
+        _sync_directory(directory)
+
+def atomic_write(filename, data):
+    """
+    Replaces the content of `filename` with `data` atomically, keeping the
+    permissions of an existing file.
+    """
+    tmp_path = _write_temp(filename, data)
+    try:
+        os.rename(tmp_path, filename)
+    except:
+        os.remove(tmp_path)
+        raise
+    _sync_directory(os.path.dirname(os.path.abspath(filename)))
+
+def _write_temp(filename, data):
+    """
+    Writes `data` to a temporary file next to `filename` and syncs it.
 
-    def _parse_func(self, drv):
-        return drv.parse_file
+    :return: the path of the temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+            prefix='.%s.' % os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filename):
+            os.chmod(tmp_path, os.stat(filename).st_mode & 07777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0666 & ~umask)
+    except:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+def _sync_directory(directory):
+    # makes the rename durable, not possible on all platforms
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _file_digest(filename):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    digest = hashlib.sha1()
+    with f:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def split_statements(source):
+    """
+    Splits `source` into its top-level statements with `tokenize`, without
+    building a node tree.
+
+    :return: a list of ``(text, names)`` pairs, where `text` is the source of
+        a statement with the comments and blank lines before it and `names`
+        the variables that a ``NAME = value`` statement assigns to. The
+        texts add up to `source`, the last one holds the text after the last
+        statement.
+    """
+    offsets = [0]
+    for line in source.splitlines(True):
+        offsets.append(offsets[-1] + len(line))
+    result = []
+    start = 0
+    depth = 0
+    names = []
+    # end offset of a statement that ends unless a block follows
+    pending = None
+    first = True
+    started = False
+    candidate = None
+    try:
+        for tok_type, tok_string, begin, end, _ in tokenize.generate_tokens(
+                StringIO(source).readline):
+            if tok_type == tokenize.INDENT:
+                if depth == 0:
+                    pending = None
+                depth += 1
+            elif tok_type == tokenize.DEDENT:
+                depth -= 1
+                if depth == 0:
+                    pending = offsets[begin[0] - 1]
+            elif tok_type in (tokenize.COMMENT, tokenize.NL) or depth:
+                pass
+            elif pending is not None and tok_type != tokenize.ENDMARKER:
+                result.append((source[start:pending], tuple(names)))
+                start, pending, names = pending, None, []
+                first = True
+                started = False
+            if depth or tok_type in (tokenize.COMMENT, tokenize.NL,
+                    tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+            if tok_type == tokenize.NEWLINE:
+                pending = offsets[end[0] - 1] + end[1]
+                candidate = None
+                continue
+            # targets start a statement or follow the '=' after a target
+            if tok_type == tokenize.NAME and first:
+                candidate = tok_string
+                first = False
+            elif tok_type == tokenize.OP and tok_string == '=' and candidate:
+                names.append(candidate)
+                candidate = None
+                first = True
+            else:
+                candidate = None
+                first = tok_type == tokenize.OP and tok_string == ';'
+            started = True
+    except (tokenize.TokenError, IndentationError), e:
+        raise SettingsError("Invalid settings: %s" % str(e))
+    if pending is None and started:
+        # the last statement is not terminated by a newline
+        pending = len(source)
+    if pending is not None:
+        result.append((source[start:pending], tuple(names)))
+        start = pending
+    result.append((source[start:], ()))
+    return result
 
 
 def find_assignment_nodes(tree, names):
@@ -136,18 +628,41 @@ def find_assignment_nodes(tree, names):
     :param tree: the node tree
     :return: a dictionary with name/node mapping
     """
-    name_patterns = [(pytree.LeafPattern(token.NAME, name),) for name in names]
-    lhs_pattern = pytree.NodePattern(symbols.expr_stmt,
-            (pytree.WildcardPattern(name_patterns, min=1, max=1),
-                pytree.LeafPattern(token.EQUAL, '='),
-                pytree.WildcardPattern()), name='match')
-    m = {}
-    result = {}
+    index = assignment_index(tree)
+    return dict((name, index[name]) for name in names
+            if isinstance(index.get(name), Node))
+
+
+def assignment_index(tree):
+    """
+    Indexes the top-level assignment statements of node tree `tree` in a
+    single pass over its children. Every target of multi-target
+    (``A = B = value``) and ``;``-separated assignments is indexed. The
+    Python 2 grammar has no annotated assignments.
+
+    :return: a dictionary that maps variable names to their ``expr_stmt``
+        nodes (or `UnparsedStatement` leaves); the last assignment to a
+        name wins.
+    """
+    index = {}
     for node in tree.children:
-        if (node.type == symbols.simple_stmt
-                and lhs_pattern.match(node.children[0], m)):
-            result[m['match'].children[0].value] = m['match']
-    return result
+        _index_statement(node, index)
+    return index
+
+
+def _index_statement(node, index):
+    if isinstance(node, UnparsedStatement):
+        for name in node.names:
+            index[name] = node
+    elif node.type == symbols.simple_stmt:
+        for child in node.children:
+            _index_statement(child, index)
+    elif node.type == symbols.expr_stmt:
+        children = node.children
+        if all(leaf.type == token.EQUAL for leaf in children[1::2]):
+            for target in children[:-1:2]:
+                if target.type == token.NAME:
+                    index[target.value] = node
 
 
 def append_to_assignment_node(node, value):
@@ -161,7 +676,7 @@ def append_to_assignment_node(node, value):
     """
 
     assert node.type == symbols.expr_stmt
-    atom = node.children[2]
+    atom = node.children[-1]
     if atom.type != symbols.atom:
         raise SettingsError("Not a container definition (expression's third "
                 "node is not an atom): %s\nCan append only to containers "
@@ -229,9 +744,9 @@ def _append_to_dict(node, value, prefix, setting):
 
 def _find_whitespace(l):
     """ Discover whitespace used in container definition. """
-    l = l.get_prev_sibling()
+    l = l.prev_sibling
     ret = ''
     while l and l.type != token.COMMA:
         ret = l.prefix
-        l = l.get_prev_sibling()
+        l = l.prev_sibling
     return ret
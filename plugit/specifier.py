@@ -0,0 +1,192 @@
+"""
+Compiled version dependency specifications.
+
+A dependency string like ``">= 1.0, < 2.0, != 1.3"`` is compiled once into a
+`SpecifierSet`: the intersection of its clauses, normalized into a sorted
+list of disjoint version intervals. Checking a version is then a binary
+search over the intervals instead of a regex pass per clause, and compiled
+sets are cached per distinct string (see `compile_spec`).
+
+Intervals are bounded by `version.Version.sort_key` values, so they follow
+the ordering of `Version` objects, where subreleases rank below releases.
+"""
+import re, bisect, operator
+
+from plugit import version
+from plugit.exceptions import VersionError
+from plugit.lru import LRUCache
+
+CMP_OP_MAP = {
+    '<':  operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '>':  operator.gt,
+}
+
+# ",?\s*(?=%s)" % "|".join(CMP_OP_MAP.keys())
+DEP_SPLIT_RE = re.compile(r',?\s*(?=<|<=|!=|==|>=|>)')
+VER_DEP_RE = re.compile(r'(?P<cmp><|<=|!=|==|>=|>)\s*(?P<ver>[-a-z0-9. ]+)')
+
+SPEC_CACHE_SIZE = 1024
+
+# an interval is a (low, low_inclusive, high, high_inclusive) tuple of
+# sort keys, None stands for an unbounded end
+_ALL = (None, True, None, True)
+
+
+class Specifier(object):
+    """
+    A single ``<operator> <version>`` clause.
+    """
+    def __init__(self, op, ver):
+        if op not in CMP_OP_MAP:
+            raise VersionError("Unknown version comparison operator '%s'."
+                    % op)
+        self.op = op
+        self.version = ver
+
+    def contains(self, ver):
+        return CMP_OP_MAP[self.op](ver, self.version)
+
+    def intervals(self):
+        key = self.version.sort_key
+        return {
+            '<':  [(None, True, key, False)],
+            '<=': [(None, True, key, True)],
+            '==': [(key, True, key, True)],
+            '!=': [(None, True, key, False), (key, False, None, True)],
+            '>=': [(key, True, None, True)],
+            '>':  [(key, False, None, True)],
+        }[self.op]
+
+    def __str__(self):
+        return '%s %s' % (self.op, self.version)
+
+    def __repr__(self):
+        return 'Specifier(%r, %r)' % (self.op, self.version)
+
+
+class SpecifierSet(object):
+    """
+    A dependency specification: versions that satisfy all of its clauses.
+
+    >>> spec = SpecifierSet('>= 1.0, < 2.0, != 1.3')
+    >>> spec.contains(version.Version(1, 2))
+    True
+    >>> version.Version(1, 3) in spec
+    False
+    >>> [str(v) for v in spec.filter([version.Version(0, 9),
+    ...     version.Version(1, 5), version.Version(2, 0)])]
+    ['1.5']
+
+    An empty specification matches every version.
+    """
+    def __init__(self, spec_string=''):
+        self.spec_string = spec_string
+        self.specifiers = _parse(spec_string)
+        intervals = [_ALL]
+        for specifier in self.specifiers:
+            intervals = _intersect(intervals, specifier.intervals())
+        self.intervals = intervals
+        self._lows = [interval[0] for interval in intervals]
+
+    def contains(self, ver):
+        """
+        Checks `ver` with a binary search over the intervals.
+        """
+        key = ver.sort_key
+        index = bisect.bisect_right(self._lows, key) - 1
+        if index < 0:
+            return False
+        low, low_inclusive, high, high_inclusive = self.intervals[index]
+        if low == key and not low_inclusive:
+            return False
+        if high is None:
+            return True
+        return key < high or (key == high and high_inclusive)
+
+    __contains__ = contains
+
+    def filter(self, versions):
+        """
+        :return: a generator of the versions in `versions` that satisfy the
+            specification.
+        """
+        contains = self.contains
+        return (ver for ver in versions if contains(ver))
+
+    @property
+    def is_empty(self):
+        """
+        True if no version can satisfy the specification.
+        """
+        return not self.intervals
+
+    def __str__(self):
+        return ', '.join(str(specifier) for specifier in self.specifiers)
+
+    def __repr__(self):
+        return 'SpecifierSet(%r)' % str(self)
+
+
+_spec_cache = LRUCache(SPEC_CACHE_SIZE)
+
+def compile_spec(spec_string):
+    """
+    :return: the `SpecifierSet` for `spec_string`, from a cache of recently
+        used specifications.
+    """
+    spec = _spec_cache.get(spec_string)
+    if spec is None:
+        spec = SpecifierSet(spec_string)
+        _spec_cache.put(spec_string, spec)
+    return spec
+
+def _parse(spec_string):
+    specifiers = []
+    if not spec_string or not spec_string.strip():
+        return specifiers
+    for chunk in DEP_SPLIT_RE.split(spec_string.strip()):
+        match = VER_DEP_RE.match(chunk)
+        if not match:
+            raise VersionError("Invalid version dependency '%s'."
+                    % spec_string)
+        specifiers.append(Specifier(match.group('cmp'),
+            version.from_string(match.group('ver').strip())))
+    return specifiers
+
+def _intersect(intervals_a, intervals_b):
+    result = []
+    for a in intervals_a:
+        for b in intervals_b:
+            low = _max_low(a[:2], b[:2])
+            high = _min_high(a[2:], b[2:])
+            if _nonempty(low, high):
+                result.append(low + high)
+    result.sort()
+    return result
+
+def _max_low(a, b):
+    if a[0] is None:
+        return b
+    if b[0] is None:
+        return a
+    if a[0] == b[0]:
+        return a[0], a[1] and b[1]
+    return max(a, b)
+
+def _min_high(a, b):
+    if a[0] is None:
+        return b
+    if b[0] is None:
+        return a
+    if a[0] == b[0]:
+        return a[0], a[1] and b[1]
+    return min(a, b)
+
+def _nonempty(low, high):
+    if low[0] is None or high[0] is None:
+        return True
+    return low[0] < high[0] or (low[0] == high[0] and low[1] and high[1])
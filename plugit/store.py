@@ -0,0 +1,255 @@
+"""
+Content-addressed local package store.
+
+Packages are stored under their ``algo:hexdigest`` digest (the format that
+`package.is_valid` understands), so a package that has been fetched once
+never has to be downloaded again, be it for reinstalling or rolling back.
+
+Blobs are written to a temporary file inside the store and renamed into
+place only after their digest has been verified, so several installers can
+share a store without locking: readers either see a complete, valid blob or
+nothing. Partial downloads are kept under a stable, locked name so that an
+interrupted download can be resumed. `PackageStore.gc` bounds the store by
+total size or age.
+"""
+from __future__ import with_statement
+
+import os, re, time, errno, shutil, tempfile
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TMP_DIR = 'tmp'
+LOCK_SUFFIX = '.lock'
+
+DIGEST_RE = re.compile(r'^(?P<algo>[a-z0-9_]+):(?P<hexdigest>[0-9a-f]+)$')
+
+
+class PackageStore(object):
+    """
+    Usage::
+
+        store = PackageStore('/var/lib/plugit/packages')
+        filename, verifier = fetch.fetch_package(url, digest, store=store)
+    """
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, TMP_DIR)
+        _makedirs(self.tmp_dir)
+
+    def path(self, digest):
+        """
+        :return: the path of the blob for `digest` (that may not exist).
+        """
+        algo, hexdigest = _parse_digest(digest)
+        return os.path.join(self.root, algo, hexdigest[:2], hexdigest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def checkout(self, digest, filename):
+        """
+        Makes the blob for `digest` available as `filename`, by hard link if
+        possible and by copying otherwise. Marks the blob as recently used.
+
+        :return: True if the blob was present, False otherwise.
+        """
+        path = self.path(digest)
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            os.link(path, filename)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # removed by a concurrent gc
+                return False
+            try:
+                shutil.copyfile(path, filename)
+            except IOError, e:
+                if e.errno == errno.ENOENT:
+                    return False
+                raise
+        return True
+
+    def temp_file(self):
+        """
+        Creates a temporary file inside the store for a blob that is being
+        fetched.
+
+        :return: ``(file object, path)`` tuple.
+        """
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.part')
+        return os.fdopen(fd, 'wb'), path
+
+    @contextmanager
+    def partial_file(self, digest):
+        """
+        Yields the path a blob is downloaded to before it is committed. The
+        path is stable for a given `digest`, so that an interrupted download
+        can be resumed later, and locked so that only one process writes to
+        it. If the lock is held by another process, or locking is not
+        available, a unique temporary path is yielded instead and removed if
+        the block fails.
+
+        Files kept next to the path by the download (such as its state) are
+        removed once the path itself is gone, i.e. when the blob has been
+        committed or discarded. The lock file is removed in any case.
+        """
+        algo, hexdigest = _parse_digest(digest)
+        path = os.path.join(self.tmp_dir, '%s-%s.part' % (algo, hexdigest))
+        lock_path = path + LOCK_SUFFIX
+        lock = _try_lock(lock_path)
+        if lock is None:
+            f, path = self.temp_file()
+            f.close()
+            try:
+                yield path
+            except:
+                _remove(path)
+                raise
+            finally:
+                _remove_sidecars(path)
+        else:
+            try:
+                yield path
+            finally:
+                _remove_sidecars(path)
+                # still locked, see _try_lock
+                _remove(lock_path)
+                lock.close()
+
+    def commit(self, digest, temp_path):
+        """
+        Atomically moves the verified blob `temp_path` (created with
+        `temp_file`) into the store under `digest`.
+
+        :return: the path of the blob.
+        """
+        path = self.path(digest)
+        _makedirs(os.path.dirname(path))
+        os.chmod(temp_path, 0444)
+        os.rename(temp_path, path)
+        return path
+
+    def add(self, digest, package_file):
+        """
+        Copies an existing, verified `package_file` into the store.
+
+        :return: the path of the blob.
+        """
+        f, temp_path = self.temp_file()
+        try:
+            with f:
+                with open(package_file, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+            return self.commit(digest, temp_path)
+        except:
+            _remove(temp_path)
+            raise
+
+    def gc(self, max_size=None, max_age=None):
+        """
+        Removes blobs that have not been used for `max_age` seconds and then
+        the least recently used blobs until the store holds at most
+        `max_size` bytes. Abandoned temporary files older than `max_age` are
+        removed as well.
+
+        :return: the number of bytes freed.
+        """
+        now = time.time()
+        blobs = []
+        total = 0
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            is_tmp = dirpath == self.tmp_dir
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if max_age is not None and now - st.st_mtime > max_age:
+                    if is_tmp and filename.endswith(LOCK_SUFFIX):
+                        # in use as long as someone holds the lock
+                        lock = _try_lock(path)
+                        if lock is None:
+                            continue
+                        _remove(path)
+                        lock.close()
+                    elif _remove(path):
+                        freed += st.st_size
+                elif not is_tmp:
+                    blobs.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+        if max_size is not None and total > max_size:
+            blobs.sort()
+            for _, size, path in blobs:
+                if _remove(path):
+                    freed += size
+                total -= size
+                if total <= max_size:
+                    break
+        return freed
+
+
+def _parse_digest(digest):
+    match = DIGEST_RE.match(digest.lower())
+    if not match:
+        raise ValueError("Invalid digest '%s', expected algo:hexdigest"
+                % digest)
+    return match.group('algo', 'hexdigest')
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _try_lock(path):
+    """
+    :return: the open lock file, or None if the lock is held elsewhere or
+        locking is not available
+
+    A lock file is removed while it is locked, so a lock taken on a file
+    that has since been removed (or replaced) is not a lock on `path`.
+    """
+    if fcntl is None:
+        return None
+    while True:
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                f.close()
+                raise
+        f.close()
+
+def _remove_sidecars(path):
+    if os.path.exists(path):
+        return
+    prefix = os.path.basename(path) + '.'
+    dirname = os.path.dirname(path)
+    for filename in os.listdir(dirname):
+        if filename.startswith(prefix) and not filename.endswith(LOCK_SUFFIX):
+            _remove(os.path.join(dirname, filename))
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
@@ -34,6 +34,7 @@ versions, e.g.::
 import re
 
 from plugit.exceptions import VersionError
+from plugit.lru import LRUCache
 
 PRE_ALPHA, ALPHA, BETA, PRERELEASE, FINAL = range(5)
 
@@ -62,10 +63,10 @@ class Version(object):
     """
     Class for representing package versions.
 
-    `Version` objects have human-readable string representation and defined
-    ordering. When comparing versions, non-release versions (i.e. versions
-    that *have subrelease numbers*) have less priority than release versions,
-    e.g.::
+    `Version` objects are immutable, have human-readable string
+    representation and defined ordering. When comparing versions,
+    non-release versions (i.e. versions that *have subrelease numbers*) have
+    less priority than release versions, e.g.::
 
     >>> v = Version(1, 2, 3, BETA, 1)
     >>> v2 = Version(0, 1)
@@ -98,70 +99,95 @@ class Version(object):
     >>> print v
     1.2.3 beta 1
     """
+    __slots__ = ('major', 'minor', 'patch', 'subrelease', 'subrellevel',
+            '_key', '_hash')
+
     def __init__(self, major, minor, patch=None, subrelease=None,
             subrellevel=None):
-        self.major = _to_int(major, "Major number")
-        self.minor = _to_int(minor, "Minor number")
-        self.patch = _to_int_or_none(patch, "Patch number")
-        self.subrelease = _to_int_or_none(subrelease, "Subrelease number")
-        if (self.subrelease is not None and
-                self.subrelease not in SUBRELEASE_DICT):
+        major = _to_int(major, "Major number")
+        minor = _to_int(minor, "Minor number")
+        patch = _to_int_or_none(patch, "Patch number")
+        subrelease = _to_int_or_none(subrelease, "Subrelease number")
+        if subrelease is not None and subrelease not in SUBRELEASE_DICT:
             raise SubreleaseError()
-        if self.subrelease == PRE_ALPHA and subrellevel is not None:
+        if subrelease == PRE_ALPHA and subrellevel is not None:
             raise VersionError("Pre-alpha release can have no subrelease "
                     "level number.")
-        self.subrellevel = _to_int_or_none(subrellevel,
+        subrellevel = _to_int_or_none(subrellevel,
                 "Subrelease level number")
 
+        as_tuple = (major, minor, patch, subrelease, subrellevel)
+        _set = object.__setattr__
+        for label, value in zip(self.__slots__, as_tuple):
+            _set(self, label, value)
+        # non-release versions are always lower priority
+        _set(self, '_key', (subrelease is None, as_tuple))
+        _set(self, '_hash', hash(as_tuple))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Version objects are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Version objects are immutable.")
+
+    def __reduce__(self):
+        return (Version, self.as_tuple())
+
     def __str__(self):
-        format = '%(major)s.%(minor)s'
-        params = self.__dict__.copy()
+        result = '%s.%s' % (self.major, self.minor)
         if self.patch is not None:
-            format += '.%(patch)s'
+            result += '.%s' % self.patch
         if self.subrelease is not None:
-            format += ' %(subrelease)s'
-            params['subrelease'] = SUBRELEASE_DICT[self.subrelease]
+            result += ' %s' % SUBRELEASE_DICT[self.subrelease]
         if self.subrellevel is not None:
-            format += ' %(subrellevel)s'
-        return format % params
+            result += ' %s' % self.subrellevel
+        return result
 
     def as_tuple(self):
-        return (self.major, self.minor, self.patch, self.subrelease,
-            self.subrellevel)
+        return self._key[1]
+
+    @property
+    def sort_key(self):
+        """
+        A key that orders versions like the comparison operators do, e.g.
+        for ``sorted(versions, key=attrgetter('sort_key'))``.
+        """
+        return self._key
 
     def __repr__(self):
-        return 'Version(%s)' % ', '.join(['%s=%s' %
-            (label, getattr(self, label))
-            for label in sorted(self.__dict__.keys())
-            if getattr(self, label) is not None])
+        return 'Version(%s)' % ', '.join(['%s=%s' % (label, value)
+            for label, value in zip(self.__slots__, self._key[1])
+            if value is not None])
 
     def __lt__(self, other):
-        # non-release versions are always lower priority
-        if self.subrelease is not None and other.subrelease is None:
-            return True
-        if other.subrelease is not None and self.subrelease is None:
-            return False
-
-        return self.as_tuple() < other.as_tuple()
+        return self._key < other._key
 
     def __gt__(self, other):
-        return other < self
+        return other._key < self._key
 
     def __le__(self, other):
-        return not (other < self)
+        return self._key <= other._key
 
     def __ge__(self, other):
-        return not (self < other)
+        return self._key >= other._key
 
     def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key == other._key
 
     def __ne__(self, other):
-        return not (self == other)
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key != other._key
 
     def __hash__(self):
-        return hash(self.as_tuple())
+        return self._hash
+
 
+# versions parsed by from_string, equal strings map to the same object
+FROM_STRING_CACHE_SIZE = 4096
+_from_string_cache = LRUCache(FROM_STRING_CACHE_SIZE)
 
 VERSION_RE = re.compile(r'^(?P<major>\d+)\.(?P<minor>\d+)(\.(?P<patch>\d+))?'
         r'( (?P<subrelease>[-a-z]+)( (?P<subrellevel>\d+))?)?$')
@@ -172,6 +198,12 @@ def from_string(version_string):
     To specify strings in right format, create a `Version` object and convert
     it to string to get the canonical representation.
 
+    Parsed versions are kept in a bounded LRU cache, so parsing a string
+    again is a dictionary lookup and returns the very same object:
+
+    >>> from_string('1.2') is from_string('1.2')
+    True
+
     Usage:
 
     >>> from_string('1.2.1 beta 5')
@@ -182,6 +214,25 @@ def from_string(version_string):
     :param version_string: the string that specifies the version
     :return: a Version object
     """
+    version = _from_string_cache.get(version_string)
+    if version is None:
+        version = _parse(version_string)
+        _from_string_cache.put(version_string, version)
+    return version
+
+def to_version(ver):
+    """
+    :return: `ver` if it is a `Version` already, `from_string(ver)` if it is
+        a version string
+
+    >>> to_version('1.2') is to_version(from_string('1.2'))
+    True
+    """
+    if isinstance(ver, basestring):
+        return from_string(ver)
+    return ver
+
+def _parse(version_string):
     match = VERSION_RE.match(version_string)
     if not match:
         raise VersionError("Incorrect version string. Please generate it in "
@@ -0,0 +1,52 @@
+"""
+A minimal bounded worker pool built on threads.
+
+Most of plugit's work is I/O (network transfers, disk writes) or runs in C
+code that releases the GIL (zlib, hashlib), so plain threads are enough to
+keep several transfers or decompressions in flight.
+"""
+import sys, threading, Queue
+
+DEFAULT_WORKERS = 8
+
+def thread_map(func, items, max_workers=DEFAULT_WORKERS):
+    """
+    Calls `func` for every item in `items` on at most `max_workers` threads.
+
+    If `func` raises, the remaining items are still processed and the first
+    exception is re-raised in the calling thread once all workers are done.
+
+    :return: a list of results in the order of `items`.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+    errors = []
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append((index, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker)
+            for _ in xrange(max(1, min(max_workers, len(items))))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        _, (exc_type, exc_value, exc_tb) = min(errors)
+        raise exc_type, exc_value, exc_tb
+    return results
@@ -0,0 +1,168 @@
+"""
+A local HTTP/1.1 stand-in for the plugit repository server.
+"""
+from __future__ import with_statement
+
+import re, time, socket, threading, BaseHTTPServer, SocketServer
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+class StandInServer(object):
+    """
+    Serves registered paths from a background thread and records the
+    connections and requests it receives. Usage::
+
+        with StandInServer() as server:
+            server.add('/foo', '{"name": "foo", "version": "0.1"}')
+            fetch_descriptor(server.url('/'), 'foo')
+
+    If `ranges` is set, single byte range requests are honoured and
+    advertised with ``Accept-Ranges``. `truncate` maps paths to a number of
+    bytes after which the next response for the path is cut off by closing
+    the connection. `head_status` maps paths to the status of their ``HEAD``
+    responses, which otherwise carry the usual headers.
+    """
+    def __init__(self, delay=0, ranges=False):
+        self.delay = delay
+        self.ranges = ranges
+        self.truncate = {}
+        self.head_status = {}
+        self.routes = {}
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.standin = self
+        self.thread = None
+
+    def add(self, path, body, headers=None):
+        self.routes[path] = (body, dict(headers or {}))
+
+    def url(self, path='/'):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d%s' % (host, port, path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self.httpd.close_requests()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.open_requests = set()
+        self.open_requests_lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.open_requests_lock:
+            self.open_requests.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                    client_address)
+        finally:
+            with self.open_requests_lock:
+                self.open_requests.discard(request)
+
+    def close_requests(self):
+        # unblock handlers that wait for the next keep-alive request
+        with self.open_requests_lock:
+            requests = list(self.open_requests)
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the response so that it leaves in one segment (avoids
+    # Nagle/delayed ACK stalls on keep-alive connections)
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        standin = self.server.standin
+        with standin.lock:
+            standin.connections += 1
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def _serve(self, head):
+        standin = self.server.standin
+        with standin.lock:
+            standin.requests.append((self.path, dict(self.headers.items())))
+        if standin.delay:
+            time.sleep(standin.delay)
+        route = standin.routes.get(self.path,
+                standin.routes.get(self.path.split('?', 1)[0]))
+        if route is None:
+            self._respond(404, 'not found', {}, head)
+            return
+        body, headers = route
+        headers = dict(headers)
+        if ('ETag' in headers and
+                self.headers.get('If-None-Match') == headers['ETag']):
+            self._respond(304, '', headers, head)
+            return
+        status = 200
+        if standin.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match and (if_range is None or
+                    if_range == headers.get('ETag')):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(body) - 1),
+                        len(body) - 1)
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                        len(body))
+                body = body[start:end + 1]
+                status = 206
+        if head:
+            status = standin.head_status.get(self.path, status)
+        with standin.lock:
+            truncate = (None if head else
+                    standin.truncate.pop(self.path, None))
+        if truncate is not None:
+            self._respond(status, body, headers, head, truncate)
+            self.close_connection = 1
+            return
+        self._respond(status, body, headers, head)
+
+    def _respond(self, status, body, headers, head=False, length=None):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[:length])
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,160 @@
+"""
+Tests for non-blocking fetching against a local stand-in server.
+"""
+import os, time, hashlib
+
+from nose.tools import assert_raises
+
+from plugit import asyncfetch
+from plugit.asyncfetch import AsyncFetcher
+from plugit.exceptions import FetchError
+
+from tests.server import StandInServer
+
+def _descriptor(name, version):
+    return '{"name": "%s", "version": "%s"}' % (name, version)
+
+def test_fetch_descriptors_concurrently():
+    names = ['app%d' % i for i in xrange(8)]
+    server = StandInServer(delay=0.2).start()
+    try:
+        for name in names:
+            server.add('/' + name, _descriptor(name, '1.0'))
+        # the stand-in server's listen backlog fits four connections
+        fetcher = AsyncFetcher(per_host=4)
+        done = []
+        start = time.time()
+        transfers = [fetcher.fetch_descriptor(server.url(), name,
+            callback=done.append) for name in names]
+        fetcher.run()
+        assert time.time() - start < 0.2 * len(names) / 2 - 0.1
+        assert [t.result().name for t in transfers] == names
+        assert len(done) == len(names)
+
+        # at most two at a time: four rounds of requests
+        fetcher = AsyncFetcher(per_host=2)
+        start = time.time()
+        for name in names:
+            fetcher.fetch_descriptor(server.url(), name)
+        fetcher.run()
+        assert time.time() - start >= 0.2 * len(names) / 2
+    finally:
+        server.stop()
+
+def test_fetch_package():
+    body = os.urandom(300 * 1024)
+    digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+    server = StandInServer().start()
+    try:
+        server.add('/foo.zip', body)
+        fetcher = AsyncFetcher()
+        good = fetcher.fetch_package(server.url('/foo.zip'), digest)
+        plain = fetcher.fetch_package(server.url('/foo.zip'))
+        missing = fetcher.fetch_package(server.url('/missing.zip'))
+        fetcher.run()
+
+        filename, verifier = good.result()
+        assert verifier.is_valid()
+        assert open(filename, 'rb').read() == body
+        assert os.path.basename(plain.result()) == 'foo.zip'
+        assert_raises(FetchError, missing.result)
+        assert not os.path.exists(os.path.dirname(missing.filename))
+    finally:
+        server.stop()
+
+def test_truncated_package_fails():
+    server = StandInServer().start()
+    try:
+        server.add('/foo.zip', 'x' * 1000)
+        server.truncate['/foo.zip'] = 100
+        fetcher = AsyncFetcher()
+        transfer = fetcher.fetch_package(server.url('/foo.zip'))
+        fetcher.run()
+        assert_raises(FetchError, transfer.result)
+        assert not os.path.exists(transfer.filename)
+    finally:
+        server.stop()
+
+def test_timeout_and_cancel():
+    server = StandInServer(delay=0.5).start()
+    try:
+        server.add('/foo.zip', 'x' * 1000)
+        fetcher = AsyncFetcher(timeout=0.1)
+        transfer = fetcher.fetch_package(server.url('/foo.zip'))
+        fetcher.run()
+        assert_raises(FetchError, transfer.result)
+
+        fetcher = AsyncFetcher()
+        transfer = fetcher.fetch_package(server.url('/foo.zip'))
+        fetcher.poll()
+        assert os.path.exists(transfer.filename)
+        transfer.cancel()
+        assert transfer.cancelled and not fetcher.poll()
+        assert not os.path.exists(os.path.dirname(transfer.filename))
+        assert_raises(FetchError, transfer.result)
+    finally:
+        server.stop()
+
+def test_unsupported_url():
+    assert_raises(FetchError, AsyncFetcher().fetch_package,
+            'ftp://example.com/foo.zip')
+
+def test_resolve_host_name():
+    server = StandInServer().start()
+    try:
+        server.add('/foo', _descriptor('foo', '1.0'))
+        port = server.httpd.server_address[1]
+        fetcher = AsyncFetcher()
+        transfers = [fetcher.fetch_descriptor('http://localhost:%d/' % port,
+            'foo') for i in xrange(2)]
+        fetcher.run()
+        assert [t.result().name for t in transfers] == ['foo', 'foo']
+
+        fetcher = AsyncFetcher()
+        transfer = fetcher.fetch_descriptor('http://nonexistent.invalid/',
+                'foo')
+        fetcher.run()
+        assert_raises(FetchError, transfer.result)
+    finally:
+        server.stop()
+
+def test_callback_error_fails_transfer():
+    server = StandInServer().start()
+    try:
+        server.add('/foo.zip', 'x' * 1000)
+        def callback(transfer):
+            raise ValueError('callback')
+        fetcher = AsyncFetcher()
+        transfer = fetcher.fetch_package(server.url('/foo.zip'),
+                callback=callback)
+        fetcher.run()
+        assert_raises(ValueError, transfer.result)
+        assert not os.path.exists(transfer.filename)
+    finally:
+        server.stop()
+
+def test_slow_writer():
+    body = os.urandom(300 * 1024)
+    server = StandInServer().start()
+    size = asyncfetch.WRITE_QUEUE_SIZE
+    asyncfetch.WRITE_QUEUE_SIZE = 1
+    try:
+        server.add('/foo.zip', body)
+        fetcher = AsyncFetcher()
+        transfers = [fetcher.fetch_package(server.url('/foo.zip'))
+                for i in xrange(3)]
+        fetcher.run()
+        for transfer in transfers:
+            assert open(transfer.result(), 'rb').read() == body
+
+        # cancelled after data has been queued for the writer
+        fetcher = AsyncFetcher()
+        transfer = fetcher.fetch_package(server.url('/foo.zip'))
+        while not transfer.bytes_received:
+            fetcher.poll()
+        transfer.cancel()
+        fetcher.close()
+        assert not os.path.exists(os.path.dirname(transfer.filename))
+    finally:
+        asyncfetch.WRITE_QUEUE_SIZE = size
+        server.stop()
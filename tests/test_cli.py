@@ -0,0 +1,152 @@
+"""
+Tests for the command line interface.
+"""
+from __future__ import with_statement
+
+import os, sys, json, shutil, tarfile, tempfile, subprocess
+from StringIO import StringIO
+
+from plugit import cli
+from plugit.manifest import Manifest
+from plugit.registry import Registry
+
+from tests.server import StandInServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that commands must not load unless they need them
+HEAVY_MODULES = ['lib2to3', 'json', 'urllib', 'urllib2', 'urlparse',
+        'httplib', 'socket', 'multiprocessing', 'sqlite3', 'tarfile']
+
+def _python(*args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.Popen((sys.executable,) + args, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    return process.returncode, out, err
+
+def test_startup_imports():
+    # Python 2 has no -X importtime, so the modules that a command loads
+    # are checked instead
+    status, out, err = _python('-c', 'import sys\n'
+            'from plugit import cli\n'
+            'status = cli.main(["check-deps", "plugit"])\n'
+            'print " ".join(name for name, module in sys.modules.items()\n'
+            '    if module is not None)\n'
+            'sys.exit(status)\n')
+    assert status == 0, err
+    loaded = set(name.split('.')[0] for name in out.split())
+    assert 'plugit' in loaded
+    assert not loaded.intersection(HEAVY_MODULES), \
+            loaded.intersection(HEAVY_MODULES)
+
+def test_main_module():
+    status, out, err = _python('-m', 'plugit', 'check-deps', 'plugit',
+            '>= 0.1')
+    assert status == 1 and 'No static VERSION' in err, err
+    assert _python('-m', 'plugit', 'check-deps', 'missing_app')[0] == 1
+    assert _python('-m', 'plugit', 'no-such-command')[0] == 2
+
+def test_update_settings():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'settings.py')
+        with open(filename, 'w') as f:
+            f.write('APPS = [\n    "base",\n    ]\n')
+        assert cli.main(['update-settings', filename, '--set', 'DEBUG=False',
+            '--set', 'NAME=plain text', '--append', 'APPS="blog"']) == 0
+        settings = {}
+        execfile(filename, settings)
+        assert settings['DEBUG'] is False
+        assert settings['NAME'] == 'plain text'
+        assert settings['APPS'] == ['base', 'blog']
+        assert cli.main(['update-settings', filename, '--set', 'DEBUG=1']) == 1
+        with open(filename, 'w') as f:
+            f.write('APPS = [\n')
+        for fast in ([], ['--fast']):
+            assert cli.main(['update-settings', filename, '--set',
+                'DEBUG=1'] + fast) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_verify_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(tmpdir, 'root')
+        os.makedirs(os.path.join(root, 'blog'))
+        with open(os.path.join(root, 'blog', '__init__.py'), 'w') as f:
+            f.write('VERSION = 1\n')
+        manifest_file = os.path.join(tmpdir, 'manifest.json')
+        Manifest.from_directory(root).save(manifest_file)
+        state_file = os.path.join(tmpdir, 'state.json')
+        args = ['verify-files', root, manifest_file, '--state', state_file]
+        assert cli.main(args) == 0
+        assert cli.main(args + ['--quick']) == 0
+        with open(os.path.join(root, 'blog', '__init__.py'), 'w') as f:
+            f.write('VERSION = 2\n')
+        assert cli.main(args + ['--quick']) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _tarball(name, version='1.0'):
+    buf = StringIO()
+    archive = tarfile.open(fileobj=buf, mode='w')
+    data = ('from plugit import version\nNAME = %r\n'
+            'VERSION = version.from_string(%r)\n' % (name, version))
+    info = tarfile.TarInfo('%s/__init__.py' % name)
+    info.size = len(data)
+    archive.addfile(info, StringIO(data))
+    archive.close()
+    return buf.getvalue()
+
+def test_install():
+    tmpdir = tempfile.mkdtemp()
+    server = StandInServer().start()
+    try:
+        for name, depends in (('base', []), ('blog', ['base'])):
+            server.add('/%s.tar' % name, _tarball(name))
+            server.add('/%s' % name, json.dumps({'name': name,
+                'version': '1.0', 'depends': depends,
+                'package_url': server.url('/%s.tar' % name)}))
+        target = os.path.join(tmpdir, 'apps')
+        registry = os.path.join(tmpdir, 'registry.db')
+        assert cli.main(['install', server.url('/'), 'blog:>= 1.0',
+            '--target', target, '--registry', registry]) == 0
+        assert sorted(os.listdir(target)) == ['base', 'blog']
+        assert cli.main(['check-deps', 'blog', '--path', target]) == 0
+
+        assert Registry(registry).names() == ['base', 'blog']
+        assert cli.main(['uninstall', 'base', '--registry', registry]) == 1
+        assert cli.main(['uninstall', 'blog', 'base', '--registry',
+            registry]) == 0
+        assert os.listdir(target) == []
+        assert Registry(registry).names() == []
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_install_older_versions():
+    tmpdir = tempfile.mkdtemp()
+    server = StandInServer().start()
+    try:
+        releases = [('base', '1.0', []), ('base', '2.0', []),
+                ('blog', '1.0', [['base', '< 2.0']]),
+                ('blog', '2.0', [['base', '>= 2.0']])]
+        for name, version, depends in releases:
+            path = '/%s-%s.tar' % (name, version)
+            server.add(path, _tarball(name, version))
+            descriptor = json.dumps({'name': name, 'version': version,
+                'depends': depends, 'versions': ['1.0', '2.0'],
+                'package_url': server.url(path)})
+            server.add('/%s?version=%s' % (name, version), descriptor)
+            # the latest version is served without a version parameter
+            server.add('/%s' % name, descriptor)
+        target = os.path.join(tmpdir, 'apps')
+        assert cli.main(['install', server.url('/'), 'blog:< 2.0',
+            '--target', target]) == 0
+        for name in ('base', 'blog'):
+            assert cli.main(['check-deps', name, '== 1.0', '--path',
+                target]) == 0
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,104 @@
+from __future__ import with_statement
+
+import os, sys, time, shutil, tempfile
+from nose.tools import assert_raises
+
+from plugit import deps
+from plugit.specifier import SpecifierSet, compile_spec
+from plugit.version import Version, from_string
+from plugit.exceptions import VersionError
+
+def test_specifier_set():
+    spec = SpecifierSet('>= 1.0, < 2.0, != 1.3')
+    assert spec.contains(Version(1, 0))
+    assert spec.contains(Version(1, 3, 1))
+    assert not spec.contains(Version(1, 3))
+    assert not spec.contains(Version(2, 0))
+    assert not spec.contains(Version(0, 9))
+    # subreleases rank below all releases
+    assert not spec.contains(Version(1, 5, 0, 2, 1))
+    assert len(spec.intervals) == 2
+
+    assert SpecifierSet('> 1.0, >= 1.2, <= 3.0, < 4.0').intervals == \
+            SpecifierSet('>= 1.2, <= 3.0').intervals
+    assert SpecifierSet('< 1.0, > 2.0').is_empty
+    assert SpecifierSet('== 1.2.3, != 1.2.3').is_empty
+    assert SpecifierSet('').contains(Version(0, 1))
+
+    versions = [from_string('%d.%d' % (major, minor))
+            for major in xrange(4) for minor in xrange(10)]
+    expected = [v for v in versions
+            if Version(1, 0) <= v < Version(2, 0) and v != Version(1, 3)]
+    assert list(spec.filter(versions)) == expected
+
+    assert compile_spec('>= 1.0') is compile_spec('>= 1.0')
+    assert_raises(VersionError, SpecifierSet, 'foo')
+
+def test_python_version_supported():
+    current = '%d.%d' % sys.version_info[:2]
+    assert deps.python_version_supported('>= %s' % current)
+    assert not deps.python_version_supported('< %s' % current)
+    assert not deps.python_version_supported('>= 1.0, < %s' % current)
+
+def test_best_version():
+    assert deps.best_version([]) is None
+    versions = ['%d.%d.%d' % (major, minor, patch) for major in xrange(3)
+            for minor in xrange(10) for patch in xrange(5)]
+    versions += ['2.9.5 beta 1', '3.0 pre-alpha']
+    index = deps.VersionIndex(versions)
+    assert len(index) == len(versions)
+
+    assert index.best() == Version(2, 9, 4)
+    assert index.best('< 1.5') == Version(1, 4, 4)
+    assert index.best('>= 1.0, < 2.0, != 1.9.4') == Version(1, 9, 3)
+    assert index.best('> 5.0') is None
+    # subreleases rank below releases
+    assert index.best('< 1.0') == Version(0, 9, 4)
+    assert index.best('< 0.0.0') == Version(3, 0, subrelease=0)
+    assert index.best('< 0.0.0, != 3.0 pre-alpha') == \
+            Version(2, 9, 5, 2, 1)
+    assert index.latest_final('< 0.0.0') is None
+    assert index.latest_final('< 0.0.1') == Version(0, 0, 0)
+    assert deps.best_version(index, '< 0.0.0', final_only=True) is None
+
+    assert [str(v) for v in index.in_range('>= 1.9.3, <= 2.0.1')] == \
+            ['1.9.3', '1.9.4', '2.0.0', '2.0.1']
+    assert index.in_range('== 1.2.3 beta 1') == []
+    assert deps.best_version(['0.1', '0.2', '0.10'], '< 1.0') == \
+            Version(0, 10)
+
+def test_is_installed_without_import():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        appdir = os.path.join(tmpdir, 'staticapp')
+        os.mkdir(appdir)
+        init = os.path.join(appdir, '__init__.py')
+        with open(init, 'w') as f:
+            f.write('from plugit import version\n'
+                    'raise RuntimeError("imported")\n'
+                    'VERSION = version.Version(1, 2, 0, version.BETA, 1)\n')
+        with open(os.path.join(tmpdir, 'plainapp.py'), 'w') as f:
+            f.write('VERSION = None\n')
+        saved_path = sys.path[:]
+
+        assert deps.is_installed('staticapp', '>= 1.1 beta 1, < 2.0',
+                [tmpdir])
+        assert deps.installed_version('staticapp', [tmpdir]) == \
+                Version(1, 2, 0, 2, 1)
+        assert_raises(VersionError, deps.is_installed, 'staticapp',
+                '>= 1.3 alpha 1', [tmpdir])
+        assert deps.is_installed('plainapp', None, [tmpdir])
+        assert_raises(VersionError, deps.is_installed, 'plainapp', '>= 1.0',
+                [tmpdir])
+        assert not deps.is_installed('missingapp', None, [tmpdir])
+        assert 'staticapp' not in sys.modules
+        assert sys.path == saved_path
+
+        # the cached version is dropped when the file changes
+        with open(init, 'w') as f:
+            f.write('VERSION = version.from_string("2.0")\n')
+        mtime = time.time() + 10
+        os.utime(init, (mtime, mtime))
+        assert deps.installed_version('staticapp', [tmpdir]) == Version(2, 0)
+    finally:
+        shutil.rmtree(tmpdir)
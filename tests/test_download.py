@@ -0,0 +1,101 @@
+"""
+Tests for resumable and segmented package downloads.
+"""
+from __future__ import with_statement
+
+import os, random, shutil, hashlib, tempfile
+from nose.tools import assert_raises
+
+from plugit import download
+from plugit.connection import ConnectionPool
+from plugit.exceptions import FetchError
+from plugit.package import DigestVerifier
+
+from tests.server import StandInServer
+
+SIZE = 300 * 1024
+
+def _setup(ranges=True):
+    body = ''.join(chr(random.randint(0, 255)) for _ in xrange(SIZE))
+    server = StandInServer(ranges=ranges).start()
+    server.add('/pkg.tar', body, {'ETag': '"1"'})
+    tmpdir = tempfile.mkdtemp()
+    digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+    return server, body, digest, os.path.join(tmpdir, 'pkg.tar')
+
+def _teardown(server, filename):
+    server.stop()
+    shutil.rmtree(os.path.dirname(filename))
+
+def _range_requests(server):
+    return [headers['range'] for path, headers in server.requests
+            if 'range' in headers]
+
+def _read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_segmented_download():
+    server, body, digest, filename = _setup()
+    try:
+        verifier = DigestVerifier(digest)
+        download.download(server.url('/pkg.tar'), filename, verifier,
+                segments=4, pool=ConnectionPool(), min_segment_size=64 * 1024)
+        assert _read(filename) == body
+        assert verifier.is_valid()
+        assert len(_range_requests(server)) == 4
+        assert not os.path.exists(filename + download.STATE_SUFFIX)
+    finally:
+        _teardown(server, filename)
+
+def test_fallback_without_ranges():
+    server, body, digest, filename = _setup(ranges=False)
+    try:
+        verifier = DigestVerifier(digest)
+        download.download(server.url('/pkg.tar'), filename, verifier,
+                segments=4, pool=ConnectionPool(), min_segment_size=64 * 1024)
+        assert _read(filename) == body
+        assert verifier.is_valid()
+        assert _range_requests(server) == []
+    finally:
+        _teardown(server, filename)
+
+def test_failed_head_request():
+    server, body, digest, filename = _setup()
+    try:
+        server.head_status['/pkg.tar'] = 500
+        verifier = DigestVerifier(digest)
+        download.download(server.url('/pkg.tar'), filename, verifier,
+                segments=4, pool=ConnectionPool(), min_segment_size=64 * 1024)
+        assert _read(filename) == body
+        assert verifier.is_valid()
+        assert _range_requests(server) == []
+    finally:
+        _teardown(server, filename)
+
+def test_resume_interrupted_download():
+    server, body, digest, filename = _setup()
+    try:
+        url = server.url('/pkg.tar')
+        server.truncate['/pkg.tar'] = 100000
+        assert_raises(FetchError, download.download, url, filename,
+                DigestVerifier(digest), pool=ConnectionPool(), retries=0)
+        assert os.path.exists(filename + download.STATE_SUFFIX)
+
+        verifier = DigestVerifier(digest)
+        download.download(url, filename, verifier, pool=ConnectionPool())
+        assert _read(filename) == body
+        assert verifier.is_valid()
+        resumed_from = int(_range_requests(server)[-1][6:].split('-')[0])
+        assert resumed_from > 0
+        assert not os.path.exists(filename + download.STATE_SUFFIX)
+
+        # a dropped connection is resumed within the same call
+        os.remove(filename)
+        server.truncate['/pkg.tar'] = 50000
+        verifier = DigestVerifier(digest)
+        download.download(url, filename, verifier, pool=ConnectionPool())
+        assert verifier.is_valid()
+        assert _range_requests(server)[-1] == 'bytes=50000-%d' % (SIZE - 1)
+    finally:
+        _teardown(server, filename)
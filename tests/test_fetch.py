@@ -0,0 +1,120 @@
+"""
+Tests for fetching descriptors against a local stand-in server.
+"""
+import os, shutil, tempfile
+from nose.tools import assert_raises
+
+from plugit import app
+from plugit.cache import DescriptorCache
+from plugit.connection import ConnectionPool
+from plugit.exceptions import FetchError
+from plugit.fetch import fetch_descriptor, fetch_descriptors
+
+from tests.server import StandInServer
+
+def _descriptor(name, version):
+    return '{"name": "%s", "version": "%s"}' % (name, version)
+
+def test_fetch_descriptor():
+    server = StandInServer().start()
+    try:
+        server.add('/repo/foo', _descriptor('foo', '0.1'))
+        result = fetch_descriptor(server.url('/repo/'), 'foo')
+        assert isinstance(result, app.App)
+        assert result.name == 'foo'
+
+        pool = ConnectionPool()
+        result = fetch_descriptor(server.url('/repo/'), 'foo', '0.1', pool)
+        assert result.version == '0.1'
+        assert server.requests[-1][0] == '/repo/foo?version=0.1'
+    finally:
+        server.stop()
+
+def test_fetch_descriptors_reports_failures_per_app():
+    server = StandInServer().start()
+    try:
+        server.add('/foo', _descriptor('foo', '0.1'))
+        server.add('/broken', 'not json')
+        results = fetch_descriptors(server.url(),
+                [('foo', None), ('missing', '1.0'), ('broken', None)],
+                pool=ConnectionPool())
+        assert results[0].name == 'foo'
+        assert isinstance(results[1], FetchError)
+        assert isinstance(results[2], FetchError)
+    finally:
+        server.stop()
+
+def test_fetch_descriptors_reuses_connections():
+    names = ['app%d' % i for i in xrange(40)]
+    server = StandInServer().start()
+    try:
+        for name in names:
+            server.add('/' + name, _descriptor(name, '1.0'))
+        apps = [(name, None) for name in names]
+
+        # without a pool, every descriptor takes a connection of its own
+        for name in names:
+            fetch_descriptor(server.url(), name)
+        assert server.connections == len(names)
+
+        pool = ConnectionPool()
+        results = fetch_descriptors(server.url(), apps, max_workers=4,
+                pool=pool)
+        assert [result.name for result in results] == names
+        assert len(server.requests) == 2 * len(names)
+        assert pool.connections_opened <= 4
+        assert server.connections - len(names) == pool.connections_opened
+    finally:
+        server.stop()
+
+def test_descriptor_cache():
+    tmpdir = tempfile.mkdtemp()
+    server = StandInServer().start()
+    try:
+        server.add('/foo', _descriptor('foo', '0.1'), {'ETag': '"v1"'})
+        cache = DescriptorCache(tmpdir, ttl=60)
+        pool = ConnectionPool()
+        for _ in xrange(3):
+            result = fetch_descriptor(server.url(), 'foo', cache=cache,
+                    pool=pool)
+            assert result.version == '0.1'
+        assert cache.stats() == {'hits': 2, 'misses': 1, 'revalidations': 0}
+        assert len(server.requests) == 1
+
+        cache.ttl = 0
+        fetch_descriptor(server.url(), 'foo', cache=cache, pool=pool)
+        assert server.requests[-1][1]['if-none-match'] == '"v1"'
+        assert cache.stats()['revalidations'] == 1
+
+        server.add('/foo', _descriptor('foo', '0.2'), {'ETag': '"v2"'})
+        result = fetch_descriptor(server.url(), 'foo', cache=cache, pool=pool)
+        assert result.version == '0.2'
+        assert cache.stats()['misses'] == 2
+        assert cache.lookup(server.url('/foo')).etag == '"v2"'
+
+        # a broken descriptor is not cached
+        server.add('/bar', _descriptor('bar', '0.1')[:-5])
+        assert_raises(FetchError, fetch_descriptor, server.url(), 'bar',
+                cache=cache, pool=pool)
+        assert cache.lookup(server.url('/bar')) is None
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_descriptor_cache_eviction():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = DescriptorCache(tmpdir, max_size=1000)
+        for i in xrange(10):
+            cache.store('http://example.com/app%d' % i, 'x' * 200,
+                    {'etag': str(i)})
+            os.utime(cache._path('http://example.com/app%d' % i),
+                    (i, i))
+        cache.evict()
+        assert cache.lookup('http://example.com/app0') is None
+        assert cache.lookup('http://example.com/app9') is not None
+        total = sum(os.path.getsize(os.path.join(tmpdir, name))
+                for name in os.listdir(tmpdir))
+        assert total <= 1000
+    finally:
+        shutil.rmtree(tmpdir)
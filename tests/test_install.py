@@ -0,0 +1,157 @@
+"""
+Tests for the pipelined install engine against a local stand-in server.
+"""
+from __future__ import with_statement
+
+import os, time, shutil, hashlib, tarfile, tempfile, threading
+from StringIO import StringIO
+from nose.tools import assert_raises
+
+from plugit.app import App
+from plugit.exceptions import PackageError
+from plugit.install import InstallEngine, uninstall
+from plugit.registry import Registry
+
+from tests.server import StandInServer
+
+def _tarball(name):
+    buf = StringIO()
+    archive = tarfile.open(fileobj=buf, mode='w')
+    data = 'NAME = %r\n' % name
+    info = tarfile.TarInfo('%s/__init__.py' % name)
+    info.size = len(data)
+    archive.addfile(info, StringIO(data))
+    archive.close()
+    return buf.getvalue()
+
+def test_pipelined_install():
+    server = StandInServer(delay=0.05).start()
+    try:
+        apps = []
+        for i in xrange(12):
+            name = 'app%d' % i
+            body = _tarball(name)
+            server.add('/%s.tar' % name, body)
+            digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+            if i == 5:
+                digest = 'sha1:' + '0' * 40
+            # app<i> depends on app<i - 3>
+            depends = ['app%d' % (i - 3)] if i >= 3 else []
+            apps.append(App(name, '1.0', depends=depends, digest=digest,
+                package_url=server.url('/%s.tar' % name)))
+
+        activated = []
+        lock = threading.Lock()
+        def activate(job):
+            assert os.path.exists(os.path.join(job.package_dir,
+                job.app.name, '__init__.py'))
+            time.sleep(0.01)
+            with lock:
+                activated.append(job.app.name)
+
+        start = time.time()
+        report = InstallEngine(activate, fetch_workers=4).install(apps)
+        elapsed = time.time() - start
+
+        # app5 has a bad digest, app8 and app11 depend on it
+        assert sorted(report.failed) == ['app11', 'app5', 'app8']
+        assert 'Digest mismatch' in str(report.failed['app5'])
+        assert activated == [app.name for app in report.installed]
+        assert len(activated) == 9
+        for i in xrange(3, 12):
+            name = 'app%d' % i
+            if name in activated:
+                assert activated.index(name) > \
+                        activated.index('app%d' % (i - 3))
+        assert report.stats['fetch'].items == 12
+        assert report.stats['activate'].items == 9
+        # serially, the HEAD and GET requests alone would take 12 * 2 * 50 ms
+        assert elapsed < 12 * 2 * 0.05
+    finally:
+        server.stop()
+
+def test_install_records_registry():
+    server = StandInServer().start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        apps = []
+        for name in ('base', 'top'):
+            server.add('/%s.tar' % name, _tarball(name))
+            apps.append(App(name, '1.0', depends=['base'] if name == 'top'
+                else [], package_url=server.url('/%s.tar' % name)))
+        def activate(job):
+            if job.app.name == 'top':
+                raise RuntimeError('activation failed')
+            return os.path.join(tmpdir, job.app.name)
+
+        registry = Registry(os.path.join(tmpdir, 'registry.db'))
+        report = InstallEngine(activate, registry=registry).install(apps)
+        assert [app.name for app in report.installed] == ['base']
+        assert registry.names() == ['base']
+        assert registry.get('base').path == os.path.join(tmpdir, 'base')
+        assert 'base/__init__.py' in registry.files('base')
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_uninstall():
+    server = StandInServer().start()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        apps = []
+        for name in ('base', 'top'):
+            server.add('/%s.tar' % name, _tarball(name))
+            apps.append(App(name, '1.0', depends=['base'] if name == 'top'
+                else [], package_url=server.url('/%s.tar' % name)))
+        target = os.path.join(tmpdir, 'apps')
+        def activate(job):
+            shutil.copytree(os.path.join(job.package_dir, job.app.name),
+                    os.path.join(target, job.app.name))
+            return target
+
+        registry = Registry(os.path.join(tmpdir, 'registry.db'))
+        InstallEngine(activate, registry=registry).install(apps)
+        with open(os.path.join(target, 'base', 'local.txt'), 'w') as f:
+            f.write('not from the package')
+
+        assert_raises(PackageError, uninstall, registry, 'base')
+        files = registry.files('top')
+        assert uninstall(registry, 'top') == len(files), files
+        assert not os.path.exists(os.path.join(target, 'top')), \
+                os.listdir(os.path.join(target, 'top'))
+        assert registry.names() == ['base']
+        uninstall(registry, 'base')
+        # the directory still holds a file that was not installed
+        assert os.listdir(os.path.join(target, 'base')) == ['local.txt']
+        assert registry.names() == []
+        assert_raises(PackageError, uninstall, registry, 'base')
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_streaming_install():
+    server = StandInServer().start()
+    try:
+        apps = []
+        for name in ('base', 'top', 'bad'):
+            body = _tarball(name)
+            server.add('/%s.tar' % name, body)
+            digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+            if name == 'bad':
+                digest = 'sha1:' + '0' * 40
+            apps.append(App(name, '1.0', digest=digest,
+                package_url=server.url('/%s.tar' % name)))
+        package_dirs = []
+        def activate(job):
+            # unpacked from the stream, there is no package file
+            assert job.package_file is None
+            assert os.path.exists(os.path.join(job.package_dir,
+                job.app.name, '__init__.py'))
+            package_dirs.append(job.package_dir)
+
+        report = InstallEngine(activate, stream=True).install(apps)
+        assert sorted(app.name for app in report.installed) == ['base', 'top']
+        assert 'Digest mismatch' in str(report.failed['bad'])
+        assert not [path for path in package_dirs if os.path.exists(path)]
+    finally:
+        server.stop()
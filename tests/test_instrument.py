@@ -0,0 +1,84 @@
+"""
+Tests for the instrumentation hooks.
+"""
+from __future__ import with_statement
+
+import json, hashlib, tarfile, warnings
+from StringIO import StringIO
+from nose.tools import assert_raises
+
+from plugit import fetch, instrument, package
+from plugit.settingshandler import SettingsStringUpdater
+
+from tests.server import StandInServer
+
+def _tarball():
+    buf = StringIO()
+    archive = tarfile.open(fileobj=buf, mode='w')
+    for name in ('app/__init__.py', 'app/models.py'):
+        data = 'X = 1\n'
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        archive.addfile(info, StringIO(data))
+    archive.close()
+    return buf.getvalue()
+
+def test_no_hooks():
+    assert instrument.span('step') is instrument._NULL_SPAN
+    with instrument.span('step') as span:
+        span.add('bytes_hashed', 10)
+    assert not span.enabled
+
+def test_profile_install_steps():
+    body = _tarball()
+    digest = 'sha1:' + hashlib.sha1(body).hexdigest()
+    server = StandInServer().start()
+    try:
+        server.add('/app', '{"name": "app", "version": "1.0"}')
+        server.add('/app.tar', body)
+        with instrument.Profile() as profile:
+            fetch.fetch_descriptor(server.url('/'), 'app')
+            package_file, verifier = fetch.fetch_package(
+                    server.url('/app.tar'), digest)
+            try:
+                assert package.is_valid(digest, package_file)
+                package_dir = package.unpack(package_file)
+                package.compile_package(None, package_dir, processes=1)
+            finally:
+                package.cleanup(package_file, package_dir)
+            SettingsStringUpdater('A = []\n').update({'B': 1}, {'A': 2})
+            assert_raises(ValueError, package.is_valid, 'sha1', package_file)
+        # the profile is no longer registered
+        fetch.fetch_descriptor(server.url('/'), 'app')
+    finally:
+        server.stop()
+
+    steps = json.loads(profile.as_json())
+    assert sorted(steps) == ['compile_package', 'fetch_descriptor',
+            'fetch_package', 'is_valid', 'settings_update', 'unpack']
+    assert steps['fetch_descriptor']['calls'] == 1
+    assert steps['fetch_descriptor']['counters'] == {
+            'bytes_transferred': 33}
+    assert steps['fetch_package']['counters'] == {
+            'bytes_transferred': len(body), 'bytes_hashed': len(body)}
+    assert steps['is_valid']['calls'] == 2
+    assert steps['is_valid']['errors'] == 1
+    assert steps['unpack']['counters'] == {'files_extracted': 2}
+    assert steps['compile_package']['counters']['files_compiled'] == 2
+    assert steps['settings_update']['counters'] == {'settings': 2}
+    step = steps['unpack']
+    assert step['min_time'] <= step['mean_time'] <= step['max_time']
+
+def test_failing_hook():
+    def hook(span):
+        raise RuntimeError('broken')
+    instrument.add_hook(hook)
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with instrument.span('step'):
+                pass
+        assert 'broken' in str(caught[0].message)
+    finally:
+        instrument.remove_hook(hook)
+    assert instrument._hooks == ()
@@ -0,0 +1,214 @@
+"""
+Tests for package manifests and delta upgrades.
+"""
+import os, time, shutil, hashlib, tempfile
+
+from nose.tools import assert_raises
+
+from plugit.app import App
+from plugit.exceptions import PackageError
+from plugit.manifest import (Manifest, delta_upgrade, installed_manifest,
+        upgrade, verify, VerifyState)
+from plugit.registry import Registry
+from plugit.store import PackageStore
+
+from tests.server import StandInServer
+
+def _write_tree(root, files):
+    for path, data in files.items():
+        filename = os.path.join(root, *path.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+def _read_tree(root):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), root)
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                result[path.replace(os.sep, '/')] = f.read()
+    return result
+
+def _serve_blobs(server, root, manifest):
+    for path, digest in manifest.files.items():
+        with open(os.path.join(root, *path.split('/')), 'rb') as f:
+            server.add('/blobs/' + digest.replace(':', '/'), f.read())
+
+OLD = {'blog/__init__.py': 'VERSION = 1\n', 'blog/views.py': 'views\n',
+        'blog/old.py': 'old\n', 'blog/static/a.css': 'css' * 1000}
+NEW = {'blog/__init__.py': 'VERSION = 2\n', 'blog/views.py': 'views\n',
+        'blog/static/b.css': 'css' * 1000, 'blog/new.py': 'new\n'}
+
+def test_manifest():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _write_tree(tmpdir, OLD)
+        _write_tree(tmpdir, {'blog/views.pyc': 'bytecode'})
+        old = Manifest.from_directory(tmpdir)
+        assert sorted(old.files) == sorted(OLD)
+        assert old.sizes['blog/static/a.css'] == 3000
+        assert Manifest.from_json(old.to_json()).files == old.files
+        upper = Manifest(dict((path, digest.upper())
+            for path, digest in old.files.items()))
+        assert Manifest.from_json(upper.to_json()).files == old.files
+
+        shutil.rmtree(tmpdir)
+        _write_tree(tmpdir, NEW)
+        diff = old.diff(Manifest.from_directory(tmpdir))
+        assert diff.added == ['blog/new.py', 'blog/static/b.css']
+        assert diff.changed == ['blog/__init__.py']
+        assert diff.removed == ['blog/old.py', 'blog/static/a.css']
+        assert diff.unchanged == 1
+        assert not old.diff(old)
+
+        assert_raises(PackageError, Manifest.from_json,
+                '{"files": {"../x": "sha1:00"}}')
+        assert_raises(PackageError, Manifest.from_json, '{"files": 1}')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_upgrade_fetches_only_missing_blobs():
+    tmpdir = tempfile.mkdtemp()
+    install_dir = os.path.join(tmpdir, 'install')
+    new_dir = os.path.join(tmpdir, 'new')
+    server = StandInServer().start()
+    try:
+        _write_tree(install_dir, OLD)
+        _write_tree(install_dir, {'blog/old.pyc': 'bytecode',
+            'other/x.py': 'not ours\n'})
+        old = Manifest.from_directory(install_dir)
+        del old.files['other/x.py']
+        _write_tree(new_dir, NEW)
+        new = Manifest.from_directory(new_dir)
+        _serve_blobs(server, new_dir, new)
+
+        store = PackageStore(os.path.join(tmpdir, 'store'))
+        report = upgrade(install_dir, old, new, server.url('/blobs/'), store)
+        # b.css has the contents of a.css, only two small files are fetched
+        assert report.fetched == 2 and report.reused == 1
+        assert report.bytes_transferred == len('VERSION = 2\nnew\n')
+        assert len(server.requests) == 2
+        assert new.files['blog/new.py'] in store
+        tree = _read_tree(install_dir)
+        assert tree == dict(NEW, **{'other/x.py': 'not ours\n'})
+        assert not os.path.exists(os.path.join(install_dir, 'blog', 'old.pyc'))
+        assert not os.path.exists(os.path.join(install_dir, 'blog', 'static',
+            'a.css'))
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_upgrade_with_bad_blob_leaves_install_unchanged():
+    tmpdir = tempfile.mkdtemp()
+    server = StandInServer().start()
+    try:
+        _write_tree(tmpdir, OLD)
+        old = Manifest.from_directory(tmpdir)
+        new = Manifest(dict(old.files, **{'blog/new.py': 'sha256:00'}))
+        del new.files['blog/old.py']
+        server.add('/blobs/sha256/00', 'corrupt')
+        assert_raises(PackageError, upgrade, tmpdir, old, new,
+                server.url('/blobs/'))
+        assert _read_tree(tmpdir) == OLD
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_failed_upgrade_removes_created_directories():
+    tmpdir = tempfile.mkdtemp()
+    server = StandInServer().start()
+    try:
+        _write_tree(tmpdir, OLD)
+        old = Manifest.from_directory(tmpdir)
+        # a directory that is in the way of a new file fails the upgrade
+        # after new/deeper/ has been created for the first one
+        os.makedirs(os.path.join(tmpdir, 'z', 'in_the_way.py'))
+        new_dir = os.path.join(tmpdir, 'new')
+        _write_tree(new_dir, {'new/deeper/a.py': 'a\n',
+            'z/in_the_way.py': 'b\n'})
+        new = Manifest.from_directory(new_dir)
+        _serve_blobs(server, new_dir, new)
+        shutil.rmtree(new_dir)
+        new.files.update(old.files)
+        assert_raises(PackageError, upgrade, tmpdir, old, new,
+                server.url('/blobs/'))
+        assert not os.path.exists(os.path.join(tmpdir, 'new'))
+        assert _read_tree(tmpdir) == OLD
+        assert sorted(os.listdir(tmpdir)) == ['blog', 'z']
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_delta_upgrade_updates_registry():
+    tmpdir = tempfile.mkdtemp()
+    install_dir = os.path.join(tmpdir, 'install')
+    new_dir = os.path.join(tmpdir, 'new')
+    server = StandInServer().start()
+    try:
+        _write_tree(install_dir, OLD)
+        _write_tree(new_dir, NEW)
+        new = Manifest.from_directory(new_dir)
+        _serve_blobs(server, new_dir, new)
+        server.add('/blog-1.1.json', new.to_json())
+
+        registry = Registry(os.path.join(tmpdir, 'registry.db'))
+        registry.record(App('blog', '1.0'), install_dir, ['blog/views.py'])
+        upgraded = App('blog', '1.1',
+                manifest_url=server.url('/blog-1.1.json'))
+        # no digests recorded, a full install is needed
+        assert delta_upgrade(registry, upgraded) is None
+
+        registry.record(App('blog', '1.0'), install_dir,
+                Manifest.from_directory(install_dir).files.items())
+        report = delta_upgrade(registry, upgraded)
+        assert report.fetched == 2
+        assert _read_tree(install_dir) == NEW
+        assert str(registry.get('blog').version) == '1.1'
+        assert installed_manifest(registry, 'blog').files == new.files
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+def test_verify():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _write_tree(tmpdir, OLD)
+        manifest = Manifest.from_directory(tmpdir)
+        state = VerifyState()
+        report = verify(tmpdir, manifest, state, algorithms=['md5', 'sha1'])
+        assert report.is_valid and report.hashed == len(OLD)
+        assert report.digests['blog/views.py']['md5'] == \
+                'md5:' + hashlib.md5('views\n').hexdigest()
+        assert report.digests['blog/views.py']['sha256'] == \
+                manifest.files['blog/views.py']
+        # files modified just now are hashed again on the next run
+        assert not state.entries
+
+        for path in OLD:
+            filename = os.path.join(tmpdir, *path.split('/'))
+            os.utime(filename, (time.time() - 60, time.time() - 60))
+        verify(tmpdir, manifest, state)
+        assert sorted(state.entries) == sorted(OLD)
+        state_file = os.path.join(tmpdir, 'state.json')
+        state.save(state_file)
+        state = VerifyState.load(state_file)
+
+        report = verify(tmpdir, manifest, state, quick=True)
+        assert report.is_valid
+        assert report.hashed == 0 and report.skipped == len(OLD)
+
+        _write_tree(tmpdir, {'blog/views.py': 'tampered\n'})
+        os.remove(os.path.join(tmpdir, 'blog', 'old.py'))
+        report = verify(tmpdir, manifest, state, quick=True)
+        assert not report.is_valid
+        assert report.mismatched == ['blog/views.py']
+        assert report.missing == ['blog/old.py']
+        assert report.hashed == 0 and report.skipped == 2
+        assert sorted(state.entries) == ['blog/__init__.py',
+                'blog/static/a.css']
+
+        assert_raises(ValueError, verify, tmpdir, manifest, quick=True)
+    finally:
+        shutil.rmtree(tmpdir)
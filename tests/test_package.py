@@ -0,0 +1,262 @@
+"""
+Tests for package validation and fetching.
+"""
+from __future__ import with_statement
+
+import os, shutil, hashlib, tarfile, zipfile, tempfile, urllib, \
+        multiprocessing
+from StringIO import StringIO
+from nose.tools import assert_raises
+
+from plugit import package
+from plugit.exceptions import FetchError, PackageError
+from plugit.fetch import fetch_package, fetch_and_unpack
+from plugit.store import PackageStore
+
+def _make_file(size):
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'package.tar')
+    data = ''.join(chr(i % 251) for i in xrange(size))
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename, data
+
+def test_is_valid():
+    for size in (0, 1, package.CHUNK_SIZE, 3 * package.CHUNK_SIZE + 17):
+        filename, data = _make_file(size)
+        try:
+            digest = 'sha1:' + hashlib.sha1(data).hexdigest()
+            assert package.is_valid(digest, filename)
+            assert package.is_valid(digest.upper().replace('SHA1', 'sha1'),
+                    filename)
+            assert not package.is_valid('sha1:' + '0' * 40, filename)
+            assert package.is_valid('md5:' + hashlib.md5(data).hexdigest(),
+                    filename)
+        finally:
+            shutil.rmtree(os.path.dirname(filename))
+
+def test_fetch_package_verifies_while_downloading():
+    source, data = _make_file(2 * package.CHUNK_SIZE + 5)
+    url = 'file://' + urllib.pathname2url(source)
+    digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+    try:
+        filename, verifier = fetch_package(url, digest)
+        assert verifier.is_valid()
+        assert verifier.bytes_hashed == len(data)
+        assert os.path.basename(filename) == 'package.tar'
+        with open(filename, 'rb') as f:
+            assert f.read() == data
+        package.cleanup(filename, None)
+
+        filename = fetch_package(url)
+        assert os.path.getsize(filename) == len(data)
+        package.cleanup(filename, None)
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def test_package_store():
+    source, data = _make_file(package.CHUNK_SIZE + 1)
+    url = 'file://' + urllib.pathname2url(source)
+    digest = 'sha1:' + hashlib.sha1(data).hexdigest()
+    store_dir = tempfile.mkdtemp()
+    try:
+        store = PackageStore(store_dir)
+        assert digest not in store
+        filename, verifier = fetch_package(url, digest, store=store)
+        assert verifier.bytes_hashed == len(data)
+        assert digest in store
+        package.cleanup(filename, None)
+
+        assert_raises(FetchError, fetch_package, url, 'sha1:' + '0' * 40,
+                store=store)
+        assert os.listdir(store.tmp_dir) == []
+
+        # served from the store without touching the url
+        os.remove(source)
+        filename, verifier = fetch_package(url, digest, store=store)
+        assert verifier.is_valid() and verifier.bytes_hashed == 0
+        with open(filename, 'rb') as f:
+            assert f.read() == data
+        package.cleanup(filename, None)
+
+        assert store.gc(max_size=len(data)) == 0
+        assert store.gc(max_size=0) == len(data)
+        assert digest not in store
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+        shutil.rmtree(store_dir)
+
+def test_package_store_gc_keeps_held_locks():
+    store_dir = tempfile.mkdtemp()
+    try:
+        store = PackageStore(store_dir)
+        digest = 'sha1:' + '0' * 40
+        with store.partial_file(digest) as path:
+            for filename in (path, path + '.state'):
+                with open(filename, 'wb') as f:
+                    f.write('{}')
+            lock_path = path + '.lock'
+            os.utime(lock_path, (0, 0))
+            store.gc(max_age=60)
+            assert os.path.exists(lock_path)
+            # a second writer gets a path of its own
+            with store.partial_file(digest) as other_path:
+                assert other_path != path
+                os.remove(other_path)
+            os.remove(path)
+        assert os.listdir(store.tmp_dir) == []
+
+        with open(lock_path, 'w'):
+            pass
+        os.utime(lock_path, (0, 0))
+        store.gc(max_age=60)
+        assert not os.path.exists(lock_path)
+    finally:
+        shutil.rmtree(store_dir)
+
+def _make_tar(members, mode='w:gz'):
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'package.tar.gz')
+    archive = tarfile.open(filename, mode)
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        archive.addfile(info, StringIO(data))
+    archive.close()
+    with open(filename, 'rb') as f:
+        digest = 'sha1:' + hashlib.sha1(f.read()).hexdigest()
+    return filename, digest
+
+def test_fetch_and_unpack_stream():
+    members = [('app/__init__.py', 'VERSION = None\n'),
+            ('app/data/big.bin', 'x' * (3 * package.CHUNK_SIZE))]
+    source, digest = _make_tar(members)
+    url = 'file://' + urllib.pathname2url(source)
+    try:
+        package_dir, verifier = fetch_and_unpack(url, digest)
+        assert verifier.is_valid()
+        assert verifier.bytes_hashed == os.path.getsize(source)
+        assert os.listdir(os.path.dirname(package_dir)) == [
+                package.UNPACK_DIR]
+        for name, data in members:
+            with open(os.path.join(package_dir, name), 'rb') as f:
+                assert f.read() == data
+        package.cleanup(None, package_dir)
+        assert not os.path.exists(package_dir)
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def test_unpack_rejects_escaping_paths():
+    source, _ = _make_tar([('../evil.py', 'pass\n')], 'w')
+    unpack_to = os.path.join(os.path.dirname(source), 'unpacked')
+    try:
+        with open(source, 'rb') as f:
+            assert_raises(PackageError, package.unpack_stream, f, unpack_to)
+        shutil.rmtree(unpack_to)
+        assert_raises(PackageError, package.unpack, source)
+        assert not os.path.exists(os.path.join(os.path.dirname(source),
+            'evil.py'))
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+    source, _ = _make_tar([], 'w')
+    archive = tarfile.open(source, 'w')
+    link = tarfile.TarInfo('app/etc')
+    link.type = tarfile.SYMTYPE
+    link.linkname = '/etc'
+    archive.addfile(link)
+    archive.close()
+    try:
+        assert_raises(PackageError, package.unpack, source)
+        assert not os.path.lexists(os.path.join(os.path.dirname(source),
+            package.UNPACK_DIR, 'app', 'etc'))
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def _make_zip(members):
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'package.zip')
+    archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in members:
+        archive.writestr(name, data)
+    archive.close()
+    return filename
+
+def test_unpack_zip():
+    members = [('app/__init__.py', 'VERSION = None\n'),
+            ('app/deep/nested/module.py', 'pass\n'),
+            ('app/data/big.bin', 'x' * (5 * package.CHUNK_SIZE))]
+    members += [('app/files/%d.txt' % i, str(i) * i) for i in xrange(20)]
+    source = _make_zip(members)
+    try:
+        package_dir = package.unpack(source)
+        for name, data in members:
+            with open(os.path.join(package_dir, name), 'rb') as f:
+                assert f.read() == data
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def test_unpack_zip_limits():
+    source = _make_zip([('a.bin', '\0' * 100000), ('b.txt', 'b')])
+    output_dir = os.path.join(os.path.dirname(source), 'out')
+    try:
+        too_big = package.ZipWrapper(source, max_size=50000)
+        assert_raises(PackageError, too_big.extractall, output_dir)
+        too_many = package.ZipWrapper(source, max_entries=1)
+        assert_raises(PackageError, too_many.extractall, output_dir)
+        assert not os.path.exists(output_dir)
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+    source = _make_zip([('../evil.py', 'pass\n')])
+    try:
+        assert_raises(PackageError, package.unpack, source)
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def test_fetch_and_unpack_zip():
+    source = _make_zip([('app/__init__.py', 'pass\n')])
+    try:
+        package_dir = fetch_and_unpack('file://' +
+                urllib.pathname2url(source))
+        assert os.path.exists(os.path.join(package_dir, 'app/__init__.py'))
+        package.cleanup(None, package_dir)
+    finally:
+        shutil.rmtree(os.path.dirname(source))
+
+def test_compile_package():
+    package_dir = tempfile.mkdtemp()
+    try:
+        for i in xrange(30):
+            subdir = os.path.join(package_dir, 'mod%d' % (i % 3))
+            if not os.path.isdir(subdir):
+                os.mkdir(subdir)
+            with open(os.path.join(subdir, 'file%d.py' % i), 'w') as f:
+                f.write('VALUE = %d\n' % i)
+        broken = os.path.join(package_dir, 'broken.py')
+        with open(broken, 'w') as f:
+            f.write('def (:\n')
+
+        report = package.compile_package(None, package_dir, processes=2)
+        assert len(report.compiled) == 30
+        assert report.failed.keys() == [broken]
+        assert os.path.exists(os.path.join(package_dir, 'mod1',
+            'file1.pyc'))
+
+        changed = os.path.join(package_dir, 'mod0', 'file0.py')
+        os.utime(changed, (0, 0))
+        report = package.compile_package(None, package_dir, processes=2)
+        assert report.compiled == [changed]
+        assert len(report.skipped) == 29
+        assert report.failed.keys() == [broken]
+
+        # on a pool that was started by the caller
+        pool = multiprocessing.Pool(2)
+        try:
+            os.utime(changed, (1, 1))
+            report = package.compile_package(None, package_dir, pool=pool)
+            assert report.compiled == [changed]
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(package_dir)
@@ -0,0 +1,103 @@
+"""
+Tests for the installed application registry.
+"""
+import os, shutil, tempfile, threading
+from nose.tools import assert_raises
+
+from plugit.app import App
+from plugit.registry import Registry
+from plugit.version import Version
+from plugit.exceptions import RegistryError, VersionError
+
+def _registry():
+    tmpdir = tempfile.mkdtemp()
+    return Registry(os.path.join(tmpdir, 'db', 'registry.db')), tmpdir
+
+def test_record_and_lookup():
+    registry, tmpdir = _registry()
+    try:
+        registry.record(App('markup', '1.2', digest='sha1:' + 'a' * 40),
+                '/srv/markup', ['markup/__init__.py',
+                    ('markup/parser.py', 'sha1:' + 'b' * 40)])
+        registry.record(App('blog', '2.0 beta 1',
+            depends={'markup': '>= 1.0'}), '/srv/blog')
+        registry.record(App('wiki', '0.9', depends=['markup', 'blog']))
+
+        record = registry.get('markup')
+        assert record.version == Version(1, 2)
+        assert record.digest == 'sha1:' + 'a' * 40
+        assert record.path == '/srv/markup'
+        assert registry.get('missing') is None
+        assert registry.names() == ['blog', 'markup', 'wiki']
+
+        assert registry.is_installed('markup', '>= 1.0')
+        assert not registry.is_installed('missing')
+        assert_raises(VersionError, registry.is_installed, 'markup', '< 1.0')
+
+        assert registry.dependents('markup') == {'blog': '>= 1.0',
+                'wiki': ''}
+        assert registry.get('blog').depends == {'markup': '>= 1.0'}
+        assert registry.files('markup') == {'markup/__init__.py': None,
+                'markup/parser.py': 'sha1:' + 'b' * 40}
+        assert registry.owner('markup/parser.py') == 'markup'
+        assert registry.owner('other.py') is None
+
+        # subreleases rank below all releases
+        assert registry.in_range('>= 0.1') == ['wiki', 'markup']
+        assert registry.in_range('< 1.0') == ['blog', 'wiki']
+        assert registry.in_range('>= 1.0, != 1.2') == []
+        assert registry.in_range('') == ['blog', 'wiki', 'markup']
+
+        # a new record replaces the old one
+        registry.record(App('markup', '1.3'), '/srv/markup')
+        assert registry.get('markup').version == Version(1, 3)
+        assert registry.files('markup') == {}
+
+        assert registry.remove('blog')
+        assert not registry.remove('blog')
+        assert registry.dependents('markup') == {'wiki': ''}
+
+        # the records persist
+        registry.close()
+        assert Registry(registry.path).names() == ['markup', 'wiki']
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_failed_record_is_rolled_back():
+    registry, tmpdir = _registry()
+    try:
+        registry.record(App('markup', '1.2'), '/srv/markup', ['a.py'])
+        # the same file twice violates the files table's primary key
+        assert_raises(RegistryError, registry.record, App('markup', '1.3'),
+                '/srv/markup', ['a.py', 'a.py'])
+        assert registry.get('markup').version == Version(1, 2)
+        assert registry.files('markup') == {'a.py': None}
+    finally:
+        registry.close()
+        shutil.rmtree(tmpdir)
+
+def test_concurrent_installers():
+    registry, tmpdir = _registry()
+    try:
+        errors = []
+        def install(start):
+            # every installer uses its own connection to the database
+            own = Registry(registry.path)
+            try:
+                for i in xrange(start, start + 20):
+                    own.record(App('app%d' % i, '1.%d' % i,
+                        depends=['app%d' % (i - 1)]), files=['f%d' % i])
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=install, args=(start,))
+                for start in xrange(0, 80, 20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(registry.names()) == 80
+        assert registry.dependents('app41') == {'app42': ''}
+        assert registry.owner('f79') == 'app79'
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,96 @@
+from nose.tools import assert_raises
+
+from plugit.app import App
+from plugit.exceptions import ResolutionError
+from plugit.resolver import Resolver, MemorySource
+from plugit.version import Version
+
+def _names(resolution):
+    return [(app.name, app.version) for app in resolution.plan]
+
+def test_resolve_with_backtracking():
+    source = MemorySource([
+        App('site', '1.0', depends={'blog': '>= 1.0', 'wiki': ''}),
+        App('blog', '1.0', depends=[['core', '< 2.0']]),
+        App('blog', '2.0', depends=[['core', '>= 3.0']]),
+        App('wiki', '1.0', depends=['core']),
+        App('wiki', '1.1', depends=[['core', '< 3.0']]),
+        App('core', '1.5'),
+        App('core', '2.5'),
+        App('core', '3.0'),
+    ])
+    resolution = Resolver(source).resolve(['site'])
+    # blog 2.0 needs core >= 3.0, which rules out wiki 1.1
+    assert resolution.versions == {'site': Version(1, 0),
+            'blog': Version(2, 0), 'wiki': Version(1, 0),
+            'core': Version(3, 0)}
+    assert _names(resolution) == [('core', '3.0'), ('blog', '2.0'),
+            ('wiki', '1.0'), ('site', '1.0')]
+
+    resolution = Resolver(source).resolve({'site': '', 'core': '< 3.0'})
+    assert resolution.versions['blog'] == Version(1, 0)
+    assert resolution.versions['wiki'] == Version(1, 1)
+    assert resolution.versions['core'] == Version(1, 5)
+
+def test_conflicts():
+    source = MemorySource([
+        App('a', '1.0', depends={'c': '>= 2.0'}),
+        App('b', '1.0', depends={'c': '< 2.0'}),
+        App('c', '1.0'),
+        App('c', '2.0'),
+        App('d', '1.0', depends={'missing': ''}),
+    ])
+    resolver = Resolver(source)
+    try:
+        resolver.resolve(['a', 'b'])
+    except ResolutionError, e:
+        assert 'required by a 1.0' in str(e)
+        assert 'required by b 1.0' in str(e)
+    else:
+        assert False, "ResolutionError not raised"
+    try:
+        resolver.resolve(['d'])
+    except ResolutionError, e:
+        assert str(e) == ("missing is not available: any version "
+                "(required by d 1.0).")
+    else:
+        assert False, "ResolutionError not raised"
+
+    # x 2.0 fails on y first, the search then fails for good on x 1.0
+    source = MemorySource([
+        App('x', '1.0', depends={'z': ''}),
+        App('x', '2.0', depends={'y': '>= 2.0'}),
+        App('y', '1.0'),
+    ])
+    try:
+        Resolver(source).resolve(['x'])
+    except ResolutionError, e:
+        assert str(e) == "z is not available: any version " \
+                "(required by x 1.0)."
+    else:
+        assert False, "ResolutionError not raised"
+
+    cyclic = MemorySource([App('x', '1.0', depends=['y']),
+        App('y', '1.0', depends=['x'])])
+    assert_raises(ResolutionError, Resolver(cyclic).resolve, ['x'])
+
+def test_resolve_large_diamond_graph():
+    # 30 layers of 10 plugins, each depending on two plugins of the next
+    # layer with a version range that rules out the newest release
+    apps = []
+    layers, width = 30, 10
+    for layer in xrange(layers):
+        for i in xrange(width):
+            name = 'p%d_%d' % (layer, i)
+            depends = {}
+            if layer + 1 < layers:
+                for j in (i, (i + 1) % width):
+                    depends['p%d_%d' % (layer + 1, j)] = '>= 1.0, < 3.0'
+            for minor in xrange(4):
+                apps.append(App(name, '%d.%d' % (minor, 0), depends=depends))
+    resolution = Resolver(MemorySource(apps)).resolve(
+            ['p0_%d' % i for i in xrange(width)])
+    assert len(resolution.plan) == layers * width
+    assert resolution.plan[0].name.startswith('p%d_' % (layers - 1))
+    assert resolution.versions['p1_0'] == Version(2, 0)
+    assert resolution.versions['p0_0'] == Version(3, 0)
@@ -1,11 +1,17 @@
 """
 Tests for updating settings.
 """
-import os, sys
+from __future__ import with_statement
+
+import os, sys, stat, shutil, tempfile
 from nose.tools import assert_raises
 from lib2to3.pgen2.parse import ParseError
 
-from plugit.settingshandler import SettingsFileUpdater
+from plugit import settingshandler
+from plugit.settingshandler import (SettingsFileUpdater,
+        SettingsStringUpdater, SettingsParser, UnparsedStatement,
+        split_statements, update_files)
+from plugit.exceptions import SettingsError
 
 TESTDATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
@@ -43,3 +49,143 @@ def test_update_settings():
     settings = sys.modules[settings_module]
     for key, val in new_settings.iteritems():
         assert getattr(settings, key) == val
+
+def test_parse_cache():
+    parser = SettingsParser(cache_size=2)
+    source = 'A = 1\nB = [1, 2]\n'
+    tree = parser.parse_string(source)
+    again = parser.parse_string(source)
+    assert tree == again and tree is not again
+    assert parser._cache.hits == 1
+    # updating a tree does not change the cached one
+    updater = SettingsStringUpdater(source, parser)
+    updater.update({'C': 3})
+    assert str(parser.parse_string(source)) == source
+
+def test_fast_update():
+    source = open(os.path.join(TESTDATADIR, 'testsettings.py')).read()
+    statements = split_statements(source)
+    assert ''.join(text for text, names in statements) == source
+    assert [names for text, names in statements if names] == [
+            ('NONEMPTY_TUPLE',), ('EMPTY_TUPLE',), ('NONEMPTY_DICT',),
+            ('EMPTY_DICT',)]
+
+    results = []
+    for fast in (False, True):
+        updater = SettingsStringUpdater(source, fast=fast)
+        updater.update({'A_STRING': 'ipsum'}, {'NONEMPTY_TUPLE': 'porro',
+            'EMPTY_DICT': {'quia': True}, 'NEW_LIST': ['a']}, True)
+        results.append(updater.result)
+    assert results[0] == results[1]
+    # only the edited statements were parsed
+    assert len([child for child in updater.root.children
+        if isinstance(child, UnparsedStatement)]) == 3
+
+def test_assignment_index():
+    source = ('A = 1; B = []\nC = D = {}\nE += 1\nf(x=1)\n' +
+            ''.join('GENERATED_%d = [%d]\n' % (i, i) for i in xrange(2000)))
+    for fast in (False, True):
+        updater = SettingsStringUpdater(source, fast=fast)
+        assert set(['A', 'B', 'C', 'D', 'GENERATED_1999']) <= \
+                set(updater._assignments())
+        assert 'E' not in updater._assignments()
+        updater.update({'NEW': 1}, {'B': 'b', 'D': {'d': 1},
+            'GENERATED_10': 'x'})
+        # the index knows about appended statements
+        assert_raises(SettingsError, updater.update, {'NEW': 2})
+        settings = {'E': 0, 'f': lambda x: x}
+        exec updater.result in settings
+        assert settings['B'] == ['b']
+        assert settings['C'] == settings['D'] == {'d': 1}
+        assert sorted(settings['GENERATED_10']) == [10, 'x']
+        assert settings['NEW'] == 1
+
+def test_spliced_save():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'settings.py')
+        shutil.copy(os.path.join(TESTDATADIR, 'testsettings.py'), filename)
+        os.chmod(filename, 0640)
+        for fast in (False, True):
+            updater = SettingsFileUpdater(filename, fast=fast)
+            updater.update({'NEW_%d' % fast: 1}, {'NONEMPTY_DICT': {'a': 1},
+                'EMPTY_TUPLE': 'b'})
+            updater.update({}, {'MISSING_%d' % fast: 2,
+                'NONEMPTY_DICT': {'c': 3}},
+                    create_if_missing=True)
+            # only the edited statements are serialized
+            assert len(updater._edits) == 2
+            assert updater.result == str(updater.root)
+            assert updater.save(compare=True)
+            assert stat.S_IMODE(os.stat(filename).st_mode) == 0640
+            assert not updater.save(compare=True)
+            assert not updater.save(filename, compare=True)
+        assert os.listdir(tmpdir) == ['settings.py']
+        settings = {}
+        execfile(filename, settings)
+        assert settings['NONEMPTY_DICT'] == {'Neque': 'foo', 'a': 1, 'c': 3}
+        assert settings['EMPTY_TUPLE'] == ('b', 'b')
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_update_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = open(os.path.join(TESTDATADIR, 'testsettings.py')).read()
+        files = []
+        for i in xrange(12):
+            filename = os.path.join(tmpdir, 'tenant%d.py' % i)
+            with open(filename, 'w') as f:
+                f.write(source)
+            files.append(filename)
+        updates = [(filename, {'new_settings': {'TENANT': i}})
+                for i, filename in enumerate(files)]
+        updates += [(filename, {'append_settings': {'EMPTY_DICT': {'a': 1}}})
+                for filename in files]
+
+        report = update_files(updates, processes=2)
+        assert sorted(report.changed) == sorted(files)
+        assert not report.failed and not report.rolled_back
+        for i, filename in enumerate(files):
+            settings = {}
+            execfile(filename, settings)
+            assert settings['TENANT'] == i
+            assert settings['EMPTY_DICT'] == {'a': 1}
+
+        # TENANT is present now, so every file fails except the new one
+        updates = [(filename, {'new_settings': {'TENANT': 0}})
+                for filename in files[:3]]
+        updates.append((files[3], {'new_settings': {'OTHER': 1}}))
+        contents = [open(filename).read() for filename in files]
+        report = update_files(updates, processes=2, all_or_nothing=True)
+        assert report.rolled_back and report.changed == []
+        assert sorted(report.failed) == sorted(files[:3])
+        assert isinstance(report.failed[files[0]], SettingsError)
+        assert [open(filename).read() for filename in files] == contents
+        assert len(os.listdir(tmpdir)) == len(files)
+
+        report = update_files([(files[3], {'new_settings': {'OTHER': 1}}),
+            (os.path.join(tmpdir, 'missing.py'), {})], processes=1)
+        assert report.changed == [files[3]]
+        assert 'IOError' in str(report.failed.values()[0])
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_replace_all_restores_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prepared = []
+        for name in ('a.py', 'b.py'):
+            filename = os.path.join(tmpdir, name)
+            with open(filename, 'w') as f:
+                f.write('OLD = 1\n')
+            prepared.append((filename,
+                settingshandler._write_temp(filename, 'NEW = 1\n')))
+        # the second replacement fails
+        os.remove(prepared[1][1])
+        assert_raises(SettingsError, settingshandler._replace_all, prepared)
+        assert sorted(os.listdir(tmpdir)) == ['a.py', 'b.py']
+        for filename, tmp_path in prepared:
+            assert open(filename).read() == 'OLD = 1\n'
+    finally:
+        shutil.rmtree(tmpdir)
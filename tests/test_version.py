@@ -70,3 +70,18 @@ def test_fromstring():
         invalid_subrel()
     except VersionError, e:
         assert str(e) == "Subrelease has to be one of pre-alpha (0), alpha (1), beta (2), prerelease (3)."
+
+def test_immutable_and_interned():
+    v = Version(1, 2, 3, 2, 1)
+    assert_raises(AttributeError, setattr, v, 'major', 2)
+    assert hash(v) == hash(Version(1, 2, 3, 2, 1))
+    assert from_string('1.2.3 beta 1') is from_string('1.2.3 beta 1')
+    assert from_string('1.2.3 beta 1') == v
+
+    versions = [Version(1, 2), Version(0, 1, 0, 2, 3), Version(1, 2, 0),
+            Version(0, 9), Version(1, 0, 0, 0)]
+    assert sorted(versions) == sorted(versions,
+            key=lambda version: version.sort_key)
+    assert sorted(versions)[:2] == [Version(0, 1, 0, 2, 3),
+            Version(1, 0, 0, 0)]
+    assert sorted(versions)[-1] == Version(1, 2, 0)